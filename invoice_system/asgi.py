@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'invoice_system.settings')
+# Read by settings: persistent database connections are off under ASGI
+os.environ.setdefault('INVOICING_SERVER', 'asgi')
 
 application = get_asgi_application()
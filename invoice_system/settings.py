@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,7 +42,25 @@ INSTALLED_APPS = [
     'invoicing',  
 ]
 
+REST_FRAMEWORK = {
+    # orjson-backed JSON (see invoicing.renderers); the other entries are
+    # DRF's defaults.
+    'DEFAULT_RENDERER_CLASSES': [
+        'invoicing.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'invoicing.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack
+    'invoicing.instrumentation.InstrumentationMiddleware',
+    # Before any view reads, so it can route them away from the replica
+    'invoicing.replicas.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,13 +94,137 @@ WSGI_APPLICATION = 'invoice_system.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite connection OPTIONS per deployment profile, chosen with the
+# INVOICING_DB_PROFILE environment variable. 'development' keeps SQLite's
+# defaults. 'production' tunes every new connection for concurrent writers:
+# - WAL journaling, so readers never block the writer;
+# - synchronous=NORMAL, which is crash-safe under WAL and fsyncs only at
+#   checkpoints;
+# - a 64 MiB page cache and 256 MiB of memory-mapped I/O;
+# - a 10 s busy timeout.
+# It also opens transactions with BEGIN IMMEDIATE. A checkout then queues
+# for the write lock when it starts, instead of failing with "database is
+# locked" when it tries to upgrade a read lock. Measure with
+# `manage.py benchmark_sqlite_profiles`.
+INVOICING_SQLITE_PROFILES = {
+    'development': {},
+    'production': {
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': ';'.join([
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA cache_size=-65536',
+            'PRAGMA mmap_size=268435456',
+            'PRAGMA busy_timeout=10000',
+        ]),
+    },
+}
+INVOICING_DB_PROFILE = os.environ.get('INVOICING_DB_PROFILE', 'development')
+
+# Connections are kept open for CONN_MAX_AGE seconds and checked before
+# reuse. Django cannot reuse connections safely across requests under ASGI,
+# so when served through asgi.py (which sets INVOICING_SERVER) the default
+# is 0. INVOICING_CONN_MAX_AGE overrides it either way.
+INVOICING_CONN_MAX_AGE = int(os.environ.get(
+    'INVOICING_CONN_MAX_AGE', 0 if os.environ.get('INVOICING_SERVER') == 'asgi' else 60,
+))
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': dict(INVOICING_SQLITE_PROFILES[INVOICING_DB_PROFILE]),
+        'CONN_MAX_AGE': INVOICING_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    # Read replica of 'default', used when INVOICING_REPLICA_DB names its
+    # file (any copy of db.sqlite3 works for local testing). Tests read
+    # through it from the test database of 'default'.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('INVOICING_REPLICA_DB', BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': dict(INVOICING_SQLITE_PROFILES[INVOICING_DB_PROFILE]),
+        'CONN_MAX_AGE': INVOICING_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+# Reads of invoicing models go to INVOICING_READ_REPLICA (None: the
+# primary); see invoicing.replicas. A client that writes keeps reading from
+# the primary for INVOICING_REPLICA_STICKY_SECONDS, to cover replication lag.
+DATABASE_ROUTERS = ['invoicing.replicas.ReplicaRouter']
+INVOICING_READ_REPLICA = 'replica' if os.environ.get('INVOICING_REPLICA_DB') else None
+INVOICING_REPLICA_STICKY_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Item list responses are cached in the 'catalogue' cache, together with the
+# catalogue version that invalidates them. It must be shared by every worker
+# process, or a checkout would only invalidate the pages of the worker that
+# served it: hence a directory on disk by default (a tmpfs path keeps it in
+# memory), or Redis/Memcached in larger deployments. TIMEOUT is the TTL in
+# seconds; entries are culled once MAX_ENTRIES is reached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalogue': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('INVOICING_CATALOGUE_CACHE_DIR', BASE_DIR / 'catalogue_cache'),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
 }
 
+INVOICING_CATALOGUE_CACHE = 'catalogue'
+
+
+# Path of the memory-mapped catalogue snapshot (see invoicing.snapshot)
+# shared by all worker processes; None disables it. Build it with
+# `manage.py build_catalogue_snapshot` when deploying. It is kept up to date
+# from then on; run `manage.py build_catalogue_snapshot --compact`
+# periodically (e.g. from cron) to fold item edits back into the main file.
+# A tmpfs path such as /dev/shm/invoicing-catalogue.snap keeps it in memory.
+INVOICING_CATALOGUE_SNAPSHOT = None
+
+
+# Rendered invoice PDFs are kept here and reused until the purchase changes.
+INVOICING_INVOICE_CACHE_DIR = BASE_DIR / 'invoice_cache'
+
+# Threads used by POST /api/invoice/<id>/render/ to render invoices in the
+# background, and how many finished jobs to remember for status lookups.
+INVOICING_RENDER_WORKERS = 2
+INVOICING_RENDER_JOB_HISTORY = 1000
+
+# Threads rendering invoices for the async (ASGI) invoice endpoint; bounds how
+# many renders run at once.
+INVOICING_ASYNC_RENDER_WORKERS = 4
+
+# Processes rendering invoices for bulk exports. None uses one per CPU core;
+# 0 renders inline in the request thread.
+INVOICING_EXPORT_WORKERS = None
+
+# How long a stock reservation (POST /api/reservations/) holds its items, in
+# seconds, unless the client asks for another ttl; and the longest allowed.
+# Run `manage.py expire_reservations` periodically to return expired holds.
+INVOICING_RESERVATION_TTL = 15 * 60
+INVOICING_RESERVATION_MAX_TTL = 60 * 60
+
+# How long responses to requests with an Idempotency-Key header are kept for
+# replay, in seconds. Run `manage.py prune_idempotency_keys` periodically to
+# delete older ones.
+INVOICING_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Fraction of requests (0.0-1.0) to run under cProfile; the stats of each
+# sampled request are written to INVOICING_PROFILE_DIR as a .prof file
+# (inspect with `python -m pstats <file>` or snakeviz).
+INVOICING_PROFILE_SAMPLE_RATE = 0.0
+INVOICING_PROFILE_DIR = BASE_DIR / 'profiles'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
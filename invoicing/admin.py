@@ -1,27 +1,124 @@
 from django.contrib import admin
+from django.contrib.admin import widgets
+from django.core.paginator import Paginator
+from django.forms.models import BaseInlineFormSet
+from django.urls import NoReverseMatch, reverse
+from django.utils.functional import cached_property
+from django.utils.text import Truncator
+
 from .models import Item, Purchase, PurchaseItem
 
+# Below this many rows the changelist counts exactly
+EXACT_COUNT_THRESHOLD = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that estimates the size of large, unfiltered changelists.
+
+    An exact COUNT(*) reads the whole table on every changelist page. When
+    no filter, date or search applies, the count is taken from the primary
+    key range instead, which costs two index lookups. Ids freed by deletes
+    and archiving make it an upper bound, so the last pages may come up
+    short. Filtered changelists, and small tables, are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if getattr(queryset, 'query', None) is None or queryset.query.where:
+            return super().count
+        ids = queryset.order_by().values_list('pk', flat=True)
+        first, last = ids.order_by('pk').first(), ids.order_by('-pk').first()
+        if first is None:
+            return 0
+        estimate = last - first + 1
+        if estimate < EXACT_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+class LineItemWidget(widgets.ForeignKeyRawIdWidget):
+    """
+    Raw id widget labelled from the line's already joined item.
+
+    The stock widget loads the item again for every line it renders.
+    """
+    item = None
+
+    def label_and_url_for_value(self, value):
+        item = self.item
+        if item is None or str(item.pk) != str(value):
+            return super().label_and_url_for_value(value)
+        try:
+            url = reverse(f'{self.admin_site.name}:invoicing_item_change', args=(item.pk,))
+        except NoReverseMatch:
+            url = ""
+        return Truncator(item).words(14), url
+
+
+class PurchaseItemFormSet(BaseInlineFormSet):
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        line = form.instance
+        if line.pk is not None and PurchaseItem._meta.get_field('item').is_cached(line):
+            form.fields['item'].widget.item = line.item
+        return form
+
+
+# Line items shown on the Purchase page, loaded with their items in one query
+class PurchaseItemInline(admin.TabularInline):
+    model = PurchaseItem
+    formset = PurchaseItemFormSet
+    fields = ('item', 'quantity', 'unit_price', 'line_total')
+    readonly_fields = ('unit_price', 'line_total')
+    raw_id_fields = ('item',)
+    extra = 0
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('item')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'item':
+            kwargs['widget'] = LineItemWidget(db_field.remote_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
 # Admin interface configuration for the Item model
 class ItemAdmin(admin.ModelAdmin):
     list_display = ('name', 'price', 'stock', 'description')
-    
-    # Enable search functionality by item name
+
+    # Enable search functionality by item name (also used by autocomplete)
     search_fields = ('name',)
 
 # Admin interface configuration for the Purchase model
 class PurchaseAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_at')
-    
-    # Add a filter for the 'created_at' field in the list view
-    list_filter = ('created_at',)
+    list_display = ('id', 'created_at', 'line_count', 'total')
+    inlines = (PurchaseItemInline,)
+
+    # Drill down by day, month and year over the created_at index
+    date_hierarchy = 'created_at'
+
+    # Avoid full-table counts on every changelist page
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 # Admin interface configuration for the PurchaseItem model
 class PurchaseItemAdmin(admin.ModelAdmin):
     list_display = ('purchase', 'item', 'quantity')
-    
+    list_select_related = ('purchase', 'item')
+
     # Enable search functionality by item name within PurchaseItem
     search_fields = ('item__name',)
 
+    # Pick related rows by id or search instead of rendering every row in a dropdown
+    raw_id_fields = ('purchase',)
+    autocomplete_fields = ('item',)
+
+    # Avoid full-table counts on every changelist page
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 admin.site.register(Item, ItemAdmin)
 admin.site.register(Purchase, PurchaseAdmin)
 admin.site.register(PurchaseItem, PurchaseItemAdmin)
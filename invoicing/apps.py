@@ -3,3 +3,8 @@ from django.apps import AppConfig
 class InvoicingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'invoicing'
+
+    def ready(self):
+        # Register signal handlers (catalogue cache invalidation, SQL
+        # instrumentation)
+        from . import signals  # noqa: F401
@@ -0,0 +1,238 @@
+"""
+Archival of old purchases into per-month tables.
+
+archive_purchases moves purchases created before a cutoff day, with their
+lines, out of the purchase tables and into ``invoicing_purchase_<YYYY_MM>``
+and ``invoicing_purchaseitem_<YYYY_MM>``, a pair of tables per month of
+creation. The purchase tables and their indexes then only hold recent
+purchases, and an old month can be backed up or dropped as a unit.
+
+Archived purchases are read-only. The purchase detail and invoice endpoints
+fall back to the archive for ids they do not find (see get_purchase); the
+purchase list, exports and updates only cover purchases that are not
+archived. Sales stay in the daily rollup.
+"""
+import contextvars
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.apps.registry import Apps
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from .models import ArchiveMonth, Item, Purchase, PurchaseItem
+from .params import local_midnight
+
+PURCHASE_COLUMNS = ('id', 'created_at', 'subtotal', 'total', 'line_count')
+LINE_COLUMNS = ('id', 'purchase_id', 'item_id', 'quantity', 'unit_price', 'line_total')
+
+# The archive tables are unmanaged models in a registry of their own, so
+# migrations and the admin never see them.
+_registry = Apps()
+_models = {}
+_models_lock = threading.Lock()
+
+# Set while archive_purchases deletes the purchases it moved, whose sales
+# stay in the daily rollup
+_archiving = contextvars.ContextVar('invoicing_archiving', default=False)
+
+
+def is_archiving():
+    """Whether purchases are being deleted because they were archived."""
+    return _archiving.get()
+
+
+def archive_models(month):
+    """
+    Return the ``(purchase, line)`` models of one month's archive tables.
+
+    Args:
+        month: The first day of the month.
+    """
+    suffix = f'{month:%Y_%m}'
+    with _models_lock:
+        if suffix not in _models:
+            def meta(table):
+                return type('Meta', (), {
+                    'app_label': 'invoicing', 'db_table': table, 'managed': False, 'apps': _registry,
+                })
+
+            purchase = type(f'ArchivedPurchase{suffix}', (models.Model,), {
+                '__module__': __name__,
+                'Meta': meta(f'invoicing_purchase_{suffix}'),
+                'id': models.BigIntegerField(primary_key=True),
+                'created_at': models.DateTimeField(),
+                'subtotal': models.DecimalField(max_digits=12, decimal_places=2),
+                'total': models.DecimalField(max_digits=12, decimal_places=2),
+                'line_count': models.PositiveIntegerField(),
+            })
+            line = type(f'ArchivedPurchaseItem{suffix}', (models.Model,), {
+                '__module__': __name__,
+                'Meta': meta(f'invoicing_purchaseitem_{suffix}'),
+                'id': models.BigIntegerField(primary_key=True),
+                'purchase_id': models.BigIntegerField(db_index=True),
+                'item_id': models.BigIntegerField(),
+                'quantity': models.PositiveIntegerField(),
+                'unit_price': models.DecimalField(max_digits=10, decimal_places=2),
+                'line_total': models.DecimalField(max_digits=12, decimal_places=2),
+            })
+            _models[suffix] = (purchase, line)
+        return _models[suffix]
+
+
+def _month_of(created_at):
+    return timezone.localtime(created_at).date().replace(day=1)
+
+
+def _ensure_tables(months):
+    # DDL runs outside the move transaction: SQLite's schema editor cannot
+    # be used inside one.
+    existing = set(connection.introspection.table_names())
+    missing = [
+        model for month in months for model in archive_models(month)
+        if model._meta.db_table not in existing
+    ]
+    if missing:
+        with connection.schema_editor() as editor:
+            for model in missing:
+                editor.create_model(model)
+
+
+def _record_month(month, rows, line_count):
+    summary = ArchiveMonth.objects.select_for_update().filter(month=month).first()
+    if summary is None:
+        summary = ArchiveMonth(month=month, first_id=rows[0]['id'], last_id=rows[0]['id'],
+                               through=timezone.localtime(rows[0]['created_at']).date())
+    summary.first_id = min(summary.first_id, *(row['id'] for row in rows))
+    summary.last_id = max(summary.last_id, *(row['id'] for row in rows))
+    summary.through = max(summary.through, *(timezone.localtime(row['created_at']).date() for row in rows))
+    summary.purchases += len(rows)
+    summary.lines += line_count
+    summary.save()
+
+
+def archive_purchases(before, batch_size=1000):
+    """
+    Move every purchase created before the day ``before`` into the archive.
+
+    Purchases move in id order, ``batch_size`` at a time. Each batch is
+    copied and deleted in one transaction with a bulk insert per table and
+    month, so an interrupted run can simply be started again.
+
+    Args:
+        before: A date; purchases created before its local midnight move.
+        batch_size: Purchases per transaction.
+
+    Returns:
+        int: The number of purchases archived.
+    """
+    cutoff = local_midnight(before)
+    archived = 0
+    while True:
+        batch = list(
+            Purchase.objects.filter(created_at__lt=cutoff).order_by('id').values_list('id', 'created_at')[:batch_size]
+        )
+        if not batch:
+            return archived
+        _ensure_tables({_month_of(created_at) for _, created_at in batch})
+
+        with transaction.atomic():
+            # Read the rows again inside the transaction, so concurrent edits
+            # made since the batch was picked are not lost.
+            ids = [purchase_id for purchase_id, _ in batch]
+            lines = defaultdict(list)
+            for line in PurchaseItem.objects.filter(purchase_id__in=ids).order_by('id').values(*LINE_COLUMNS):
+                lines[line['purchase_id']].append(line)
+            by_month = defaultdict(list)
+            for row in Purchase.objects.filter(id__in=ids).order_by('id').values(*PURCHASE_COLUMNS):
+                by_month[_month_of(row['created_at'])].append(row)
+
+            for month, rows in by_month.items():
+                purchase_model, line_model = archive_models(month)
+                month_lines = [line for row in rows for line in lines[row['id']]]
+                purchase_model.objects.bulk_create([purchase_model(**row) for row in rows])
+                line_model.objects.bulk_create([line_model(**line) for line in month_lines], batch_size=batch_size)
+                _record_month(month, rows, len(month_lines))
+
+            token = _archiving.set(True)
+            try:
+                PurchaseItem.objects.filter(purchase_id__in=ids).delete()
+                Purchase.objects.filter(id__in=ids).delete()
+            finally:
+                _archiving.reset(token)
+        archived += len(ids)
+
+
+def _locate(purchase_id):
+    # Return the archived row of a purchase and its month, or (None, None)
+    months = ArchiveMonth.objects.filter(first_id__lte=purchase_id, last_id__gte=purchase_id)
+    for month in months.order_by('month').values_list('month', flat=True):
+        purchase_model, _ = archive_models(month)
+        row = purchase_model.objects.filter(id=purchase_id).values_list(*PURCHASE_COLUMNS).first()
+        if row is not None:
+            return row, month
+    return None, None
+
+
+def is_archived(purchase_id):
+    """Whether a purchase was moved to the archive."""
+    return _locate(purchase_id)[0] is not None
+
+
+def archived_purchase(purchase_id):
+    """
+    Load an archived purchase the way ``Purchase.objects.with_lines()`` does.
+
+    The purchase and its lines are unsaved-looking model instances built
+    from the archive rows, with the lines (and their items) already in the
+    prefetch cache. Lines of items deleted since are left out, as the
+    cascade would have removed them from the purchase tables.
+
+    Raises:
+        Purchase.DoesNotExist: If no archive holds the purchase.
+    """
+    row, month = _locate(purchase_id)
+    if row is None:
+        raise Purchase.DoesNotExist(f"Purchase {purchase_id} does not exist")
+    _, line_model = archive_models(month)
+    queryset = line_model.objects.filter(purchase_id=purchase_id).order_by('id')
+    line_rows = list(queryset.values_list(*LINE_COLUMNS))
+    items = Item.objects.in_bulk({line[2] for line in line_rows})
+
+    purchase = Purchase.from_db(queryset.db, PURCHASE_COLUMNS, row)
+    lines = []
+    for line_row in line_rows:
+        item = items.get(line_row[2])
+        if item is None:
+            continue
+        line = PurchaseItem.from_db(queryset.db, LINE_COLUMNS, line_row)
+        line.item = item
+        lines.append(line)
+    purchase._prefetched_objects_cache = {'purchaseitem_set': lines}
+    return purchase
+
+
+def get_purchase(queryset, purchase_id):
+    """
+    Fetch a purchase from ``queryset``, falling back to the archive.
+
+    Raises:
+        Purchase.DoesNotExist: If the purchase is in neither.
+    """
+    try:
+        return queryset.get(id=purchase_id)
+    except Purchase.DoesNotExist:
+        return archived_purchase(purchase_id)
+
+
+async def aget_purchase(queryset, purchase_id):
+    """
+    Async variant of get_purchase.
+
+    The archive lookup, which runs rarely, goes through sync_to_async.
+    """
+    try:
+        return await queryset.aget(id=purchase_id)
+    except Purchase.DoesNotExist:
+        return await sync_to_async(archived_purchase)(purchase_id)
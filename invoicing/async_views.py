@@ -0,0 +1,191 @@
+"""
+Async (ASGI-native) variants of the hot invoicing endpoints.
+
+DRF's APIView only runs synchronously, so these are plain Django async views
+mounted under ``/api/async/``. Reads use Django's async ORM directly. The
+checkout needs a transaction, which the async ORM cannot open, so it runs
+through ``sync_to_async``. PDF rendering goes to a small thread pool so a
+slow render never blocks the event loop.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from .cache import acatalogue_version, catalogue_cache, list_etag, list_response_key, params_digest
+from .catalogue import (
+    STREAM_FIELDS, CatalogueQueryError, apaginate, filter_items, is_unfiltered, item_rows, ndjson_line, parse_page,
+)
+from .checkout import CheckoutError, place_order
+from .idempotency import HEADER, REPLAY_HEADER, IdempotencyError, fingerprint, run_idempotent
+from .instrumentation import timed
+from .invoices import InvoiceStore, ainvoice_purchase
+from .models import Purchase
+from .params import set_next_link
+from .renderers import dumps
+from .snapshot import catalogue_snapshot
+from .views import ItemListView
+
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+def render_executor():
+    """
+    Return the thread pool that renders invoices for the async views.
+
+    Its size, ``INVOICING_ASYNC_RENDER_WORKERS``, bounds how many renders run
+    at once; further requests wait for a free worker without holding up the
+    event loop.
+    """
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'INVOICING_ASYNC_RENDER_WORKERS', 4),
+                thread_name_prefix='async-invoice-render',
+            )
+        return _render_executor
+
+
+@require_GET
+async def item_list(request):
+    """
+    Async counterpart of ItemListView, with the same parameters, caching,
+    ``ETag`` and ``Link`` headers.
+    """
+    version = await acatalogue_version()
+    digest = params_digest(request.GET)
+    etag = list_etag(version, digest)
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    try:
+        items = filter_items(request.GET)
+        if request.GET.get('stream') == 'ndjson':
+            # values() rather than values_list(): Django's values_list iterable
+            # runs its query as soon as it is created, which aiterator() does
+            # on the event loop thread.
+            rows = items.values(*STREAM_FIELDS)
+            columns = itemgetter(*STREAM_FIELDS)
+
+            async def lines():
+                async for row in rows.aiterator(chunk_size=ItemListView.stream_chunk_size):
+                    yield ndjson_line(columns(row))
+
+            response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+            response['ETag'] = etag
+            return response
+        cursor, limit = parse_page(request.GET, ItemListView.page_size, ItemListView.max_page_size)
+    except CatalogueQueryError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    cache = catalogue_cache()
+    key = list_response_key(version, digest)
+    cached = await cache.aget(key)
+    if cached is None:
+        snapshot = catalogue_snapshot() if is_unfiltered(request.GET) else None
+        if snapshot is not None:
+            cached = snapshot.page(cursor, limit)
+        else:
+            page, next_cursor = await apaginate(items.values(*STREAM_FIELDS), cursor, limit)
+            with timed('serialize'):
+                cached = (item_rows(page), next_cursor)
+        await cache.aset(key, cached)
+    data, next_cursor = cached
+
+    response = HttpResponse(dumps(data), content_type='application/json')
+    response['ETag'] = etag
+    set_next_link(response, request, request.GET, next_cursor)
+    return response
+
+
+@csrf_exempt
+@require_POST
+async def create_purchase(request):
+    """
+    Async counterpart of CreatePurchaseView, taking the same payload and
+    ``Idempotency-Key`` header.
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({"error": "Body must be JSON"}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Body must be a JSON object"}, status=400)
+
+    def operation():
+        try:
+            purchase = place_order(data.get('items'))
+        except CheckoutError as exc:
+            return 400, {"error": str(exc)}
+        return 201, {"purchase_id": purchase.id}
+
+    key = request.headers.get(HEADER)
+    if key is None:
+        status, body = await sync_to_async(operation)()
+        return JsonResponse(body, status=status)
+
+    try:
+        status, body, replayed = await sync_to_async(run_idempotent)(
+            key, fingerprint(request.method, request.path, data), operation,
+        )
+    except IdempotencyError as exc:
+        return JsonResponse({"error": str(exc)}, status=exc.status_code)
+    response = JsonResponse(body, status=status)
+    if replayed:
+        response[REPLAY_HEADER] = 'true'
+    return response
+
+
+def _read_invoice(purchase, lines):
+    # Runs on the render executor: open (or render and store) the PDF and
+    # read it whole; invoices are small and this keeps file IO off the loop.
+    file, digest, last_modified = InvoiceStore().open(purchase, lines)
+    with file:
+        return file.read(), digest, last_modified
+
+
+@require_GET
+async def invoice(request, id):
+    """
+    Async counterpart of InvoiceView, with the same caching headers.
+    """
+    try:
+        purchase, lines = await ainvoice_purchase(id)
+    except Purchase.DoesNotExist:
+        return JsonResponse({"error": "Purchase not found"}, status=404)
+
+    # run_in_executor does not carry the request's context over to the
+    # worker thread; run the render in a copy of it so its timing (and any
+    # query) is recorded against this request.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    pdf, digest, last_modified = await loop.run_in_executor(
+        render_executor(), functools.partial(context.run, _read_invoice, purchase, lines)
+    )
+    etag = f'"{digest}"'
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if not_modified is not None:
+        return not_modified
+
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Content-Disposition'] = 'attachment; filename="invoice.pdf"'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
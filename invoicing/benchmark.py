@@ -0,0 +1,332 @@
+"""
+Load generation and measurement for the invoicing endpoints.
+
+Used by the ``benchmark_endpoints`` management command. Requests are sent
+in-process through Django's test client, so the numbers cover the full
+request/response cycle (middleware, views, ORM, rendering) without network
+noise.
+"""
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+
+from .catalogue import STREAM_FIELDS, item_rows
+from .models import DailyItemSales, Item, Purchase, PurchaseItem
+from .renderers import dumps
+from .serializers import ItemSerializer
+
+SCENARIOS = ('item_list', 'create_purchase', 'update_purchase', 'invoice')
+
+# Stock given to seeded items; large enough that no benchmark run sells out.
+SEED_STOCK = 10 ** 9
+
+
+def percentile(samples, pct):
+    """Return the nearest-rank ``pct`` percentile of ``samples``."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def peak_rss_kib():
+    """Peak resident set size of this process so far, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _seed_price(n):
+    return Decimal(n % 500) + Decimal('0.99')
+
+
+@contextmanager
+def scratch_environment(directory, db_options=None):
+    """
+    Run the block against a throwaway database in ``directory``.
+
+    Never seed the real database: the schema is built the same way the test
+    runner does. SQLite gets a file rather than the in-memory default so
+    concurrent clients can share it. Invoice PDFs are cached in
+    ``directory`` too, and the catalogue cache starts empty.
+
+    Args:
+        directory: A scratch directory, removed by the caller afterwards.
+        db_options: Connection ``OPTIONS`` to use instead of the configured
+            ones, e.g. an entry of ``INVOICING_SQLITE_PROFILES``.
+    """
+    settings_dict = connection.settings_dict
+    if connection.vendor == 'sqlite':
+        settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    old_options = settings_dict['OPTIONS']
+    if db_options is not None:
+        # Every thread's connection is built from this same settings dict
+        connection.close()
+        settings_dict['OPTIONS'] = dict(db_options)
+    old_name = settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    # Failed requests are counted in the report; don't also log a traceback
+    # for each of them.
+    request_logger = logging.getLogger('django.request')
+    level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+    try:
+        # The in-process client sends "Host: testserver", as under the test runner
+        with override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            INVOICING_INVOICE_CACHE_DIR=os.path.join(directory, 'invoices'),
+            # The replica would not see the scratch data
+            INVOICING_READ_REPLICA=None,
+        ):
+            caches['catalogue'].clear()
+            yield
+    finally:
+        request_logger.setLevel(level)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if db_options is not None:
+            connection.close()
+            settings_dict['OPTIONS'] = old_options
+
+
+def seed(items, purchases, lines_per_purchase=3, batch_size=5000):
+    """
+    Fill the database with ``items`` items and ``purchases`` purchases.
+
+    Everything is written with bulk inserts, so seeding a million rows takes
+    seconds rather than hours. Each purchase gets ``lines_per_purchase``
+    distinct items.
+
+    Returns:
+        tuple: ``(item_ids, purchase_ids)`` of the seeded rows.
+    """
+    item_ids, purchase_ids = [], []
+    for start in range(0, items, batch_size):
+        created = Item.objects.bulk_create([
+            Item(name=f"Item {n:07d}", price=_seed_price(n),
+                 description="Seeded for benchmarking", stock=SEED_STOCK)
+            for n in range(start, min(start + batch_size, items))
+        ])
+        item_ids.extend(item.id for item in created)
+
+    lines_per_purchase = min(lines_per_purchase, len(item_ids))
+    step = max(len(item_ids) // max(lines_per_purchase, 1), 1)
+    for start in range(0, purchases, batch_size):
+        created = Purchase.objects.bulk_create([
+            Purchase() for _ in range(start, min(start + batch_size, purchases))
+        ])
+        lines = []
+        for n, purchase in enumerate(created, start=start):
+            for k in range(lines_per_purchase):
+                index = (n + k * step) % len(item_ids)
+                price = _seed_price(index)
+                lines.append(PurchaseItem(purchase=purchase, item_id=item_ids[index], quantity=1,
+                                          unit_price=price, line_total=price))
+        PurchaseItem.objects.bulk_create(lines, batch_size=batch_size)
+        Purchase.objects.filter(pk__in=[purchase.pk for purchase in created]).update_totals()
+        purchase_ids.extend(purchase.id for purchase in created)
+
+    DailyItemSales.objects.rebuild()
+    return item_ids, purchase_ids
+
+
+class ScenarioResult:
+    """Latencies and query counts collected for one scenario run."""
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, latency, queries, ok):
+        with self._lock:
+            self.latencies.append(latency)
+            self.queries.append(queries)
+            if not ok:
+                self.errors += 1
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.concurrency}"
+
+    def summary(self):
+        count = len(self.latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "throughput": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(self.latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(self.latencies, 99) * 1000, 3),
+            "queries_mean": round(sum(self.queries) / count, 2) if count else 0.0,
+            "queries_max": max(self.queries, default=0),
+        }
+
+
+def _send(scenario, client, rng, item_ids, purchase_ids):
+    if scenario == 'item_list':
+        cursor = rng.choice(item_ids) - 1
+        return client.get(reverse('item-list'), {'cursor': cursor, 'limit': 100})
+    if scenario == 'create_purchase':
+        lines = rng.sample(item_ids, min(rng.randint(1, 5), len(item_ids)))
+        return client.post(
+            reverse('create-purchase'),
+            {"items": [{"id": item_id, "quantity": 1} for item_id in lines]},
+            content_type='application/json',
+        )
+    if scenario == 'update_purchase':
+        return client.patch(
+            reverse('update-purchase', kwargs={'id': rng.choice(purchase_ids)}),
+            {"items": [{"id": rng.choice(item_ids), "quantity": rng.randint(1, 3)}]},
+            content_type='application/json',
+        )
+    if scenario == 'invoice':
+        return client.get(reverse('generate-invoice', kwargs={'id': rng.choice(purchase_ids)}))
+    raise ValueError(f"Unknown scenario {scenario!r}")
+
+
+def _drive(scenario, count, result, item_ids, purchase_ids, seed_value):
+    client = Client(raise_request_exception=False)
+    rng = random.Random(seed_value)
+    for _ in range(count):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = _send(scenario, client, rng, item_ids, purchase_ids)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            latency = time.perf_counter() - started
+        result.add(latency, len(queries), response.status_code < 400)
+
+
+def run_scenario(scenario, requests, concurrency, item_ids, purchase_ids, seed_value=0):
+    """
+    Send ``requests`` requests of one scenario from ``concurrency`` clients.
+
+    With a concurrency of 1 the requests run on the calling thread; otherwise
+    each client runs on its own thread with its own database connection.
+
+    Returns:
+        ScenarioResult: The collected measurements.
+    """
+    result = ScenarioResult(scenario, concurrency)
+    started = time.perf_counter()
+    if concurrency <= 1:
+        _drive(scenario, requests, result, item_ids, purchase_ids, seed_value)
+    else:
+        def worker(n):
+            try:
+                share = requests // concurrency + (1 if n < requests % concurrency else 0)
+                _drive(scenario, share, result, item_ids, purchase_ids, seed_value + n)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def run_benchmark(item_ids, purchase_ids, scenarios=SCENARIOS, requests=200, concurrency=(1,), seed_value=0):
+    """
+    Run every scenario at every concurrency level against seeded data.
+
+    Returns:
+        dict: ``{"scenarios": {"<scenario>@<concurrency>": summary},
+        "serialization": {...}, "peak_rss_kib": int}``; see
+        time_item_serialization for the ``serialization`` entry.
+    """
+    report = {"scenarios": {}}
+    for scenario in scenarios:
+        for level in concurrency:
+            result = run_scenario(scenario, requests, level, item_ids, purchase_ids, seed_value)
+            report["scenarios"][result.key] = result.summary()
+    report["serialization"] = time_item_serialization()
+    report["peak_rss_kib"] = peak_rss_kib()
+    return report
+
+
+def time_item_serialization(limit=1000, repeat=20):
+    """
+    Compare the two ways of turning a page of items into a JSON body.
+
+    ``model_serializer`` is the original path (model instances through
+    ItemSerializer and DRF's stdlib JSONRenderer); ``values_rows`` is the one
+    the item list uses now (``values()`` rows through item_rows and
+    renderers.dumps). Both include fetching the page.
+
+    Returns:
+        dict: Median milliseconds per page for each path, and the page size.
+    """
+    page = Item.objects.order_by('id')[:limit]
+    renderer = JSONRenderer()
+    paths = {
+        "model_serializer": lambda: renderer.render(ItemSerializer(list(page), many=True).data),
+        "values_rows": lambda: dumps(item_rows(page.values(*STREAM_FIELDS))),
+    }
+    timings = {}
+    for name, render in paths.items():
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            render()
+            samples.append(time.perf_counter() - started)
+        timings[f"{name}_ms"] = round(percentile(samples, 50) * 1000, 3)
+    timings["rows"] = len(page)
+    return timings
+
+
+def compare_to_baseline(report, baseline, tolerance=0.25, min_delta_ms=1.0):
+    """
+    List the ways ``report`` is worse than ``baseline``.
+
+    Latency percentiles may grow by ``tolerance`` (a fraction) and by at
+    least ``min_delta_ms`` before they count, so sub-millisecond jitter does
+    not fail a run. Query counts are deterministic and may not grow at all.
+    Scenarios missing from either side are skipped.
+
+    Returns:
+        list: Human-readable regression messages; empty when there are none.
+    """
+    regressions = []
+    for key, current in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(key)
+        if previous is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            limit = max(previous[metric] * (1 + tolerance), previous[metric] + min_delta_ms)
+            if current[metric] > limit:
+                regressions.append(
+                    f"{key}: {metric} {current[metric]:.2f} > {previous[metric]:.2f} (limit {limit:.2f})"
+                )
+        if current["queries_max"] > previous["queries_max"]:
+            regressions.append(
+                f"{key}: queries per request {current['queries_max']} > {previous['queries_max']}"
+            )
+        if current["errors"] > previous["errors"]:
+            regressions.append(f"{key}: errors {current['errors']} > {previous['errors']}")
+
+    previous_rss = baseline.get("peak_rss_kib")
+    if previous_rss and report["peak_rss_kib"] > previous_rss * (1 + tolerance):
+        regressions.append(f"peak RSS {report['peak_rss_kib']} KiB > {previous_rss} KiB")
+    return regressions
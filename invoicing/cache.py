@@ -0,0 +1,80 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+# Cache key holding the catalogue version counter. Every cached item list
+# response embeds the version it was built from, so bumping the counter
+# invalidates all of them at once without having to enumerate keys.
+VERSION_KEY = 'invoicing:catalogue:version'
+
+
+def catalogue_cache():
+    """
+    Return the cache backend used for item list responses.
+
+    The alias comes from ``INVOICING_CATALOGUE_CACHE`` (default ``'default'``);
+    TTL and eviction are configured on that entry of ``CACHES``.
+    """
+    return caches[getattr(settings, 'INVOICING_CATALOGUE_CACHE', 'default')]
+
+
+def catalogue_version():
+    """
+    Return the current catalogue version, initializing it if missing.
+
+    The counter is seeded from the clock rather than 1 so that, if it is ever
+    evicted, the new value cannot collide with versions still embedded in
+    cached responses.
+    """
+    cache = catalogue_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+async def acatalogue_version():
+    """Async variant of catalogue_version."""
+    cache = catalogue_cache()
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, time.time_ns(), timeout=None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def bump_catalogue_version():
+    """Invalidate every cached item list response."""
+    cache = catalogue_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def bump_catalogue_version_on_commit():
+    """
+    Invalidate cached item lists once the current transaction commits.
+
+    Bumping before the commit would let a concurrent reader cache the old rows
+    under the new version.
+    """
+    transaction.on_commit(bump_catalogue_version)
+
+
+def params_digest(params):
+    """Return a stable digest of a request's query parameters."""
+    pairs = sorted((key, value) for key in params for value in params.getlist(key))
+    return hashlib.sha1(repr(pairs).encode()).hexdigest()
+
+
+def list_response_key(version, digest):
+    return f'invoicing:catalogue:list:{version}:{digest}'
+
+
+def list_etag(version, digest):
+    return f'"{version}-{digest[:16]}"'
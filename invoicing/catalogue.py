@@ -0,0 +1,182 @@
+import json
+from decimal import Decimal, InvalidOperation
+
+from .models import Item
+from .params import ClientError
+
+
+class CatalogueQueryError(ClientError):
+    """Raised when item list query parameters cannot be parsed."""
+
+
+def _parse_int(params, name, minimum=0):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise CatalogueQueryError(f"'{name}' must be an integer")
+    if value < minimum:
+        raise CatalogueQueryError(f"'{name}' must be at least {minimum}")
+    return value
+
+
+def _parse_decimal(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = Decimal(value)
+    except InvalidOperation:
+        raise CatalogueQueryError(f"'{name}' must be a number")
+    if not value.is_finite():
+        raise CatalogueQueryError(f"'{name}' must be a number")
+    return value
+
+
+def _parse_bool(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    value = value.lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    raise CatalogueQueryError(f"'{name}' must be true or false")
+
+
+def _prefix_range(field, prefix):
+    # Express "starts with" as a range so it can use the column's index;
+    # SQLite's LIKE is case-insensitive and cannot use an ordinary index.
+    last = ord(prefix[-1])
+    if last >= 0x10FFFF:
+        return {f'{field}__startswith': prefix}
+    return {f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + chr(last + 1)}
+
+
+# Query parameters filter_items filters on
+FILTER_PARAMS = ('name', 'min_price', 'max_price', 'in_stock')
+
+
+def is_unfiltered(params):
+    """Whether a list request asks for the whole catalogue."""
+    return not any(params.get(name) for name in FILTER_PARAMS)
+
+
+def filter_items(params):
+    """
+    Build the item queryset described by the list endpoint's query parameters.
+
+    Supported parameters:
+        name: Only items whose name starts with this prefix.
+        min_price / max_price: Inclusive price bounds.
+        in_stock: ``true`` for items with stock left, ``false`` for sold-out items.
+
+    The queryset is always ordered by ``id`` so it can be walked with keyset
+    pagination; each filter is backed by an index on its column.
+
+    Raises:
+        CatalogueQueryError: If a parameter has an invalid value.
+    """
+    queryset = Item.objects.order_by('id')
+
+    name = params.get('name')
+    if name:
+        queryset = queryset.filter(**_prefix_range('name', name))
+
+    min_price = _parse_decimal(params, 'min_price')
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+
+    max_price = _parse_decimal(params, 'max_price')
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+
+    in_stock = _parse_bool(params, 'in_stock')
+    if in_stock is True:
+        queryset = queryset.filter(stock__gt=0)
+    elif in_stock is False:
+        queryset = queryset.filter(stock=0)
+
+    return queryset
+
+
+def parse_page(params, default_size, max_size):
+    """
+    Read the keyset cursor and page size from the query parameters.
+
+    Returns:
+        tuple: ``(cursor, limit)`` where ``cursor`` is the id of the last item
+        on the previous page (or None for the first page).
+    """
+    cursor = _parse_int(params, 'cursor')
+    limit = _parse_int(params, 'limit', minimum=1)
+    if limit is None:
+        limit = default_size
+    return cursor, min(limit, max_size)
+
+
+# Columns streamed by the NDJSON mode of the item list, see ndjson_line
+STREAM_FIELDS = ('id', 'name', 'price', 'description', 'stock')
+
+
+def ndjson_line(row):
+    """Format a ``values_list(*STREAM_FIELDS)`` row as one NDJSON line."""
+    item_id, name, price, description, stock = row
+    return json.dumps({
+        "id": item_id,
+        "name": name,
+        "price": str(price),
+        "description": description,
+        "stock": stock,
+    }) + "\n"
+
+
+def item_rows(rows):
+    """
+    Format ``values(*STREAM_FIELDS)`` rows exactly as ItemSerializer would.
+
+    Building plain dicts skips ModelSerializer's per-field machinery, which
+    is most of the cost of serializing a large page of items.
+    """
+    return [dict(row, price=str(row['price'])) for row in rows]
+
+
+def _row_id(row):
+    # Pages may hold model instances or values() dicts
+    return row['id'] if isinstance(row, dict) else row.id
+
+
+def paginate(queryset, cursor, limit, descending=False):
+    """
+    Fetch one keyset page from an ``id``-ordered queryset.
+
+    Args:
+        descending: The queryset is ordered by ``-id`` (newest first).
+
+    Returns:
+        tuple: ``(rows, next_cursor)``. ``next_cursor`` is None on the last page.
+    """
+    if cursor is not None:
+        queryset = queryset.filter(id__lt=cursor) if descending else queryset.filter(id__gt=cursor)
+
+    # Fetch one extra row to learn whether another page follows.
+    rows = list(queryset[:limit + 1])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, _row_id(rows[-1])
+    return rows, None
+
+
+async def apaginate(queryset, cursor, limit):
+    """Async variant of paginate."""
+    if cursor is not None:
+        queryset = queryset.filter(id__gt=cursor)
+
+    rows = [row async for row in queryset[:limit + 1]]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, _row_id(rows[-1])
+    return rows, None
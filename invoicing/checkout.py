@@ -0,0 +1,337 @@
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from .cache import bump_catalogue_version_on_commit
+from .snapshot import refresh_snapshot_on_commit
+from .models import DailyItemSales, Item, Purchase, PurchaseItem
+from .params import ClientError, integer_range
+
+
+class CheckoutError(ClientError):
+    """Base error raised when an order cannot be placed."""
+
+
+class UnknownItem(CheckoutError):
+    def __init__(self, item_id):
+        self.item_id = item_id
+        super().__init__(f"Item {item_id} does not exist")
+
+
+class InsufficientStock(CheckoutError):
+    def __init__(self, item):
+        self.item = item
+        super().__init__(f"Not enough stock for {item.name}")
+
+
+class _StockConflict(Exception):
+    # Raised inside a savepoint to undo a partially applied stock update.
+    pass
+
+
+def normalize_lines(items_data, allow_zero=False):
+    """
+    Validate the raw ``items`` payload and merge repeated item ids.
+
+    Args:
+        items_data: A list of ``{"id": <item id>, "quantity": <int>}`` dicts;
+            both values must be ints (not floats, strings or booleans).
+        allow_zero: Accept a quantity of 0 (used by partial updates to
+            remove a line).
+
+    Returns:
+        dict: Quantities keyed by item id, in the order the items first appear.
+
+    Raises:
+        CheckoutError: If a line is malformed, has a non-positive quantity, or
+            a value the database cannot store.
+    """
+    if not isinstance(items_data, list) or not items_data:
+        raise CheckoutError("At least one item is required")
+
+    min_id, max_id = integer_range(Item._meta.pk)
+    _, max_quantity = integer_range(PurchaseItem._meta.get_field('quantity'))
+    quantities = {}
+    for line in items_data:
+        try:
+            item_id, quantity = line['id'], line['quantity']
+        except (KeyError, TypeError):
+            raise CheckoutError("Each item needs an integer 'id' and 'quantity'")
+        # int() would truncate floats and accept booleans
+        if type(item_id) is not int or type(quantity) is not int:
+            raise CheckoutError("Each item needs an integer 'id' and 'quantity'")
+        if not min_id <= item_id <= max_id:
+            raise CheckoutError(f"Item id {item_id} is out of range")
+        if quantity < 0 or (quantity == 0 and not allow_zero):
+            raise CheckoutError("Quantity must be a positive integer")
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+        if quantities[item_id] > max_quantity:
+            raise CheckoutError(f"Quantity must be at most {max_quantity}")
+    return quantities
+
+
+def load_items(quantities):
+    """
+    Fetch every item referenced by an order in a single ``id__in`` query.
+
+    Raises:
+        UnknownItem: If any of the requested ids is missing.
+    """
+    items = Item.objects.in_bulk(list(quantities))
+    for item_id in quantities:
+        if item_id not in items:
+            raise UnknownItem(item_id)
+    return items
+
+
+def adjust_stock(items, deltas, hold=False):
+    """
+    Apply per-item stock changes, guarded against overselling.
+
+    A positive delta takes stock (a sale), a negative one gives it back.
+    Every change is applied in one ``UPDATE`` whose ``WHERE`` clause requires
+    ``stock >= delta`` for each row that loses stock, so the row count tells
+    us whether all of them fit. If not (another checkout got there first),
+    the partial update is rolled back to a savepoint and the changes are
+    re-applied one by one to find the item that ran out.
+
+    Must be called inside a transaction.
+
+    Args:
+        items: Items keyed by id; needed for every item with a positive delta.
+        deltas: Stock to take, keyed by item id.
+        hold: Move the stock into ``Item.reserved`` instead of selling it
+            (or, for negative deltas, back out of it), in the same update.
+
+    Raises:
+        InsufficientStock: If any item would go below zero.
+    """
+    deltas = {item_id: delta for item_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    refresh_snapshot_on_commit(deltas)
+
+    # Cheap pre-check against the rows we just loaded so the common failure
+    # never reaches the UPDATE.
+    for item_id, delta in deltas.items():
+        if delta > 0 and items[item_id].stock < delta:
+            raise InsufficientStock(items[item_id])
+
+    guard = Q()
+    stock, reserved = [], []
+    for item_id, delta in deltas.items():
+        guard |= Q(pk=item_id, stock__gte=delta) if delta > 0 else Q(pk=item_id)
+        stock.append(When(pk=item_id, then=F('stock') - delta))
+        reserved.append(When(pk=item_id, then=F('reserved') + delta))
+
+    changes = {'stock': Case(*stock, default=F('stock'), output_field=Item._meta.get_field('stock'))}
+    if hold:
+        changes['reserved'] = Case(*reserved, default=F('reserved'), output_field=Item._meta.get_field('reserved'))
+
+    try:
+        with transaction.atomic():
+            updated = Item.objects.filter(guard).update(**changes)
+            if updated != len(deltas):
+                raise _StockConflict
+        return
+    except _StockConflict:
+        pass
+
+    for item_id, delta in deltas.items():
+        rows = Item.objects.filter(pk=item_id)
+        if delta > 0:
+            rows = rows.filter(stock__gte=delta)
+        changes = {'stock': F('stock') - delta}
+        if hold:
+            changes['reserved'] = F('reserved') + delta
+        if not rows.update(**changes) and delta > 0:
+            raise InsufficientStock(items[item_id])
+
+
+def reserve_stock(items, quantities):
+    """
+    Decrement stock for all lines of a new order; see adjust_stock.
+
+    Raises:
+        InsufficientStock: If any line asks for more than is in stock.
+    """
+    adjust_stock(items, quantities)
+
+
+def build_lines(items, quantities, prices=None):
+    """
+    Build unsaved purchase lines with their price snapshot filled in.
+
+    Args:
+        items: Items keyed by id, as returned by load_items.
+        quantities: Quantities keyed by item id.
+        prices: Optional unit prices keyed by item id that take precedence
+            over the current item price (to keep an earlier snapshot).
+
+    Returns:
+        list: PurchaseItem instances without a purchase set.
+    """
+    prices = prices or {}
+    lines = []
+    for item_id, quantity in quantities.items():
+        line = PurchaseItem(item=items[item_id], quantity=quantity, unit_price=prices.get(item_id))
+        line.fill_snapshot()
+        lines.append(line)
+    return lines
+
+
+def line_sales(lines):
+    """
+    Sum lines into the ``(units, revenue)`` per item id format taken by
+    ``DailyItemSales.objects.record``.
+    """
+    sales = {}
+    for line in lines:
+        units, revenue = sales.get(line.item_id, (0, 0))
+        sales[line.item_id] = (units + line.quantity, revenue + line.line_total)
+    return sales
+
+
+def place_order(items_data):
+    """
+    Create a purchase and its lines, decrementing stock atomically.
+
+    Runs a constant number of queries regardless of how many lines the order
+    has: one to load the items, one to insert the purchase, one conditional
+    stock update, one bulk insert for the lines and the sales rollup update.
+    Each line records the price it was sold at and the purchase stores its
+    totals. Any failure rolls back the whole order, so no half-created
+    purchase or stray stock change is left behind.
+
+    Args:
+        items_data: The raw ``items`` list from the request payload.
+
+    Returns:
+        Purchase: The newly created purchase.
+
+    Raises:
+        CheckoutError: If the payload is invalid, an item does not exist or
+        stock is insufficient.
+    """
+    quantities = normalize_lines(items_data)
+
+    with transaction.atomic():
+        items = load_items(quantities)
+        reserve_stock(items, quantities)
+        # Stock is part of the cached item list; update() sends no signals.
+        bump_catalogue_version_on_commit()
+        return create_purchase(items, quantities)
+
+
+def create_purchase(items, quantities):
+    """
+    Insert a purchase for stock that has already been taken.
+
+    Snapshots the line prices, stores the totals and records the sale in
+    the daily rollup. Must be called inside a transaction.
+
+    Args:
+        items: Items keyed by id, as returned by load_items.
+        quantities: Quantities keyed by item id.
+
+    Returns:
+        Purchase: The new purchase.
+    """
+    lines = build_lines(items, quantities)
+    purchase = Purchase()
+    purchase.set_totals(lines)
+    purchase.save()
+    for line in lines:
+        line.purchase = purchase
+    PurchaseItem.objects.bulk_create(lines)
+    DailyItemSales.objects.record(timezone.localdate(purchase.created_at), line_sales(lines))
+    return purchase
+
+
+def update_lines(purchase, items_data, partial=False):
+    """
+    Bring a purchase's lines in line with the payload using minimal writes.
+
+    Existing lines are diffed against the requested quantities: only new
+    lines are inserted, only lines whose quantity changed are updated and
+    only dropped lines are deleted, each as a single bulk statement. Stock
+    is adjusted by the net change per item, guarded like a checkout. Items
+    that were already on the purchase keep the price they were sold at. All
+    of it runs in one transaction with a constant number of queries.
+
+    Args:
+        purchase: The Purchase to update.
+        items_data: The raw ``items`` list from the request payload.
+        partial: When True only the listed items change (a quantity of 0
+            removes the line); otherwise the payload replaces every line.
+
+    Returns:
+        dict: How many lines were created, updated and deleted.
+
+    Raises:
+        CheckoutError: If the payload is invalid, an item does not exist,
+        stock is insufficient or the purchase would be left empty.
+    """
+    quantities = normalize_lines(items_data, allow_zero=partial)
+
+    with transaction.atomic():
+        # Serialize concurrent edits of the same purchase
+        Purchase.objects.select_for_update().filter(pk=purchase.pk).exists()
+        existing = {line.item_id: line for line in PurchaseItem.objects.filter(purchase=purchase)}
+
+        if partial:
+            target = {item_id: line.quantity for item_id, line in existing.items()}
+            target.update(quantities)
+            target = {item_id: quantity for item_id, quantity in target.items() if quantity}
+        else:
+            target = quantities
+        if not target:
+            raise CheckoutError("A purchase needs at least one item")
+
+        # Sales before the change, so the rollup can be moved by the difference
+        sold_before = line_sales(existing.values())
+
+        new_ids = {item_id: quantity for item_id, quantity in target.items() if item_id not in existing}
+        items = load_items(target)
+
+        deltas = {
+            item_id: target.get(item_id, 0) - (existing[item_id].quantity if item_id in existing else 0)
+            for item_id in target.keys() | existing.keys()
+        }
+        adjust_stock(items, deltas)
+
+        created = build_lines(items, new_ids)
+        for line in created:
+            line.purchase = purchase
+        changed = []
+        for item_id, line in existing.items():
+            if item_id in target and target[item_id] != line.quantity:
+                line.quantity = target[item_id]
+                line.fill_snapshot()
+                changed.append(line)
+        removed = [line.pk for item_id, line in existing.items() if item_id not in target]
+
+        if created:
+            PurchaseItem.objects.bulk_create(created)
+        if changed:
+            PurchaseItem.objects.bulk_update(changed, ['quantity', 'line_total'])
+        if removed:
+            PurchaseItem.objects.filter(pk__in=removed).delete()
+
+        kept = [line for item_id, line in existing.items() if item_id in target]
+        purchase.set_totals(kept + created)
+        purchase.save(update_fields=['subtotal', 'total', 'line_count'])
+
+        sold_after = line_sales(kept + created)
+        DailyItemSales.objects.record(timezone.localdate(purchase.created_at), {
+            item_id: (
+                sold_after.get(item_id, (0, 0))[0] - sold_before.get(item_id, (0, 0))[0],
+                sold_after.get(item_id, (0, 0))[1] - sold_before.get(item_id, (0, 0))[1],
+            )
+            for item_id in sold_before.keys() | sold_after.keys()
+        })
+
+        if any(deltas.values()):
+            bump_catalogue_version_on_commit()
+
+    return {"created": len(created), "updated": len(changed), "deleted": len(removed)}
@@ -0,0 +1,149 @@
+import os
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .invoices import invoice_rows, render_invoice
+from .models import Purchase
+from .params import ClientError, integer_range, on_days, parse_day
+
+
+class ExportQueryError(ClientError):
+    """Raised when the purchases to export cannot be determined."""
+
+
+def parse_ids(value):
+    """Parse a comma-separated list of purchase ids."""
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise ExportQueryError("'ids' must be a comma-separated list of integers")
+    # Checked here: an id the database cannot store would only fail once
+    # the export is already streaming.
+    min_id, max_id = integer_range(Purchase._meta.pk)
+    for purchase_id in ids:
+        if not min_id <= purchase_id <= max_id:
+            raise ExportQueryError(f"Purchase id {purchase_id} is out of range")
+    return ids
+
+
+def export_queryset(start=None, end=None, ids=None):
+    """
+    Select the purchases to export.
+
+    Args:
+        start: First day to include, as a ``YYYY-MM-DD`` string.
+        end: Last day to include, as a ``YYYY-MM-DD`` string.
+        ids: A list of purchase ids.
+
+    Returns:
+        QuerySet: Matching purchases with their lines prefetched, ordered by id.
+
+    Raises:
+        ExportQueryError: If no selection is given or a value is invalid.
+    """
+    if not (start or end or ids):
+        raise ExportQueryError("Give a date range ('start'/'end') or a list of 'ids'")
+
+    purchases = on_days(
+        Purchase.objects.with_lines().order_by('id'),
+        parse_day(start, 'start', ExportQueryError), parse_day(end, 'end', ExportQueryError),
+    )
+    if ids:
+        purchases = purchases.filter(id__in=ids)
+    return purchases
+
+
+def render_invoices(purchases, executor=None, window=16, chunk_size=200):
+    """
+    Render the invoice of every purchase, in parallel when given an executor.
+
+    Purchases are read from the database in chunks and at most ``window``
+    renders are in flight at once, so memory stays bounded however many
+    purchases are exported.
+
+    Yields:
+        tuple: ``(purchase_id, pdf_bytes)`` in purchase order.
+    """
+    if executor is None:
+        for purchase in purchases.iterator(chunk_size=chunk_size):
+            yield purchase.id, render_invoice(invoice_rows(purchase.purchaseitem_set.all()), purchase.total)
+        return
+
+    pending = deque()
+    for purchase in purchases.iterator(chunk_size=chunk_size):
+        rows = invoice_rows(purchase.purchaseitem_set.all())
+        pending.append((purchase.id, executor.submit(render_invoice, rows, purchase.total)))
+        if len(pending) >= window:
+            purchase_id, future = pending.popleft()
+            yield purchase_id, future.result()
+    while pending:
+        purchase_id, future = pending.popleft()
+        yield purchase_id, future.result()
+
+
+class _ChunkBuffer:
+    # Write-only file object for zipfile; zipfile copes with streams that
+    # cannot seek by writing data descriptors after each member.
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(rendered):
+    """
+    Pack rendered invoices into a ZIP archive, yielding it piece by piece.
+
+    Args:
+        rendered: An iterable of ``(purchase_id, pdf_bytes)``, as produced by
+            render_invoices.
+
+    Yields:
+        bytes: Consecutive chunks of the archive.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for purchase_id, pdf in rendered:
+            archive.writestr(f'invoice-{purchase_id}.pdf', pdf)
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def export_workers():
+    """Number of render processes; ``INVOICING_EXPORT_WORKERS`` or one per core."""
+    workers = getattr(settings, 'INVOICING_EXPORT_WORKERS', None)
+    return os.cpu_count() if workers is None else workers
+
+
+def export_executor():
+    """
+    Return the process pool shared by export requests, or None when
+    ``INVOICING_EXPORT_WORKERS`` is 0 and invoices should render inline.
+    """
+    global _executor
+    workers = export_workers()
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
@@ -0,0 +1,153 @@
+"""
+``Idempotency-Key`` support for the purchase write endpoints.
+
+The first request with a given key runs normally; if it succeeds, its
+response is stored in the same transaction as its effects. Retries with the
+same key and payload get the stored response back after one indexed lookup,
+without touching stock again. Failed requests are not stored, so a retry
+after an error runs the request again.
+"""
+import datetime
+import functools
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+from .params import ClientError
+
+HEADER = 'Idempotency-Key'
+REPLAY_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+class IdempotencyError(ClientError):
+    """
+    Raised when an idempotency key cannot be used for a request.
+
+    ``status_code`` is the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status_code):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def fingerprint(method, path, data):
+    """Hash a request's method, path and parsed payload."""
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{method}\n{path}\n{payload}".encode()).hexdigest()
+
+
+def _ttl():
+    return datetime.timedelta(seconds=settings.INVOICING_IDEMPOTENCY_TTL)
+
+
+def _lookup(key, request_fingerprint):
+    # Returns the stored (status, data), or None if the key is unused.
+    record = IdempotencyKey.objects.filter(key=key).first()
+    if record is None:
+        return None
+    if record.created_at <= timezone.now() - _ttl():
+        # Expired but not pruned yet: free the key for this request.
+        IdempotencyKey.objects.filter(pk=record.pk).delete()
+        return None
+    if record.fingerprint != request_fingerprint:
+        raise IdempotencyError("Idempotency-Key was already used for a different request", 422)
+    return record.status_code, record.response
+
+
+def run_idempotent(key, request_fingerprint, operation):
+    """
+    Run ``operation`` once per idempotency key.
+
+    Args:
+        key: The client's ``Idempotency-Key`` header value.
+        request_fingerprint: See fingerprint.
+        operation: Callable returning ``(status_code, data)``. It runs in
+            a transaction with the insert of the stored response.
+
+    Returns:
+        tuple: ``(status_code, data, replayed)``.
+
+    Raises:
+        IdempotencyError: If the key is malformed or was used for another
+        request.
+    """
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters", 400)
+
+    stored = _lookup(key, request_fingerprint)
+    if stored is not None:
+        return (*stored, True)
+
+    try:
+        with transaction.atomic():
+            status_code, data = operation()
+            if 200 <= status_code < 300:
+                IdempotencyKey.objects.create(
+                    key=key, fingerprint=request_fingerprint, status_code=status_code, response=data,
+                )
+    except IntegrityError:
+        # A concurrent request with the same key committed first; our effects
+        # were rolled back with the insert, so answer with its response.
+        stored = _lookup(key, request_fingerprint)
+        if stored is None:
+            raise
+        return (*stored, True)
+    return status_code, data, False
+
+
+def idempotent(method):
+    """
+    Make a DRF view method honour the ``Idempotency-Key`` header.
+
+    Requests without the header are handled as before.
+    """
+    @functools.wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return method(view, request, *args, **kwargs)
+
+        responses = []
+
+        def operation():
+            response = method(view, request, *args, **kwargs)
+            responses.append(response)
+            return response.status_code, response.data
+
+        try:
+            status_code, data, replayed = run_idempotent(
+                key, fingerprint(request.method, request.path, request.data), operation,
+            )
+        except IdempotencyError as exc:
+            return Response({"error": str(exc)}, status=exc.status_code)
+        if replayed:
+            return Response(data, status=status_code, headers={REPLAY_HEADER: 'true'})
+        return responses[0]
+
+    return wrapper
+
+
+def prune_idempotency_keys(now=None, batch_size=1000):
+    """
+    Delete stored responses older than ``INVOICING_IDEMPOTENCY_TTL``.
+
+    Returns:
+        int: The number of keys deleted.
+    """
+    cutoff = (now or timezone.now()) - _ttl()
+    deleted = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(created_at__lte=cutoff)
+            .order_by('created_at').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,230 @@
+import csv
+import json
+import time
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import bump_catalogue_version_on_commit
+from .checkout import (
+    CheckoutError, InsufficientStock, UnknownItem, adjust_stock, build_lines, line_sales, normalize_lines,
+)
+from .models import DailyItemSales, Item, Purchase, PurchaseItem
+
+
+class ImportReport:
+    """
+    Outcome of a bulk import: created purchases and per-record failures.
+
+    Records are identified by their key: the line number for NDJSON input or
+    the ``order`` column for CSV input.
+    """
+
+    def __init__(self):
+        self.created = []
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def succeed(self, key, purchase_id):
+        self.created.append({"record": key, "purchase_id": purchase_id})
+
+    def fail(self, key, error):
+        self.errors.append({"record": key, "error": str(error)})
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    @property
+    def rate(self):
+        """Purchases created per second."""
+        return len(self.created) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "created": self.created,
+            "errors": self.errors,
+            "elapsed": round(self.elapsed, 3),
+            "orders_per_second": round(self.rate, 1),
+        }
+
+
+def parse_ndjson(lines):
+    """
+    Read purchases from newline-delimited JSON.
+
+    Each non-blank line is an object with an ``items`` list in the same
+    format as ``POST /api/purchase/``.
+
+    Yields:
+        tuple: ``(line number, quantities or CheckoutError)``.
+    """
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError
+        except ValueError:
+            yield number, CheckoutError("Record is not a JSON object")
+            continue
+        try:
+            yield number, normalize_lines(record.get('items'))
+        except CheckoutError as exc:
+            yield number, exc
+
+
+def _csv_int(value):
+    # CSV cells are strings; anything that is not an integer is passed on
+    # for normalize_lines to reject.
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def parse_csv(lines):
+    """
+    Read purchases from CSV with an ``order,item,quantity`` header.
+
+    Consecutive rows sharing an ``order`` value form one purchase.
+
+    Yields:
+        tuple: ``(order, quantities or CheckoutError)``.
+    """
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames or not {'order', 'item', 'quantity'} <= set(reader.fieldnames):
+        yield None, CheckoutError("CSV needs an 'order,item,quantity' header")
+        return
+
+    def flush(order, rows):
+        try:
+            return order, normalize_lines(rows)
+        except CheckoutError as exc:
+            return order, exc
+
+    order, rows = None, []
+    for row in reader:
+        if rows and row['order'] != order:
+            yield flush(order, rows)
+            rows = []
+        order = row['order']
+        rows.append({"id": _csv_int(row['item']), "quantity": _csv_int(row['quantity'])})
+    if rows:
+        yield flush(order, rows)
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _import_chunk(chunk, report):
+    # Returns False when stock changed under us and the chunk should be retried.
+    item_ids = set()
+    for _, quantities in chunk:
+        item_ids.update(quantities)
+
+    with transaction.atomic():
+        # One query resolves every item referenced by the chunk
+        items = Item.objects.in_bulk(list(item_ids))
+        available = {item_id: item.stock for item_id, item in items.items()}
+
+        # Allocate stock record by record in memory, so that a record that
+        # does not fit fails on its own without touching the others.
+        accepted, failed, purchases = [], [], []
+        for key, quantities in chunk:
+            try:
+                for item_id, quantity in quantities.items():
+                    if item_id not in items:
+                        raise UnknownItem(item_id)
+                    if available[item_id] < quantity:
+                        raise InsufficientStock(items[item_id])
+            except CheckoutError as exc:
+                failed.append((key, exc))
+                continue
+            for item_id, quantity in quantities.items():
+                available[item_id] -= quantity
+            accepted.append((key, quantities))
+
+        if accepted:
+            taken = Counter()
+            for _, quantities in accepted:
+                taken.update(quantities)
+            try:
+                adjust_stock(items, taken)
+            except InsufficientStock:
+                transaction.set_rollback(True)
+                return False
+            bump_catalogue_version_on_commit()
+
+            lines = []
+            for _, quantities in accepted:
+                purchase_lines = build_lines(items, quantities)
+                purchase = Purchase()
+                purchase.set_totals(purchase_lines)
+                purchases.append(purchase)
+                lines.append(purchase_lines)
+            Purchase.objects.bulk_create(purchases)
+            for purchase, purchase_lines in zip(purchases, lines):
+                for line in purchase_lines:
+                    line.purchase = purchase
+            PurchaseItem.objects.bulk_create([line for purchase_lines in lines for line in purchase_lines])
+
+            # One rollup update per day in the chunk (almost always just one)
+            by_day = {}
+            for purchase, purchase_lines in zip(purchases, lines):
+                by_day.setdefault(timezone.localdate(purchase.created_at), []).extend(purchase_lines)
+            for day, day_lines in by_day.items():
+                DailyItemSales.objects.record(day, line_sales(day_lines))
+
+    for key, exc in failed:
+        report.fail(key, exc)
+    for (key, _), purchase in zip(accepted, purchases):
+        report.succeed(key, purchase.id)
+    return True
+
+
+def import_purchases(records, chunk_size=500):
+    """
+    Create purchases in bulk from parsed records.
+
+    Records are processed in chunks. Each chunk resolves its items with one
+    query, allocates stock, and inserts its purchases and lines with one bulk
+    insert each, all in its own transaction. A record that is malformed,
+    references a missing item or asks for more stock than is left fails on
+    its own; the rest of the chunk and batch still go through.
+
+    Args:
+        records: ``(key, quantities or CheckoutError)`` pairs, as yielded by
+            parse_ndjson or parse_csv.
+        chunk_size: Records per transaction.
+
+    Returns:
+        ImportReport: Created purchase ids and failures per record.
+    """
+    report = ImportReport()
+    for chunk in _chunks(records, chunk_size):
+        valid = []
+        for key, payload in chunk:
+            if isinstance(payload, CheckoutError):
+                report.fail(key, payload)
+            else:
+                valid.append((key, payload))
+        if not valid:
+            continue
+        # A concurrent checkout can take stock between the read and the
+        # guarded update; re-read and try again before giving up on the chunk.
+        if not _import_chunk(valid, report) and not _import_chunk(valid, report):
+            for key, _ in valid:
+                report.fail(key, "Stock changed during import, retry this record")
+    return report.finish()
@@ -0,0 +1,307 @@
+"""
+Per-request instrumentation: SQL, serializer and PDF render timings.
+
+InstrumentationMiddleware opens a RequestMetrics for every request. Code on
+the hot paths reports into it with ``timed('<phase>')``, and every SQL
+statement is counted and timed by a wrapper installed on each new database
+connection. Results go out in a ``Server-Timing`` response header and are
+aggregated into the process-wide ``registry``, which ``/api/metrics/``
+exposes in the Prometheus text format.
+
+A fraction of requests (``INVOICING_PROFILE_SAMPLE_RATE``) can also be run
+under cProfile, with the stats dumped to ``INVOICING_PROFILE_DIR``.
+"""
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+_current = contextvars.ContextVar('invoicing_request_metrics', default=None)
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    """Timings collected while handling one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.phases = {}
+
+    def add_phase(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def server_timing(self, total):
+        """Format the collected timings as a ``Server-Timing`` header value."""
+        parts = [f'db;dur={self.sql_time * 1000:.2f};desc="{self.sql_count} queries"']
+        parts.extend(f'{name};dur={elapsed * 1000:.2f}' for name, elapsed in self.phases.items())
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts)
+
+
+def current_metrics():
+    """The RequestMetrics of the request being handled, or None."""
+    return _current.get()
+
+
+@contextmanager
+def timed(phase):
+    """
+    Time a block and add it to the current request's ``phase`` timing.
+
+    Does nothing outside an instrumented request (management commands,
+    worker processes), so it is safe to leave on shared code paths.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_phase(phase, time.perf_counter() - started)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting and timing every statement.
+
+    Installed on each connection as it is opened (see install_query_wrapper);
+    the request's metrics are found through a context variable, which also
+    reaches ORM calls made from ``sync_to_async`` threads.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.sql_count += 1
+        metrics.sql_time += time.perf_counter() - started
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    # connection_created receiver
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms in the Prometheus data model.
+
+    Every worker process keeps its own registry; scrape each of them (or
+    sum them in the query) when running several.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, count, total = self._histograms.get(key, ([0] * len(self.buckets), 0, 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets[index] += 1
+            self._histograms[key] = (buckets, count + 1, total + value)
+
+    def value(self, name, **labels):
+        """Current value of a counter (0 if never incremented)."""
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+            described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            for bound, bucket in zip(self.buckets, buckets):
+                lines.append(f'{name}_bucket{label_text(labels, [("le", bound)])} {bucket}')
+            lines.append(f'{name}_bucket{label_text(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{label_text(labels)} {total}')
+            lines.append(f'{name}_count{label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+registry.describe('invoicing_requests_total', 'counter', 'Requests handled, by view, method and status.')
+registry.describe('invoicing_request_duration_seconds', 'histogram', 'Request handling time, by view.')
+registry.describe('invoicing_sql_queries_total', 'counter', 'SQL statements executed, by view.')
+registry.describe('invoicing_sql_seconds_total', 'counter', 'Time spent in SQL statements, by view.')
+registry.describe('invoicing_phase_seconds_total', 'counter', 'Time spent in instrumented phases, by view and phase.')
+registry.describe('invoicing_response_bytes_total', 'counter', 'Response body bytes sent, by view.')
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+def _count_streamed(response, labels):
+    # Count streamed bytes as they go out; the total is only known at the end.
+    if response.is_async:
+        content = response.streaming_content
+
+        async def counted():
+            size = 0
+            try:
+                async for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                registry.inc('invoicing_response_bytes_total', labels, size)
+    else:
+        content = response.streaming_content
+
+        def counted():
+            size = 0
+            try:
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                registry.inc('invoicing_response_bytes_total', labels, size)
+    response.streaming_content = counted()
+
+
+def _should_profile():
+    rate = getattr(settings, 'INVOICING_PROFILE_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def _dump_profile(profiler, request):
+    directory = settings.INVOICING_PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = _view_name(request).replace('/', '_').replace(':', '_') or 'request'
+    path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{name}-{os.getpid()}-{time.perf_counter_ns()}.prof')
+    profiler.dump_stats(path)
+    return path
+
+
+class InstrumentationMiddleware:
+    """
+    Measure every request and report it in ``Server-Timing`` and the
+    metrics registry.
+
+    Supports both sync and async views without switching threads. cProfile
+    sampling only applies to sync requests: a profiler on the event loop
+    would also record every other request interleaved with this one.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        profiler = cProfile.Profile() if _should_profile() else None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        finally:
+            _current.reset(token)
+        if profiler is not None:
+            _dump_profile(profiler, request)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        response['Server-Timing'] = metrics.server_timing(total)
+
+        view = _view_name(request)
+        labels = {'view': view}
+        registry.inc('invoicing_requests_total', {
+            'view': view, 'method': request.method, 'status': str(response.status_code),
+        })
+        registry.observe('invoicing_request_duration_seconds', labels, total)
+        registry.inc('invoicing_sql_queries_total', labels, metrics.sql_count)
+        registry.inc('invoicing_sql_seconds_total', labels, metrics.sql_time)
+        for phase, elapsed in metrics.phases.items():
+            registry.inc('invoicing_phase_seconds_total', {'view': view, 'phase': phase}, elapsed)
+
+        if not response.streaming:
+            registry.inc('invoicing_response_bytes_total', labels, len(response.content))
+        elif response.has_header('Content-Length'):
+            registry.inc('invoicing_response_bytes_total', labels, int(response['Content-Length']))
+        else:
+            _count_streamed(response, labels)
+        return response
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+from django.conf import settings
+
+from .archive import aget_purchase, get_purchase
+from .instrumentation import timed
+from .layout import DEFAULT_TEMPLATE
+from .models import Purchase
+from .snapshot import catalogue_snapshot
+
+# Bump whenever render_invoice changes what it draws, so PDFs rendered with
+# the old layout stop matching and get re-rendered.
+INVOICE_TEMPLATE_VERSION = 2
+
+
+def invoice_rows(lines):
+    """
+    Flatten purchase lines into the plain rows render_invoice draws.
+
+    Args:
+        lines: PurchaseItem instances with ``item`` already loaded.
+
+    Returns:
+        list: ``(name, price, quantity)`` tuples. Unlike model instances these
+        are cheap to pickle, so they can be shipped to worker processes.
+    """
+    return [(line.item.name, line.unit_price, line.quantity) for line in lines]
+
+
+def invoice_purchase(purchase_id):
+    """
+    Load a purchase and its lines, with their items, for its invoice.
+
+    When a catalogue snapshot is published the lines are read without
+    joining their items, which come from the snapshot instead. Archived
+    purchases are found too.
+
+    Returns:
+        tuple: ``(purchase, lines)``.
+
+    Raises:
+        Purchase.DoesNotExist: If there is no such purchase.
+    """
+    snapshot = catalogue_snapshot()
+    purchase = get_purchase(Purchase.objects.with_lines(items=snapshot is None), purchase_id)
+    lines = list(purchase.purchaseitem_set.all())
+    if snapshot is not None:
+        snapshot.attach_items(lines)
+    return purchase, lines
+
+
+async def ainvoice_purchase(purchase_id):
+    """Async variant of invoice_purchase, reading through the async ORM."""
+    snapshot = catalogue_snapshot()
+    purchase = await aget_purchase(Purchase.objects.with_lines(items=snapshot is None), purchase_id)
+    lines = list(purchase.purchaseitem_set.all())
+    if snapshot is not None:
+        await snapshot.aattach_items(lines)
+    return purchase, lines
+
+
+def render_invoice(rows, total=None):
+    """
+    Draw the invoice PDF for a purchase.
+
+    Args:
+        rows: ``(name, price, quantity)`` tuples, see invoice_rows.
+        total: The purchase's stored total; summed from ``rows`` if omitted.
+
+    Returns:
+        bytes: The rendered PDF document, paginated by the default template.
+    """
+    with timed('render'):
+        return DEFAULT_TEMPLATE.render(rows, total)
+
+
+def invoice_digest(purchase, lines):
+    """
+    Hash everything that ends up on the rendered invoice.
+
+    Two renders with the same digest produce the same PDF, so the digest
+    serves both as the cache key and as the HTTP ``ETag``.
+    """
+    digest = hashlib.sha256(f"template:{INVOICE_TEMPLATE_VERSION}\ntotal:{purchase.total}\n".encode())
+    for line in lines:
+        digest.update(f"{line.item_id}\t{line.item.name}\t{line.unit_price}\t{line.quantity}\n".encode())
+    return digest.hexdigest()
+
+
+class InvoiceStore:
+    """
+    Rendered invoice PDFs persisted on local disk.
+
+    Files live at ``<root>/<purchase id>/<digest>.pdf`` so that all renders of
+    one purchase can be dropped together when its lines are rewritten.
+    """
+
+    def __init__(self, root=None):
+        self.root = Path(root or settings.INVOICING_INVOICE_CACHE_DIR)
+
+    def path(self, purchase_id, digest):
+        return self.root / str(purchase_id) / f"{digest}.pdf"
+
+    def put(self, purchase_id, digest, pdf):
+        """
+        Store a rendered PDF and return its path.
+
+        The file is written under a temporary name and renamed into place so
+        concurrent readers never see a partial document.
+        """
+        path = self.path(purchase_id, digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(pdf)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def invalidate(self, purchase_id):
+        """Drop every cached render of a purchase."""
+        shutil.rmtree(self.root / str(purchase_id), ignore_errors=True)
+
+    def ensure(self, purchase, lines):
+        """
+        Make sure a PDF matching the lines is stored and return its path.
+        """
+        digest = invoice_digest(purchase, lines)
+        path = self.path(purchase.id, digest)
+        if not path.exists():
+            self.put(purchase.id, digest, render_invoice(invoice_rows(lines), purchase.total))
+        return path
+
+    def open(self, purchase, lines):
+        """
+        Open the purchase's invoice, rendering it only if no PDF with matching
+        content is cached.
+
+        Returns:
+            tuple: ``(file, digest, last_modified)`` where ``file`` is a binary
+            file object positioned at the start of the PDF and
+            ``last_modified`` is a POSIX timestamp.
+        """
+        digest = invoice_digest(purchase, lines)
+        path = self.path(purchase.id, digest)
+        try:
+            file = path.open('rb')
+        except FileNotFoundError:
+            pass
+        else:
+            return file, digest, os.fstat(file.fileno()).st_mtime
+
+        pdf = render_invoice(invoice_rows(lines), purchase.total)
+        self.put(purchase.id, digest, pdf)
+        # Serve from memory; the stored copy could be invalidated before we
+        # get to reopen it.
+        return BytesIO(pdf), digest, time.time()
@@ -0,0 +1,111 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from .invoices import InvoiceStore, invoice_purchase
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class RenderJob:
+    """
+    One background render of a purchase's invoice.
+    """
+
+    def __init__(self, purchase_id):
+        self.id = uuid.uuid4().hex
+        self.purchase_id = purchase_id
+        self.status = QUEUED
+        self.path = None
+        self.error = None
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout=None):
+        """Block until the job has finished (mainly for tests and commands)."""
+        self.future.result(timeout)
+        return self
+
+
+class InvoiceRenderQueue:
+    """
+    Renders invoices on a local thread pool, outside the request thread.
+
+    Requests for a purchase that already has a queued or running job get that
+    job back instead of a new one. Job state is kept in memory, so status
+    lookups must reach the same process that accepted the job; finished jobs
+    are forgotten once more than ``history`` newer ones exist.
+    """
+
+    def __init__(self, max_workers=None, history=None):
+        self.max_workers = max_workers or getattr(settings, 'INVOICING_RENDER_WORKERS', 2)
+        self.history = history or getattr(settings, 'INVOICING_RENDER_JOB_HISTORY', 1000)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='invoice-render'
+            )
+        return self._executor
+
+    def submit(self, purchase_id):
+        """
+        Queue a render of the purchase's invoice.
+
+        Returns:
+            tuple: ``(job, created)`` where ``created`` is False when an
+            in-flight job for the same purchase was reused.
+        """
+        with self._lock:
+            job_id = self._in_flight.get(purchase_id)
+            if job_id is not None:
+                return self._jobs[job_id], False
+
+            job = RenderJob(purchase_id)
+            self._jobs[job.id] = job
+            self._in_flight[purchase_id] = job.id
+            self._prune()
+            job.future = self._get_executor().submit(self._run, job)
+            return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        job.status = RUNNING
+        close_old_connections()
+        try:
+            purchase, lines = invoice_purchase(job.purchase_id)
+            job.path = InvoiceStore().ensure(purchase, lines)
+            job.status = DONE
+        except Exception as exc:
+            job.error = str(exc)
+            job.status = FAILED
+        finally:
+            # Worker threads outlive requests, so release their connection here
+            connection.close()
+            with self._lock:
+                self._in_flight.pop(job.purchase_id, None)
+
+
+render_queue = InvoiceRenderQueue()
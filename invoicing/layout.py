@@ -0,0 +1,109 @@
+from io import BytesIO
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+
+class InvoiceTemplate:
+    """
+    Page layout of the invoice PDF.
+
+    The geometry (how many lines fit on a page, where each section goes) is
+    worked out once when the template is built, and reused for every
+    document. Static page furniture (the header and footer rule) is drawn
+    into form XObjects once per document and then placed on each page by
+    reference instead of being redrawn.
+
+    Each page holds a slice of the line table; the totals follow the last
+    line, on a page of their own if they do not fit.
+    """
+    HEADER_FORM = 'invoice-header'
+    FOOTER_FORM = 'invoice-footer'
+
+    def __init__(self, page_size=A4, left=100, title_y=800, first_line_y=750,
+                 line_height=20, bottom=60, footer_y=30):
+        self.page_size = page_size
+        self.left = left
+        self.title_y = title_y
+        self.first_line_y = first_line_y
+        self.line_height = line_height
+        self.footer_y = footer_y
+        # Number of line slots between the first line and the bottom margin
+        self.lines_per_page = int((first_line_y - bottom) // line_height) + 1
+
+    def paginate(self, rows):
+        """
+        Split rows into pages.
+
+        Returns:
+            list: One list of rows per page. The totals need two free slots
+            (a blank line and the total) after the last row; when the last
+            page is too full an empty trailing page is added for them.
+        """
+        per_page = self.lines_per_page
+        pages = [rows[start:start + per_page] for start in range(0, len(rows), per_page)] or [[]]
+        if per_page - len(pages[-1]) < 2:
+            pages.append([])
+        return pages
+
+    def draw_furniture(self, pdf):
+        # Define the static parts of the page once for the whole document.
+        width = self.page_size[0]
+
+        pdf.beginForm(self.HEADER_FORM)
+        pdf.drawString(self.left, self.title_y, "Invoice")
+        pdf.line(self.left, self.title_y - 10, width - self.left, self.title_y - 10)
+        pdf.endForm()
+
+        pdf.beginForm(self.FOOTER_FORM)
+        pdf.line(self.left, self.footer_y + 15, width - self.left, self.footer_y + 15)
+        pdf.endForm()
+
+    def draw_lines(self, pdf, rows):
+        # One text object per page keeps the content stream to a single
+        # BT/ET block however many lines the page holds.
+        text = pdf.beginText(self.left, self.first_line_y)
+        text.setLeading(self.line_height)
+        for name, price, quantity in rows:
+            text.textLine(f"{name} x {quantity} @ {price}")
+        pdf.drawText(text)
+
+    def draw_totals(self, pdf, lines_on_page, total):
+        y = self.first_line_y - lines_on_page * self.line_height
+        if lines_on_page:
+            # Leave a blank line between the last row and the total
+            y -= self.line_height
+        pdf.drawString(self.left, y, f"Total: {total}")
+
+    def render(self, rows, total=None):
+        """
+        Draw the invoice for ``rows`` of ``(name, price, quantity)``.
+
+        ``total`` is printed as given; when omitted it is summed from the rows.
+
+        Returns:
+            bytes: The rendered PDF document.
+        """
+        buffer = BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=self.page_size)
+        self.draw_furniture(pdf)
+
+        pages = self.paginate(rows)
+        if total is None:
+            total = sum([price * quantity for _, price, quantity in rows])
+        for number, page_rows in enumerate(pages, start=1):
+            pdf.doForm(self.HEADER_FORM)
+            pdf.doForm(self.FOOTER_FORM)
+            if page_rows:
+                self.draw_lines(pdf, page_rows)
+            if number == len(pages):
+                self.draw_totals(pdf, len(page_rows), total)
+            pdf.drawRightString(self.page_size[0] - self.left, self.footer_y, f"Page {number} of {len(pages)}")
+            pdf.showPage()
+
+        pdf.save()
+        return buffer.getvalue()
+
+
+# Shared, precomputed template used by render_invoice
+DEFAULT_TEMPLATE = InvoiceTemplate()
@@ -0,0 +1,54 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from invoicing.archive import archive_purchases
+
+
+class Command(BaseCommand):
+    help = (
+        "Move purchases created before a cutoff day, with their lines, into per-month archive "
+        "tables. Archived purchases stay readable through the purchase detail and invoice endpoints."
+    )
+
+    def add_arguments(self, parser):
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument('--before', help="Archive purchases created before this day (YYYY-MM-DD).")
+        cutoff.add_argument('--older-than-days', type=int, help="Archive purchases older than this many days.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Purchases per transaction.")
+        parser.add_argument(
+            '--vacuum', action='store_true',
+            help="Compact the SQLite database afterwards, returning the freed pages.",
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if options['before']:
+            try:
+                before = parse_date(options['before'])
+            except ValueError:
+                before = None
+            if before is None:
+                raise CommandError(f"'{options['before']}' is not a date in YYYY-MM-DD format")
+        else:
+            if options['older_than_days'] < 1:
+                raise CommandError("--older-than-days must be at least 1")
+            before = timezone.localdate() - datetime.timedelta(days=options['older_than_days'])
+        if options['vacuum'] and connection.vendor != 'sqlite':
+            raise CommandError("--vacuum is only supported on SQLite")
+
+        started = time.perf_counter()
+        archived = archive_purchases(before, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} purchases created before {before} in {time.perf_counter() - started:.2f}s"
+        ))
+        if options['vacuum'] and archived:
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+                cursor.execute('PRAGMA optimize')
+            self.stdout.write("Database compacted")
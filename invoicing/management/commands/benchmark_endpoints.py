@@ -0,0 +1,102 @@
+import json
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.benchmark import SCENARIOS, compare_to_baseline, run_benchmark, scratch_environment, seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch database and measure latency, throughput, queries per request and "
+        "peak memory of the invoicing endpoints, optionally against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000, help="Items to seed (default: 10000).")
+        parser.add_argument('--purchases', type=int, default=100000, help="Purchases to seed (default: 100000).")
+        parser.add_argument('--requests', type=int, default=200, help="Requests per scenario and concurrency level.")
+        parser.add_argument(
+            '--concurrency', type=int, nargs='+', default=[1, 8],
+            help="Concurrent clients to run each scenario with (default: 1 8).",
+        )
+        parser.add_argument(
+            '--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+            help="Scenarios to run (default: all).",
+        )
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for request generation.")
+        parser.add_argument('--baseline', help="Compare against this JSON report; regressions fail the run.")
+        parser.add_argument('--save-baseline', help="Write this run's report to this JSON file.")
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help="Allowed latency/memory growth over the baseline, as a fraction (default: 0.25).",
+        )
+
+    def handle(self, *args, **options):
+        if options['items'] < 1 or options['purchases'] < 1 or options['requests'] < 1:
+            raise CommandError("--items, --purchases and --requests must be at least 1")
+        if min(options['concurrency']) < 1:
+            raise CommandError("--concurrency must be at least 1")
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline'], encoding='utf-8') as source:
+                    baseline = json.load(source)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Cannot read baseline: {exc}")
+
+        with tempfile.TemporaryDirectory() as scratch:
+            report = self.run_in_scratch_database(scratch, options)
+
+        self.write_report(report)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+
+        if baseline is not None:
+            regressions = compare_to_baseline(report, baseline, tolerance=options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f"{len(regressions)} performance regression(s) against the baseline")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def run_in_scratch_database(self, scratch, options):
+        with scratch_environment(scratch):
+            started = time.perf_counter()
+            item_ids, purchase_ids = seed(options['items'], options['purchases'])
+            self.stdout.write(
+                f"Seeded {len(item_ids)} items and {len(purchase_ids)} purchases "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+            report = run_benchmark(
+                item_ids, purchase_ids,
+                scenarios=options['scenarios'],
+                requests=options['requests'],
+                concurrency=options['concurrency'],
+                seed_value=options['seed'],
+            )
+        report["volumes"] = {"items": options['items'], "purchases": options['purchases']}
+        return report
+
+    def write_report(self, report):
+        self.stdout.write(
+            f"{'scenario':<24} {'reqs':>6} {'errs':>5} {'req/s':>8} {'p50 ms':>9} "
+            f"{'p95 ms':>9} {'p99 ms':>9} {'q/req':>6} {'q max':>6}"
+        )
+        for key, row in report["scenarios"].items():
+            self.stdout.write(
+                f"{key:<24} {row['requests']:>6} {row['errors']:>5} {row['throughput']:>8.1f} "
+                f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+                f"{row['queries_mean']:>6.1f} {row['queries_max']:>6}"
+            )
+        serialization = report["serialization"]
+        self.stdout.write(
+            f"Item page serialization ({serialization['rows']} rows): "
+            f"ModelSerializer {serialization['model_serializer_ms']:.2f} ms, "
+            f"values() rows {serialization['values_rows_ms']:.2f} ms"
+        )
+        self.stdout.write(f"Peak RSS: {report['peak_rss_kib'] / 1024:.1f} MiB")
@@ -0,0 +1,33 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from invoicing.layout import DEFAULT_TEMPLATE
+
+
+class Command(BaseCommand):
+    help = "Time invoice rendering for increasing line counts to check it scales linearly."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', type=int, nargs='+', default=[10, 100, 1000],
+            help="Line counts to render (default: 10 100 1000).",
+        )
+        parser.add_argument('--repeat', type=int, default=5, help="Renders per line count; the best is kept.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'lines':>8} {'pages':>6} {'best ms':>10} {'us/line':>10} {'KiB':>8}")
+        for count in options['lines']:
+            rows = [(f"Item {i}", Decimal("19.99"), i % 7 + 1) for i in range(count)]
+            best = None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                pdf = DEFAULT_TEMPLATE.render(rows)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            pages = len(DEFAULT_TEMPLATE.paginate(rows))
+            self.stdout.write(
+                f"{count:>8} {pages:>6} {best * 1000:>10.2f} "
+                f"{best * 1e6 / max(count, 1):>10.1f} {len(pdf) / 1024:>8.1f}"
+            )
@@ -0,0 +1,49 @@
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from invoicing.benchmark import run_scenario, scratch_environment, seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure checkout throughput with many parallel writers under each SQLite profile "
+        "in INVOICING_SQLITE_PROFILES, each on its own scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', nargs='+', choices=sorted(settings.INVOICING_SQLITE_PROFILES),
+            default=sorted(settings.INVOICING_SQLITE_PROFILES),
+            help="Profiles to compare (default: all).",
+        )
+        parser.add_argument('--writers', type=int, default=16, help="Concurrent checkout clients (default: 16).")
+        parser.add_argument('--requests', type=int, default=800, help="Checkouts per profile (default: 800).")
+        parser.add_argument('--items', type=int, default=1000, help="Items to seed (default: 1000).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for request generation.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The default database is not SQLite")
+        if options['writers'] < 1 or options['requests'] < 1 or options['items'] < 1:
+            raise CommandError("--writers, --requests and --items must be at least 1")
+
+        self.stdout.write(
+            f"{'profile':<14} {'writers':>7} {'reqs':>6} {'errs':>5} {'req/s':>8} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        )
+        for profile in options['profiles']:
+            with tempfile.TemporaryDirectory() as scratch:
+                with scratch_environment(scratch, settings.INVOICING_SQLITE_PROFILES[profile]):
+                    item_ids, purchase_ids = seed(options['items'], 1)
+                    result = run_scenario(
+                        'create_purchase', options['requests'], options['writers'],
+                        item_ids, purchase_ids, options['seed'],
+                    )
+            row = result.summary()
+            self.stdout.write(
+                f"{profile:<14} {options['writers']:>7} {row['requests']:>6} {row['errors']:>5} "
+                f"{row['throughput']:>8.1f} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}"
+            )
@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.snapshot import build_snapshot, compact_snapshot
+
+
+class Command(BaseCommand):
+    help = "Write the memory-mapped catalogue snapshot from the database (INVOICING_CATALOGUE_SNAPSHOT)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--compact', action='store_true',
+            help="Merge the overlay of changed items into the snapshot instead of reading the database.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.INVOICING_CATALOGUE_SNAPSHOT:
+            raise CommandError("Set INVOICING_CATALOGUE_SNAPSHOT to the snapshot's path first")
+        started = time.perf_counter()
+        if options['compact']:
+            merged = compact_snapshot()
+            self.stdout.write(self.style.SUCCESS(
+                f"Merged {merged} changed items into {settings.INVOICING_CATALOGUE_SNAPSHOT} "
+                f"in {time.perf_counter() - started:.2f}s"
+            ))
+            return
+        count = build_snapshot()
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {count} items to {settings.INVOICING_CATALOGUE_SNAPSHOT} in {time.perf_counter() - started:.2f}s"
+        ))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.reservations import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Expire stock reservations whose hold has run out and return their stock."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Reservations per transaction.")
+        parser.add_argument(
+            '--every', type=float, default=None,
+            help="Keep running, sweeping every this many seconds (default: sweep once and exit).",
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if options['every'] is not None and options['every'] <= 0:
+            raise CommandError("--every must be positive")
+
+        while True:
+            expired = expire_reservations(batch_size=options['batch_size'])
+            if expired or options['every'] is None:
+                self.stdout.write(f"Expired {expired} reservations")
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
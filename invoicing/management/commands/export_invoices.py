@@ -0,0 +1,63 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.export import (
+    ExportQueryError, export_queryset, export_workers, parse_ids, render_invoices, stream_zip,
+)
+
+
+class Command(BaseCommand):
+    help = "Render the invoices of many purchases into one ZIP archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the ZIP file to write.")
+        parser.add_argument('--start', help="First purchase day to include (YYYY-MM-DD).")
+        parser.add_argument('--end', help="Last purchase day to include (YYYY-MM-DD).")
+        parser.add_argument('--ids', default='', help="Comma-separated purchase ids.")
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help="Render processes (default: INVOICING_EXPORT_WORKERS or one per core; 0 renders inline).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            purchases = export_queryset(options['start'], options['end'], parse_ids(options['ids']))
+        except ExportQueryError as exc:
+            raise CommandError(str(exc))
+
+        workers = options['workers']
+        if workers is None:
+            workers = export_workers()
+
+        count = 0
+        started = time.perf_counter()
+        executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+        try:
+            rendered = render_invoices(purchases, executor, window=2 * max(workers, 1))
+
+            def counted():
+                nonlocal count
+                for purchase_id, pdf in rendered:
+                    count += 1
+                    yield purchase_id, pdf
+
+            with open(options['output'], 'wb') as output:
+                for chunk in stream_zip(counted()):
+                    output.write(chunk)
+        except BaseException:
+            if os.path.exists(options['output']):
+                os.unlink(options['output'])
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {count} invoices to {options['output']} in {elapsed:.2f}s "
+            f"({rate:.1f} invoices/s, {workers or 'no'} worker processes)"
+        ))
@@ -0,0 +1,41 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.ingest import import_purchases, parse_csv, parse_ndjson
+
+
+class Command(BaseCommand):
+    help = "Import purchases in bulk from an NDJSON or CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or '-' for standard input.")
+        parser.add_argument(
+            '--format', choices=['ndjson', 'csv'],
+            help="Input format (default: from the file extension, NDJSON otherwise).",
+        )
+        parser.add_argument('--chunk-size', type=int, default=500, help="Records per transaction.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        parse = parse_csv if fmt == 'csv' else parse_ndjson
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        if path == '-':
+            report = import_purchases(parse(sys.stdin), chunk_size=options['chunk_size'])
+        else:
+            try:
+                source = open(path, encoding='utf-8', newline='')
+            except OSError as exc:
+                raise CommandError(str(exc))
+            with source:
+                report = import_purchases(parse(source), chunk_size=options['chunk_size'])
+
+        for error in report.errors:
+            self.stderr.write(f"record {error['record']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {len(report.created)} purchases, {len(report.errors)} failed, "
+            f"in {report.elapsed:.2f}s ({report.rate:.1f} orders/s)"
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from invoicing.idempotency import prune_idempotency_keys
+
+
+class Command(BaseCommand):
+    help = "Delete stored Idempotency-Key responses older than INVOICING_IDEMPOTENCY_TTL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Keys deleted per statement.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        deleted = prune_idempotency_keys(batch_size=options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} idempotency keys")
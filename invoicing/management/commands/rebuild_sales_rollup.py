@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from invoicing.models import DailyItemSales
+
+
+def _date(value):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise CommandError(f"'{value}' is not a date in YYYY-MM-DD format")
+    return day
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily per-item sales rollup from the purchase lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help="First day to rebuild (YYYY-MM-DD); default: the beginning.")
+        parser.add_argument('--end', help="Last day to rebuild (YYYY-MM-DD), inclusive; default: the end.")
+
+    def handle(self, *args, **options):
+        start = _date(options['start']) if options['start'] else None
+        end = _date(options['end']) if options['end'] else None
+        if start and end and start > end:
+            raise CommandError("--start must not be after --end")
+
+        started = time.perf_counter()
+        written = DailyItemSales.objects.rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {written} rollup rows in {time.perf_counter() - started:.2f}s"
+        ))
@@ -0,0 +1,71 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def backfill_snapshots(apps, schema_editor):
+    # Existing lines take the item's current price as their snapshot; that is
+    # what their invoices have shown so far.
+    PurchaseItem = apps.get_model('invoicing', 'PurchaseItem')
+    Purchase = apps.get_model('invoicing', 'Purchase')
+
+    lines = PurchaseItem.objects.select_related('item').order_by('id')
+    batch = []
+    for line in lines.iterator(chunk_size=2000):
+        line.unit_price = line.item.price
+        line.line_total = line.item.price * line.quantity
+        batch.append(line)
+        if len(batch) >= 2000:
+            PurchaseItem.objects.bulk_update(batch, ['unit_price', 'line_total'])
+            batch = []
+    if batch:
+        PurchaseItem.objects.bulk_update(batch, ['unit_price', 'line_total'])
+
+    totals = (
+        PurchaseItem.objects.order_by().values('purchase')
+        .annotate(amount=models.Sum('line_total'), count=models.Count('id'))
+    )
+    for row in totals.iterator(chunk_size=2000):
+        Purchase.objects.filter(pk=row['purchase']).update(
+            subtotal=row['amount'] or Decimal('0'),
+            total=row['amount'] or Decimal('0'),
+            line_count=row['count'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0002_item_catalogue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='purchase',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='purchase',
+            name='line_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='purchaseitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='purchaseitem',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.3 on 2026-10-18 01:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollup(apps, schema_editor):
+    # Same aggregation as DailyItemSales.objects.rebuild(), which historical
+    # models do not have.
+    PurchaseItem = apps.get_model('invoicing', 'PurchaseItem')
+    DailyItemSales = apps.get_model('invoicing', 'DailyItemSales')
+
+    totals = (
+        PurchaseItem.objects.annotate(day=TruncDate('purchase__created_at'))
+        .values('day', 'item_id')
+        .annotate(units=models.Sum('quantity'), revenue=models.Sum('line_total'))
+        .order_by()
+    )
+    batch = []
+    for row in totals.iterator(chunk_size=2000):
+        batch.append(DailyItemSales(**row))
+        if len(batch) >= 2000:
+            DailyItemSales.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        DailyItemSales.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0003_purchase_totals_and_line_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyItemSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoicing.item')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'item'), name='daily_item_sales_day_item_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.3 on 2026-10-18 01:13
+
+from django.db import migrations, models
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # Older write paths could store the same item twice on a purchase. Fold
+    # each group into its first line so the unique constraint can be added;
+    # purchase totals and the sales rollup are sums and stay the same.
+    PurchaseItem = apps.get_model('invoicing', 'PurchaseItem')
+    Purchase = apps.get_model('invoicing', 'Purchase')
+
+    duplicates = (
+        PurchaseItem.objects.order_by().values('purchase_id', 'item_id')
+        .annotate(first=models.Min('id'), lines=models.Count('id'),
+                  quantity=models.Sum('quantity'), line_total=models.Sum('line_total'))
+        .filter(lines__gt=1)
+    )
+    purchase_ids = set()
+    for group in list(duplicates):
+        PurchaseItem.objects.filter(pk=group['first']).update(
+            quantity=group['quantity'], line_total=group['line_total'],
+        )
+        PurchaseItem.objects.filter(
+            purchase_id=group['purchase_id'], item_id=group['item_id'],
+        ).exclude(pk=group['first']).delete()
+        purchase_ids.add(group['purchase_id'])
+
+    for purchase_id in purchase_ids:
+        Purchase.objects.filter(pk=purchase_id).update(
+            line_count=PurchaseItem.objects.filter(purchase_id=purchase_id).count(),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0004_daily_item_sales'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['created_at'], name='purchase_created_at_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='purchaseitem',
+            constraint=models.UniqueConstraint(fields=('purchase', 'item'), name='purchase_item_uniq'),
+        ),
+    ]
@@ -1,20 +1,326 @@
-from django.db import models
+import datetime
+import uuid
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .params import on_days
 
 class Item(models.Model):
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField()
     stock = models.PositiveIntegerField(default=0)
+    # Units held by active reservations. Held units are already taken out of
+    # stock, so stock is always the quantity available to sell.
+    reserved = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Back the item list filters (name prefix, price range, in-stock)
+        indexes = [
+            models.Index(fields=['name'], name='item_name_idx'),
+            models.Index(fields=['price'], name='item_price_idx'),
+            models.Index(fields=['stock'], name='item_stock_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+class PurchaseQuerySet(models.QuerySet):
+    def with_lines(self, items=True):
+        """
+        Prefetch each purchase's lines together with their items.
+
+        Loads every line of every purchase in the queryset with one extra
+        query, so code that walks ``purchase.purchaseitem_set.all()`` and
+        touches ``line.item`` does not issue a query per purchase or per line.
+        Pass ``items=False`` to skip the join when the items are looked up
+        elsewhere (the catalogue snapshot).
+        """
+        lines = PurchaseItem.objects.order_by('id')
+        if items:
+            lines = lines.select_related('item')
+        return self.prefetch_related(models.Prefetch('purchaseitem_set', queryset=lines))
+
+    def update_totals(self):
+        """
+        Recompute the stored totals of every purchase in the queryset from
+        its lines, in a single UPDATE.
+        """
+        lines = PurchaseItem.objects.filter(purchase=models.OuterRef('pk')).order_by().values('purchase')
+        subtotal = Coalesce(
+            models.Subquery(lines.annotate(amount=models.Sum('line_total')).values('amount')),
+            models.Value(Decimal('0')),
+            output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        )
+        line_count = Coalesce(
+            models.Subquery(lines.annotate(count=models.Count('id')).values('count')),
+            models.Value(0),
+        )
+        return self.update(subtotal=subtotal, total=subtotal, line_count=line_count)
+
 class Purchase(models.Model):
     # Link items with purchases via a through model (PurchaseItem)
     items = models.ManyToManyField(Item, through='PurchaseItem')
     created_at = models.DateTimeField(auto_now_add=True) 
 
+    # Totals are computed when the lines are written, so reads never need to
+    # aggregate the lines. There are no taxes or discounts yet, so total is
+    # equal to subtotal.
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    line_count = models.PositiveIntegerField(default=0)
+
+    objects = PurchaseQuerySet.as_manager()
+
+    class Meta:
+        # Date range filters: exports, the admin's created_at filter
+        indexes = [
+            models.Index(fields=['created_at'], name='purchase_created_at_idx'),
+        ]
+
+    def set_totals(self, lines):
+        """
+        Set the totals from a complete list of the purchase's lines.
+
+        Does not save; used by write paths that create lines in bulk.
+        """
+        self.subtotal = sum((line.line_total for line in lines), Decimal('0'))
+        self.total = self.subtotal
+        self.line_count = len(lines)
+
 class PurchaseItem(models.Model):
     purchase = models.ForeignKey(Purchase, on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
+
+    # Price of the item when the line was written, so invoices do not change
+    # when the catalogue price does
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    line_total = models.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        # One line per item; quantities of a repeated item are merged
+        constraints = [
+            models.UniqueConstraint(fields=['purchase', 'item'], name='purchase_item_uniq'),
+        ]
+
+    def fill_snapshot(self):
+        # Capture the current item price unless one was given explicitly.
+        if self.unit_price is None:
+            self.unit_price = self.item.price
+        self.line_total = Decimal(self.unit_price) * self.quantity
+
+    def save(self, *args, **kwargs):
+        # Single-line writes (admin, shell) keep the purchase totals and the
+        # sales rollup in sync. Bulk write paths fill the snapshot, set the
+        # totals and record the sales themselves.
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = PurchaseItem.objects.filter(pk=self.pk).values(
+                    'item_id', 'quantity', 'unit_price', 'line_total',
+                ).first()
+            # A line moved to another item takes that item's price, unless a
+            # new price was given with it.
+            if previous is not None and previous['item_id'] != self.item_id and self.unit_price == previous['unit_price']:
+                self.unit_price = None
+            self.fill_snapshot()
+            super().save(*args, **kwargs)
+            Purchase.objects.filter(pk=self.purchase_id).update_totals()
+
+            day = timezone.localdate(self.purchase.created_at)
+            if previous is not None:
+                DailyItemSales.objects.record(day, {
+                    previous['item_id']: (-previous['quantity'], -previous['line_total']),
+                })
+            DailyItemSales.objects.record(day, {self.item_id: (self.quantity, self.line_total)})
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            Purchase.objects.filter(pk=self.purchase_id).update_totals()
+            DailyItemSales.objects.record(
+                timezone.localdate(self.purchase.created_at),
+                {self.item_id: (-self.quantity, -self.line_total)},
+            )
+        return result
+
+class DailyItemSalesQuerySet(models.QuerySet):
+    def record(self, day, sales):
+        """
+        Add sales to the rollup rows of one day.
+
+        Missing rows are inserted empty and every row is then incremented in
+        a single UPDATE, so concurrent writers never lose each other's sales.
+
+        Args:
+            day: The local date the sales belong to.
+            sales: ``(units, revenue)`` changes keyed by item id; negative
+                values take sales back out (an edited or removed line).
+        """
+        sales = {item_id: change for item_id, change in sales.items() if any(change)}
+        if not sales:
+            return
+
+        existing = set(self.filter(day=day, item_id__in=list(sales)).values_list('item_id', flat=True))
+        missing = [DailyItemSales(day=day, item_id=item_id) for item_id in sales if item_id not in existing]
+        if missing:
+            self.bulk_create(missing, ignore_conflicts=True)
+
+        units, revenue = [], []
+        for item_id, (unit_change, revenue_change) in sales.items():
+            units.append(models.When(item_id=item_id, then=models.F('units') + unit_change))
+            revenue.append(models.When(item_id=item_id, then=models.F('revenue') + revenue_change))
+        self.filter(day=day, item_id__in=list(sales)).update(
+            units=models.Case(*units, output_field=DailyItemSales._meta.get_field('units')),
+            revenue=models.Case(*revenue, output_field=DailyItemSales._meta.get_field('revenue')),
+        )
+
+    def rebuild(self, start=None, end=None, batch_size=1000):
+        """
+        Recompute the rollup from the purchase lines.
+
+        Days whose purchases were archived (see invoicing.archive) keep their
+        rollup rows, since their lines are no longer in the purchase tables;
+        the rebuild starts after the last of them.
+
+        Args:
+            start: First day to rebuild (a date), or None for no lower bound.
+            end: Last day to rebuild (a date), or None for no upper bound.
+            batch_size: Rollup rows per INSERT.
+
+        Returns:
+            int: The number of rollup rows written.
+        """
+        archived_through = ArchiveMonth.objects.aggregate(day=models.Max('through'))['day']
+        if archived_through is not None and (start is None or start <= archived_through):
+            start = archived_through + datetime.timedelta(days=1)
+
+        rollup = self
+        if start is not None:
+            rollup = rollup.filter(day__gte=start)
+        if end is not None:
+            rollup = rollup.filter(day__lte=end)
+        lines = on_days(PurchaseItem.objects.all(), start, end, field='purchase__created_at')
+
+        totals = (
+            lines.annotate(day=TruncDate('purchase__created_at'))
+            .values('day', 'item_id')
+            .annotate(units=models.Sum('quantity'), revenue=models.Sum('line_total'))
+            .order_by()
+        )
+        written = 0
+        with transaction.atomic():
+            rollup.delete()
+            batch = []
+            for row in totals.iterator(chunk_size=batch_size):
+                batch.append(DailyItemSales(**row))
+                if len(batch) >= batch_size:
+                    written += len(self.bulk_create(batch))
+                    batch = []
+            if batch:
+                written += len(self.bulk_create(batch))
+        return written
+
+class DailyItemSales(models.Model):
+    """
+    Units sold and revenue per item per day, kept up to date as purchases
+    are written so sales reports read a few rows per day instead of every
+    purchase line.
+    """
+    day = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    objects = DailyItemSalesQuerySet.as_manager()
+
+    class Meta:
+        # Also serves day range scans, the leading column being the day
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'item'], name='daily_item_sales_day_item_uniq'),
+        ]
+
+class Reservation(models.Model):
+    """
+    A time-limited hold on stock, e.g. for a cart going through checkout.
+
+    The held quantities are taken out of ``Item.stock`` (and counted in
+    ``Item.reserved``) when the reservation is placed; checkout turns them
+    into a purchase, while releasing or expiring it returns them to stock.
+    """
+    ACTIVE = 'active'
+    CONVERTED = 'converted'
+    RELEASED = 'released'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Active'),
+        (CONVERTED, 'Converted'),
+        (RELEASED, 'Released'),
+        (EXPIRED, 'Expired'),
+    ]
+
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=ACTIVE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    purchase = models.OneToOneField(Purchase, null=True, blank=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        # Lets the sweeper find expired holds without scanning old ones
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_sweep_idx'),
+        ]
+
+    def is_expired(self, now=None):
+        return self.expires_at <= (now or timezone.now())
+
+class ReservedItem(models.Model):
+    reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['reservation', 'item'], name='reserved_item_uniq'),
+        ]
+
+class IdempotencyKey(models.Model):
+    """
+    The stored outcome of a request sent with an ``Idempotency-Key`` header.
+
+    A retry with the same key gets this response back instead of running
+    the request again; see invoicing.idempotency.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    # Hash of the method, path and payload the key was first used with
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Pruning deletes by age
+        indexes = [
+            models.Index(fields=['created_at'], name='idempotency_created_idx'),
+        ]
+
+class ArchiveMonth(models.Model):
+    """
+    One month of purchases moved out of the purchase tables into its own
+    archive tables by invoicing.archive.
+
+    Purchase ids grow with creation time, so the id range locates the month
+    of an archived purchase without an index of every archived id.
+    """
+    month = models.DateField(unique=True)  # First day of the month
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    # Last local day with archived purchases; the rollup keeps these days
+    through = models.DateField()
+    purchases = models.PositiveIntegerField(default=0)
+    lines = models.PositiveIntegerField(default=0)
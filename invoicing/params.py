@@ -0,0 +1,86 @@
+"""
+Helpers shared by the endpoints that read query parameters: client-facing
+errors, ``YYYY-MM-DD`` day parameters, day ranges over a datetime column,
+column integer ranges and the keyset pagination ``Link`` header.
+"""
+import datetime
+
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+
+class ClientError(Exception):
+    """
+    Base class of the errors raised for invalid client input.
+
+    The message is safe to return to the client as-is.
+    """
+
+
+def parse_day(value, name, error=ClientError):
+    """
+    Parse a ``YYYY-MM-DD`` parameter value.
+
+    Args:
+        value: The raw value; None or ``''`` when the parameter is absent.
+        name: The parameter name, for the error message.
+        error: The ClientError subclass to raise.
+
+    Returns:
+        date: The day, or None if no value was given.
+
+    Raises:
+        ClientError: If the value is not a valid date.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise error(f"'{name}' must be a date in YYYY-MM-DD format")
+    return day
+
+
+def integer_range(field):
+    """The ``(min, max)`` integers the database column of ``field`` can store."""
+    return connection.ops.integer_field_range(field.get_internal_type())
+
+
+def local_midnight(day):
+    """The aware datetime at which ``day`` starts in the current time zone."""
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def on_days(queryset, start=None, end=None, field='created_at'):
+    """
+    Narrow ``queryset`` to rows whose ``field`` falls on the local days
+    ``start`` through ``end``; either bound may be None.
+    """
+    # Compare against local midnights rather than field__date so an index
+    # on the column can be used.
+    if start is not None:
+        queryset = queryset.filter(**{f'{field}__gte': local_midnight(start)})
+    if end is not None:
+        queryset = queryset.filter(**{f'{field}__lt': local_midnight(end + datetime.timedelta(days=1))})
+    return queryset
+
+
+def set_next_link(response, request, params, next_cursor):
+    """
+    Point the ``Link`` header of a keyset page at the page after it.
+
+    Args:
+        response: The page's response.
+        request: The request it answers.
+        params: The request's query parameters (a QueryDict).
+        next_cursor: The cursor of the next page, or None on the last page.
+    """
+    if next_cursor is None:
+        return
+    params = params.copy()
+    params['cursor'] = next_cursor
+    next_url = request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+    response['Link'] = f'<{next_url}>; rel="next"'
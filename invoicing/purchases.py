@@ -0,0 +1,78 @@
+from django.db.models import Prefetch
+
+from .models import Purchase, PurchaseItem
+from .params import ClientError, on_days, parse_day
+from .serializers import PurchaseReadSerializer
+
+# Fields the purchase endpoints can return, and the ones ?expand= accepts
+PURCHASE_FIELDS = tuple(PurchaseReadSerializer.Meta.fields)
+EXPANDABLE = ('items',)
+
+
+class PurchaseQueryError(ClientError):
+    """Raised when purchase list query parameters cannot be parsed."""
+
+
+def _parse_list(params, name, allowed):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    names = [part.strip() for part in value.split(',') if part.strip()]
+    unknown = [part for part in names if part not in allowed]
+    if unknown:
+        raise PurchaseQueryError(f"Unknown '{name}': {', '.join(unknown)}. Choose from: {', '.join(allowed)}")
+    return names
+
+
+def parse_shape(params):
+    """
+    Read the sparse fieldset parameters.
+
+    Supported parameters:
+        fields: Comma-separated fields to return (default: all).
+        expand: ``items`` to embed each line's item, unit price and total.
+
+    Returns:
+        tuple: ``(fields or None, expand)``.
+    """
+    fields = _parse_list(params, 'fields', PURCHASE_FIELDS)
+    expand = _parse_list(params, 'expand', EXPANDABLE) or []
+    return fields, expand
+
+
+def purchase_queryset(fields=None, expand=()):
+    """
+    Build the purchase queryset for a fieldset.
+
+    Only the requested columns are read, and lines are prefetched (with
+    their items, when expanded) only when ``items`` is requested, so a list
+    costs one query, or two with items, however many purchases it holds.
+    """
+    fields = PURCHASE_FIELDS if fields is None else fields
+    columns = [name for name in fields if name != 'items']
+    queryset = Purchase.objects.only('id', *columns)
+    if 'items' in fields:
+        lines = PurchaseItem.objects.order_by('id')
+        if 'items' in expand:
+            lines = lines.select_related('item').only(
+                'purchase_id', 'item_id', 'quantity', 'unit_price', 'line_total', 'item__name',
+            )
+        else:
+            lines = lines.only('purchase_id', 'item_id', 'quantity')
+        queryset = queryset.prefetch_related(Prefetch('purchaseitem_set', queryset=lines))
+    return queryset
+
+
+def filter_purchases(queryset, params):
+    """
+    Narrow purchases to a ``created_at`` range.
+
+    Supported parameters:
+        start / end: Inclusive ``YYYY-MM-DD`` bounds.
+
+    Raises:
+        PurchaseQueryError: If a date is invalid.
+    """
+    start = parse_day(params.get('start'), 'start', PurchaseQueryError)
+    end = parse_day(params.get('end'), 'end', PurchaseQueryError)
+    return on_days(queryset, start, end)
@@ -0,0 +1,127 @@
+"""
+Read-replica routing for the invoicing app.
+
+With ``INVOICING_READ_REPLICA`` set to a database alias, ReplicaRouter sends
+reads of invoicing models there and keeps every write on the primary
+(``default``). Reads stay on the primary when they must see the latest data:
+
+- inside a transaction on the primary (checkout, purchase updates), so
+  stock checks and locks never work on stale rows;
+- for models that guard correctness (idempotency keys);
+- for the rest of a request once it has written anything;
+- for ``INVOICING_REPLICA_STICKY_SECONDS`` after a client's last write, so
+  it reads its own purchases back even if the replica lags. ReplicaPinMiddleware
+  remembers this in a cookie.
+"""
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'invoicing_primary_until'
+
+# Read on the primary even when a replica is configured: a stale idempotency
+# lookup would run a retried purchase twice.
+PRIMARY_ONLY_MODELS = {'idempotencykey'}
+
+
+class _Pin:
+    # Routing state of one request
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_current = contextvars.ContextVar('invoicing_replica_pin', default=None)
+
+
+def replica_alias():
+    """The configured replica alias, or None when reads use the primary."""
+    return getattr(settings, 'INVOICING_READ_REPLICA', None)
+
+
+class ReplicaRouter:
+    """Route invoicing reads to the replica and writes to the primary."""
+
+    def _routes(self, model):
+        return model._meta.app_label == 'invoicing'
+
+    def db_for_read(self, model, **hints):
+        replica = replica_alias()
+        if replica is None or not self._routes(model):
+            return None
+        if model._meta.model_name in PRIMARY_ONLY_MODELS:
+            return DEFAULT_DB_ALIAS
+        pin = _current.get()
+        if pin is not None and (pin.pinned or pin.wrote):
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        if not self._routes(model):
+            return None
+        pin = _current.get()
+        if pin is not None:
+            pin.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+def _pinned_by_cookie(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaPinMiddleware:
+    """
+    Track writes per request and keep recent writers on the primary.
+
+    A request that wrote gets a cookie pinning the client's reads to the
+    primary for ``INVOICING_REPLICA_STICKY_SECONDS``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        pin = _Pin(pinned=_pinned_by_cookie(request))
+        token = _current.set(pin)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(response, pin)
+
+    async def __acall__(self, request):
+        pin = _Pin(pinned=_pinned_by_cookie(request))
+        token = _current.set(pin)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(response, pin)
+
+    def finish(self, response, pin):
+        if pin.wrote and replica_alias() is not None:
+            sticky = settings.INVOICING_REPLICA_STICKY_SECONDS
+            response.set_cookie(PIN_COOKIE, f'{time.time() + sticky:.3f}', max_age=sticky, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,117 @@
+from django.db.models import Sum
+
+from .models import DailyItemSales
+from .params import ClientError, parse_day
+
+
+class ReportQueryError(ClientError):
+    """Raised when report query parameters cannot be parsed."""
+
+
+# Ways the top items can be ranked, mapped to their ordering
+RANKINGS = {
+    'revenue': ('-revenue', '-units', 'item_id'),
+    'units': ('-units', '-revenue', 'item_id'),
+}
+
+
+def parse_report_params(params, default_top=10, max_top=100):
+    """
+    Read the sales report parameters.
+
+    Supported parameters:
+        start / end: Inclusive ``YYYY-MM-DD`` bounds; either may be omitted.
+        top: How many items to rank.
+        by: Rank items by ``revenue`` (default) or ``units``.
+
+    Returns:
+        tuple: ``(start, end, top, by)``.
+
+    Raises:
+        ReportQueryError: If a parameter has an invalid value.
+    """
+    start = parse_day(params.get('start'), 'start', ReportQueryError)
+    end = parse_day(params.get('end'), 'end', ReportQueryError)
+    if start and end and start > end:
+        raise ReportQueryError("'start' must not be after 'end'")
+
+    top = params.get('top')
+    if top in (None, ''):
+        top = default_top
+    else:
+        try:
+            top = int(top)
+        except ValueError:
+            top = 0
+        if top < 1:
+            raise ReportQueryError("'top' must be a positive integer")
+        top = min(top, max_top)
+
+    by = params.get('by') or 'revenue'
+    if by not in RANKINGS:
+        raise ReportQueryError(f"'by' must be one of: {', '.join(RANKINGS)}")
+    return start, end, top, by
+
+
+def rollup_range(start=None, end=None):
+    """Select the rollup rows of an inclusive day range."""
+    rows = DailyItemSales.objects.all()
+    if start is not None:
+        rows = rows.filter(day__gte=start)
+    if end is not None:
+        rows = rows.filter(day__lte=end)
+    return rows
+
+
+def sales_report(start=None, end=None, top=10, by='revenue'):
+    """
+    Summarize sales over a day range from the daily rollup.
+
+    Every figure is aggregated from ``DailyItemSales``, so the cost grows
+    with the number of days and items sold rather than with the number of
+    purchase lines.
+
+    Args:
+        start: First day to include (a date), or None.
+        end: Last day to include (a date), or None.
+        top: How many items to return in ``top_items``.
+        by: Rank items by ``'revenue'`` or ``'units'``.
+
+    Returns:
+        dict: Overall ``revenue`` and ``units``, a ``daily`` series and the
+        ``top_items``, all JSON-serializable.
+    """
+    rows = rollup_range(start, end).order_by()
+
+    totals = rows.aggregate(units=Sum('units'), revenue=Sum('revenue'))
+    daily = (
+        rows.values('day')
+        .annotate(units=Sum('units'), revenue=Sum('revenue'))
+        .order_by('day')
+    )
+    ranked = (
+        rows.values('item_id', 'item__name')
+        .annotate(units=Sum('units'), revenue=Sum('revenue'))
+        .filter(units__gt=0)
+        .order_by(*RANKINGS[by])[:top]
+    )
+
+    return {
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "units": totals['units'] or 0,
+        "revenue": f"{totals['revenue'] or 0:.2f}",
+        "daily": [
+            {"day": row['day'].isoformat(), "units": row['units'], "revenue": f"{row['revenue']:.2f}"}
+            for row in daily
+        ],
+        "top_items": [
+            {
+                "item_id": row['item_id'],
+                "name": row['item__name'],
+                "units": row['units'],
+                "revenue": f"{row['revenue']:.2f}",
+            }
+            for row in ranked
+        ],
+    }
@@ -0,0 +1,195 @@
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, When
+from django.utils import timezone
+
+from .cache import bump_catalogue_version_on_commit
+from .checkout import CheckoutError, adjust_stock, create_purchase, load_items, normalize_lines
+from .models import Item, Reservation, ReservedItem
+
+
+class ReservationClosed(CheckoutError):
+    def __init__(self, reservation):
+        self.reservation = reservation
+        super().__init__(f"Reservation is {reservation.status}")
+
+
+class ReservationExpired(ReservationClosed):
+    pass
+
+
+def reservation_ttl(ttl=None):
+    """
+    Validate a requested hold duration in seconds.
+
+    Defaults to ``INVOICING_RESERVATION_TTL`` and may not exceed
+    ``INVOICING_RESERVATION_MAX_TTL``.
+
+    Raises:
+        CheckoutError: If ``ttl`` is not a positive integer within the limit.
+    """
+    if ttl is None:
+        return settings.INVOICING_RESERVATION_TTL
+    # As in normalize_lines: int() would truncate floats and accept booleans
+    if type(ttl) is not int:
+        raise CheckoutError("'ttl' must be an integer number of seconds")
+    if not 0 < ttl <= settings.INVOICING_RESERVATION_MAX_TTL:
+        raise CheckoutError(f"'ttl' must be between 1 and {settings.INVOICING_RESERVATION_MAX_TTL} seconds")
+    return ttl
+
+
+def reserve(items_data, ttl=None):
+    """
+    Hold stock for a cart until it checks out or the hold expires.
+
+    The held quantities are taken from stock with the same guarded update as
+    a checkout, so concurrent holds and purchases can never oversell, and
+    the item list shows them as unavailable straight away.
+
+    Args:
+        items_data: The raw ``items`` list, as for a purchase.
+        ttl: Seconds the hold lasts; see reservation_ttl.
+
+    Returns:
+        Reservation: The new, active reservation.
+
+    Raises:
+        CheckoutError: If the payload or ttl is invalid, an item does not
+        exist or stock is insufficient.
+    """
+    quantities = normalize_lines(items_data)
+    ttl = reservation_ttl(ttl)
+
+    with transaction.atomic():
+        items = load_items(quantities)
+        adjust_stock(items, quantities, hold=True)
+        bump_catalogue_version_on_commit()
+
+        reservation = Reservation.objects.create(
+            expires_at=timezone.now() + datetime.timedelta(seconds=ttl),
+        )
+        ReservedItem.objects.bulk_create([
+            ReservedItem(reservation=reservation, item_id=item_id, quantity=quantity)
+            for item_id, quantity in quantities.items()
+        ])
+    return reservation
+
+
+def _return_to_stock(reservation_ids):
+    # Give the held quantities of these reservations back to stock, with one
+    # update however many reservations and items are involved.
+    held = Counter()
+    rows = ReservedItem.objects.filter(reservation_id__in=reservation_ids).values_list('item_id', 'quantity')
+    for item_id, quantity in rows:
+        held[item_id] += quantity
+    if held:
+        adjust_stock({}, {item_id: -quantity for item_id, quantity in held.items()}, hold=True)
+        bump_catalogue_version_on_commit()
+
+
+def _lock_active(reservation):
+    # Lock the reservation row and make sure it can still be used. An
+    # expired hold that the sweeper has not reached yet is expired here.
+    locked = Reservation.objects.select_for_update().get(pk=reservation.pk)
+    if locked.status == Reservation.ACTIVE and locked.is_expired():
+        _return_to_stock([locked.pk])
+        locked.status = Reservation.EXPIRED
+        locked.save(update_fields=['status'])
+    if locked.status == Reservation.EXPIRED:
+        raise ReservationExpired(locked)
+    if locked.status != Reservation.ACTIVE:
+        raise ReservationClosed(locked)
+    return locked
+
+
+def release(reservation):
+    """
+    Cancel an active reservation and return its stock.
+
+    Raises:
+        ReservationClosed: If the reservation was already used, released or
+        has expired.
+    """
+    # The expiry must be saved even though the caller gets an error, so it is
+    # raised only after the transaction commits.
+    error = None
+    with transaction.atomic():
+        try:
+            locked = _lock_active(reservation)
+        except ReservationClosed as exc:
+            error = exc
+        else:
+            _return_to_stock([locked.pk])
+            locked.status = Reservation.RELEASED
+            locked.save(update_fields=['status'])
+    if error is not None:
+        raise error
+    return locked
+
+
+def checkout(reservation):
+    """
+    Turn an active reservation into a purchase.
+
+    Stock was taken when the hold was placed, so only ``Item.reserved`` is
+    reduced here; lines are priced at checkout time like any purchase.
+
+    Returns:
+        Purchase: The new purchase.
+
+    Raises:
+        ReservationClosed: If the reservation was already used or released.
+        ReservationExpired: If the hold ran out before checkout.
+    """
+    error = None
+    with transaction.atomic():
+        try:
+            locked = _lock_active(reservation)
+        except ReservationClosed as exc:
+            error = exc
+        else:
+            quantities = dict(
+                ReservedItem.objects.filter(reservation=locked).order_by('id').values_list('item_id', 'quantity')
+            )
+            items = load_items(quantities)
+            Item.objects.filter(pk__in=list(quantities)).update(reserved=Case(
+                *[When(pk=item_id, then=F('reserved') - quantity) for item_id, quantity in quantities.items()],
+                default=F('reserved'),
+                output_field=Item._meta.get_field('reserved'),
+            ))
+            purchase = create_purchase(items, quantities)
+            locked.status = Reservation.CONVERTED
+            locked.purchase = purchase
+            locked.save(update_fields=['status', 'purchase'])
+    if error is not None:
+        raise error
+    return purchase
+
+
+def expire_reservations(now=None, batch_size=500):
+    """
+    Expire every active reservation whose hold has run out.
+
+    Works in batches, each in its own short transaction. A batch's stock is
+    returned with a single update and its reservations are marked expired
+    with another.
+
+    Returns:
+        int: The number of reservations expired.
+    """
+    now = now or timezone.now()
+    expired = 0
+    while True:
+        with transaction.atomic():
+            due = Reservation.objects.select_for_update().filter(
+                status=Reservation.ACTIVE, expires_at__lte=now,
+            ).order_by('expires_at')
+            ids = list(due.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return expired
+            _return_to_stock(ids)
+            Reservation.objects.filter(pk__in=ids).update(status=Reservation.EXPIRED)
+        expired += len(ids)
@@ -27,10 +27,12 @@ class PurchaseSerializer(serializers.ModelSerializer):
 
     def get_items(self, obj):
         # Custom representation for read operations (GET requests)
-        purchase_items = PurchaseItem.objects.filter(purchase=obj)  # Fetch all PurchaseItem objects related to the purchase
+        # Reading through the related manager lets a prefetch done by the caller
+        # (Purchase.objects.with_lines()) serve every purchase from memory, and
+        # using item_id avoids loading the Item row just to read its key.
         return [
-            {"item": purchase_item.item.id, "quantity": purchase_item.quantity}
-            for purchase_item in purchase_items
+            {"item": purchase_item.item_id, "quantity": purchase_item.quantity}
+            for purchase_item in obj.purchaseitem_set.all()
         ]
         # Here we return the IDs of the items in the purchase, along with their quantities. 
         # The 'items' field in the response will contain a list of dictionaries with 'item' (ID) and 'quantity'.
@@ -55,3 +57,36 @@ class PurchaseSerializer(serializers.ModelSerializer):
         return purchase
         # The method returns the created Purchase instance with all associated PurchaseItems.
         # This will be automatically serialized and returned in the API response.
+
+# Read-only serializer for the purchase list and detail endpoints. The caller
+# picks which fields to include (``fields``) and whether lines embed their
+# item (``expand``), so only the requested data is loaded and serialized.
+class PurchaseReadSerializer(serializers.ModelSerializer):
+    items = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Purchase
+        fields = ['id', 'created_at', 'subtotal', 'total', 'line_count', 'items']
+        read_only_fields = fields
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.expand = set(expand)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    def get_items(self, obj):
+        # Lines come from the prefetch set up by purchases.purchase_queryset
+        lines = obj.purchaseitem_set.all()
+        if 'items' not in self.expand:
+            return [{"item": line.item_id, "quantity": line.quantity} for line in lines]
+        return [
+            {
+                "item": {"id": line.item_id, "name": line.item.name},
+                "quantity": line.quantity,
+                "unit_price": str(line.unit_price),
+                "line_total": str(line.line_total),
+            }
+            for line in lines
+        ]
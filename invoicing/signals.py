@@ -0,0 +1,41 @@
+from django.db.backends.signals import connection_created
+from django.db.models import Sum
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .archive import is_archiving
+from .cache import bump_catalogue_version_on_commit
+from .instrumentation import install_query_wrapper
+from .models import DailyItemSales, Item, Purchase, PurchaseItem
+from .snapshot import refresh_snapshot_on_commit
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_catalogue(sender, instance, **kwargs):
+    # Any change to an item may alter some cached item list page. The
+    # snapshot is refreshed before the version is bumped (on_commit hooks run
+    # in order), so no reader caches an old snapshot page under the new version.
+    refresh_snapshot_on_commit([instance.pk])
+    bump_catalogue_version_on_commit()
+
+
+@receiver(pre_delete, sender=Purchase)
+def remove_purchase_sales(sender, instance, **kwargs):
+    # Deleting a purchase (admin, cascade) removes its lines without
+    # PurchaseItem.delete(), so take their sales out of the rollup here.
+    # Archived purchases keep theirs.
+    if is_archiving():
+        return
+    sales = PurchaseItem.objects.filter(purchase_id=instance.pk).values('item_id').annotate(
+        units=Sum('quantity'), revenue=Sum('line_total'),
+    )
+    DailyItemSales.objects.record(
+        timezone.localdate(instance.created_at),
+        {row['item_id']: (-row['units'], -row['revenue']) for row in sales},
+    )
+
+
+# Count and time every SQL statement for the request instrumentation
+connection_created.connect(install_query_wrapper, dispatch_uid='invoicing.instrumentation')
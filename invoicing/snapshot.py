@@ -0,0 +1,438 @@
+"""
+Memory-mapped catalogue snapshot shared by every worker process.
+
+The snapshot is one file (``INVOICING_CATALOGUE_SNAPSHOT``) holding every
+item in fixed-width, id-sorted columns, followed by the item texts:
+
+    header    magic, format, generation, count, text size
+    ids       int64 x count, ascending
+    prices    int64 x count, in cents
+    stock     int64 x count
+    offsets   int64 x (2 * count + 1), into the text blob
+    texts     UTF-8 name and description of each item
+
+Workers map it read-only, so they share one copy through the page cache and
+look items up by binary search without touching the database. Stock
+changes are written into the stock column in place. Any other change
+(an item added, removed, renamed or repriced) goes to an overlay file
+(``<snapshot>.overlay``) of the same layout, holding only the changed items
+and a stock of DELETED for removed ones; lookups check it first. Rewriting
+the overlay costs only the size of the overlay. compact_snapshot, run from
+``build_catalogue_snapshot --compact``, merges it into a new generation of
+the main file outside of any request. Files are replaced by atomic
+renames, and readers notice new ones on their next lookup. Without a
+snapshot file, callers read the database as before.
+"""
+import bisect
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .models import Item, PurchaseItem
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ICAT'
+FORMAT = 1
+HEADER = struct.Struct('<4sIQQQ')
+SNAPSHOT_FIELDS = ('id', 'name', 'price', 'description', 'stock')
+
+# Stock of an item removed since the main file was written (overlay only)
+DELETED = -1
+
+_ITEM_FIELD = PurchaseItem._meta.get_field('item')
+
+
+class _Segment:
+    # The columns of one snapshot or overlay file
+
+    def __init__(self, file, writable):
+        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, file_format, self.generation, count, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f"{file.name} is not a catalogue snapshot")
+        view = memoryview(self._map)
+        start = HEADER.size
+        columns = []
+        for length in (count, count, count, 2 * count + 1):
+            columns.append(view[start:start + 8 * length].cast('q'))
+            start += 8 * length
+        self.ids, self.prices, self.stock, self._offsets = columns
+        self._texts = view[start:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _index(self, item_id):
+        index = bisect.bisect_left(self.ids, item_id)
+        if index < len(self.ids) and self.ids[index] == item_id:
+            return index
+        return None
+
+    def _text(self, n):
+        return str(self._texts[self._offsets[n]:self._offsets[n + 1]], 'utf-8')
+
+    def _values(self, index):
+        # The item's SNAPSHOT_FIELDS values
+        return (
+            self.ids[index], self._text(2 * index), Decimal(self.prices[index]).scaleb(-2),
+            self._text(2 * index + 1), self.stock[index],
+        )
+
+
+def _overlay_path(path):
+    return f'{path}.overlay'
+
+
+def _open(path, writable):
+    # (segment, file key) of one file
+    with open(path, 'r+b' if writable else 'rb') as file:
+        stat = os.fstat(file.fileno())
+        return _Segment(file, writable), (stat.st_dev, stat.st_ino)
+
+
+def _file_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+class CatalogueSnapshot:
+    """
+    A view of the snapshot file and its overlay.
+
+    Only refresh_snapshot opens it ``writable``, to update stock in place.
+    """
+
+    def __init__(self, path, writable=False):
+        while True:
+            self._main, main_key = _open(path, writable)
+            try:
+                self._overlay, overlay_key = _open(_overlay_path(path), writable)
+            except FileNotFoundError:
+                self._overlay, overlay_key = None, None
+            # A compaction may have replaced the main file and removed the
+            # overlay in between; the pair is only consistent if not.
+            if _file_key(path) == main_key:
+                break
+        self.key = (main_key, overlay_key)
+        self.generation = self._main.generation
+        if self._overlay is not None and self._overlay.generation != self.generation:
+            # Left over from before the main file was rebuilt, which
+            # already includes its changes
+            self._overlay = None
+
+    def _find(self, item_id):
+        # (segment, index) holding the current row of an item, or None
+        if self._overlay is not None:
+            index = self._overlay._index(item_id)
+            if index is not None:
+                if self._overlay.stock[index] == DELETED:
+                    return None
+                return self._overlay, index
+        index = self._main._index(item_id)
+        if index is None:
+            return None
+        return self._main, index
+
+    def _rows(self, cursor):
+        # (segment, index) of every item after ``cursor``, in id order
+        main, overlay = self._main, self._overlay
+        m = 0 if cursor is None else bisect.bisect_right(main.ids, cursor)
+        if overlay is None:
+            for index in range(m, len(main)):
+                yield main, index
+            return
+        o = 0 if cursor is None else bisect.bisect_right(overlay.ids, cursor)
+        while m < len(main) or o < len(overlay):
+            if o == len(overlay) or (m < len(main) and main.ids[m] < overlay.ids[o]):
+                yield main, m
+                m += 1
+                continue
+            if m < len(main) and main.ids[m] == overlay.ids[o]:
+                m += 1
+            if overlay.stock[o] != DELETED:
+                yield overlay, o
+            o += 1
+
+    def get(self, item_id):
+        """Return ``(name, price, stock)`` of an item, or None if it is unknown."""
+        found = self._find(item_id)
+        if found is None:
+            return None
+        _, name, price, _, stock = found[0]._values(found[1])
+        return name, price, stock
+
+    def page(self, cursor, limit):
+        """
+        Return one keyset page of the whole catalogue, like paginate.
+
+        Rows are formatted as catalogue.item_rows formats them.
+
+        Returns:
+            tuple: ``(rows, next_cursor)``.
+        """
+        rows = []
+        for segment, index in self._rows(cursor):
+            if len(rows) == limit:
+                return rows, rows[-1]["id"]
+            row = dict(zip(SNAPSHOT_FIELDS, segment._values(index)))
+            row["price"] = str(row["price"])
+            rows.append(row)
+        return rows, None
+
+    def _attach(self, lines):
+        # Set the items found in the snapshot; return the lines still missing one
+        missing = []
+        for line in lines:
+            if _ITEM_FIELD.is_cached(line):
+                continue
+            found = self._find(line.item_id)
+            if found is None:
+                missing.append(line)
+            else:
+                values = found[0]._values(found[1])
+                _ITEM_FIELD.set_cached_value(line, Item.from_db(DEFAULT_DB_ALIAS, SNAPSHOT_FIELDS, values))
+        return missing
+
+    def attach_items(self, lines):
+        """
+        Set ``line.item`` on purchase lines from the snapshot.
+
+        Lines of items missing from the snapshot are served with one
+        database query; lines whose item is already loaded are left alone.
+        """
+        missing = self._attach(lines)
+        if missing:
+            items = Item.objects.in_bulk({line.item_id for line in missing})
+            for line in missing:
+                _ITEM_FIELD.set_cached_value(line, items[line.item_id])
+
+    async def aattach_items(self, lines):
+        """Async variant of attach_items."""
+        missing = self._attach(lines)
+        if missing:
+            items = await Item.objects.ain_bulk({line.item_id for line in missing})
+            for line in missing:
+                _ITEM_FIELD.set_cached_value(line, items[line.item_id])
+
+
+def _pack(rows, generation):
+    # rows: (id, name, price, description, stock) tuples sorted by id
+    texts = bytearray()
+    offsets = [0]
+    for _, name, _, description, _ in rows:
+        for text in (name, description):
+            texts += text.encode('utf-8')
+            offsets.append(len(texts))
+    count = len(rows)
+    parts = [
+        HEADER.pack(MAGIC, FORMAT, generation, count, len(texts)),
+        struct.pack(f'<{count}q', *(row[0] for row in rows)),
+        struct.pack(f'<{count}q', *(int(row[2] * 100) for row in rows)),
+        struct.pack(f'<{count}q', *(row[4] for row in rows)),
+        struct.pack(f'<{len(offsets)}q', *offsets),
+        bytes(texts),
+    ]
+    return b''.join(parts)
+
+
+def _publish(path, rows, generation):
+    # Write the new file next to the old one and rename it into place, so
+    # readers always map a complete snapshot.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(_pack(rows, generation))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _discard(path):
+    # Remove a file if it is there
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def _writer_lock(path):
+    # Serializes writers across processes; readers never take it.
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _snapshot_path():
+    path = getattr(settings, 'INVOICING_CATALOGUE_SNAPSHOT', None)
+    return os.fspath(path) if path else None
+
+
+def build_snapshot(batch_size=5000):
+    """
+    Write a snapshot of the whole catalogue from the database.
+
+    Returns:
+        int: The number of items in it.
+    """
+    path = _snapshot_path()
+    if path is None:
+        raise ValueError("INVOICING_CATALOGUE_SNAPSHOT is not set")
+    with _writer_lock(path):
+        rows = list(
+            Item.objects.using(DEFAULT_DB_ALIAS).order_by('id').values_list(*SNAPSHOT_FIELDS)
+            .iterator(chunk_size=batch_size)
+        )
+        try:
+            generation = CatalogueSnapshot(path).generation + 1
+        except (FileNotFoundError, ValueError):
+            generation = 1
+        _publish(path, rows, generation)
+        _discard(_overlay_path(path))
+    return len(rows)
+
+
+def compact_snapshot():
+    """
+    Merge the overlay into a new generation of the snapshot file.
+
+    Reads no database rows. Does nothing until a snapshot has been built.
+
+    Returns:
+        int: The number of overlay entries merged.
+    """
+    path = _snapshot_path()
+    if path is None:
+        raise ValueError("INVOICING_CATALOGUE_SNAPSHOT is not set")
+    with _writer_lock(path):
+        try:
+            snapshot = CatalogueSnapshot(path)
+        except FileNotFoundError:
+            return 0
+        if snapshot._overlay is None:
+            _discard(_overlay_path(path))
+            return 0
+        rows = [segment._values(index) for segment, index in snapshot._rows(None)]
+        _publish(path, rows, snapshot.generation + 1)
+        _discard(_overlay_path(path))
+        return len(snapshot._overlay)
+
+
+def _stock_changes(snapshot, item_ids, changed):
+    # The (segment, index, stock) writes that bring the snapshot up to date,
+    # or None if anything other than stock changed for one of the items.
+    writes = []
+    for item_id in item_ids:
+        found = snapshot._find(item_id)
+        row = changed.get(item_id)
+        if found is None or row is None or found[0]._values(found[1])[:4] != row[:4]:
+            return None
+        writes.append((*found, row[4]))
+    return writes
+
+
+def refresh_snapshot(item_ids):
+    """
+    Bring the snapshot entries of ``item_ids`` up to date with the database.
+
+    When only stock changed, the new values are written in place; otherwise
+    the items are written to the overlay, whose other entries are kept.
+    Does nothing until a snapshot has been built.
+    """
+    path = _snapshot_path()
+    item_ids = set(item_ids)
+    if path is None or not item_ids:
+        return
+    with _writer_lock(path):
+        try:
+            snapshot = CatalogueSnapshot(path, writable=True)
+        except FileNotFoundError:
+            return
+        # Read from the primary: a replica could still have the old rows.
+        changed = {
+            row[0]: row
+            for row in Item.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=item_ids).values_list(*SNAPSHOT_FIELDS)
+        }
+        writes = _stock_changes(snapshot, item_ids, changed)
+        if writes is not None:
+            for segment, index, stock in writes:
+                segment.stock[index] = stock
+            return
+
+        overlay = snapshot._overlay
+        rows = [] if overlay is None else [
+            overlay._values(index) for index in range(len(overlay)) if overlay.ids[index] not in item_ids
+        ]
+        rows.extend(changed.values())
+        rows.extend((item_id, '', 0, '', DELETED) for item_id in item_ids - changed.keys())
+        rows.sort(key=lambda row: row[0])
+        _publish(_overlay_path(path), rows, snapshot.generation)
+
+
+def _refresh_after_commit(item_ids):
+    # Runs after the transaction committed, so a failure must not reach the
+    # client. Drop the snapshot instead: readers fall back to the database
+    # until it is built again.
+    try:
+        refresh_snapshot(item_ids)
+    except Exception:
+        logger.exception("Could not refresh the catalogue snapshot; removing it")
+        path = _snapshot_path()
+        for stale in (path, _overlay_path(path)):
+            try:
+                _discard(stale)
+            except OSError:
+                logger.exception("Could not remove %s", stale)
+
+
+def refresh_snapshot_on_commit(item_ids):
+    """Refresh the snapshot entries of ``item_ids`` once the transaction commits."""
+    if _snapshot_path() is None:
+        return
+    item_ids = list(item_ids)
+    transaction.on_commit(lambda: _refresh_after_commit(item_ids))
+
+
+_mapped = threading.local()
+
+
+def catalogue_snapshot():
+    """
+    The current snapshot, or None when none is configured or built.
+
+    Each thread keeps its mapping and only remaps after a writer renamed a
+    new file into place, which costs two ``stat`` calls per call.
+    """
+    path = _snapshot_path()
+    if path is None:
+        return None
+    main_key = _file_key(path)
+    if main_key is None:
+        return None
+    key = (main_key, _file_key(_overlay_path(path)))
+    mapped = getattr(_mapped, 'snapshot', None)
+    if getattr(_mapped, 'path', None) != path or mapped is None or mapped.key != key:
+        try:
+            _mapped.snapshot = CatalogueSnapshot(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        _mapped.path = path
+    return _mapped.snapshot
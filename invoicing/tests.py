@@ -1,11 +1,54 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.http import QueryDict
+from urllib.parse import urlencode
+from unittest import skipUnless
 from rest_framework.test import APIClient
+from rest_framework.renderers import JSONRenderer
 from rest_framework import status
-from .models import Item, Purchase, PurchaseItem
+from .models import ArchiveMonth, DailyItemSales, IdempotencyKey, Item, Purchase, PurchaseItem, Reservation
 from .serializers import ItemSerializer, PurchaseItemSerializer, PurchaseSerializer
+from .checkout import InsufficientStock, place_order, reserve_stock
+from .benchmark import SCENARIOS, compare_to_baseline, percentile, run_benchmark, seed, time_item_serialization
+from .cache import bump_catalogue_version_on_commit
+from .instrumentation import registry
+from . import idempotency
+from .ingest import import_purchases, parse_ndjson
+from .catalogue import STREAM_FIELDS, filter_items, item_rows
+from .replicas import PIN_COOKIE, ReplicaRouter
+from .archive import archive_models, archive_purchases, archived_purchase
+from .snapshot import build_snapshot, catalogue_snapshot, compact_snapshot
+from .renderers import FastJSONParser, FastJSONRenderer
+from rest_framework.exceptions import ParseError
+from .export import export_queryset
+from .reports import rollup_range
+from .invoices import InvoiceStore
+from .jobs import DONE, InvoiceRenderQueue
+from .layout import DEFAULT_TEMPLATE
+from decimal import Decimal
+import threading
+from unittest import mock
+from asgiref.sync import sync_to_async
+import datetime
+import json
+import os
+import pstats
+import runpy
+import tempfile
+import zipfile
+from io import StringIO
 from io import BytesIO
 from PyPDF2 import PdfReader
 from django.urls import reverse
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+
+# Rendered invoices go to a throwaway directory instead of the project tree
+INVOICE_CACHE_DIR = tempfile.TemporaryDirectory()
 
 class ItemModelTestCase(TestCase):
     def setUp(self):
@@ -163,7 +206,8 @@ class PurchaseItemSerializerTestCase(TestCase):
         }
         serializer = PurchaseItemSerializer(data=data)
         self.assertTrue(serializer.is_valid())
-        purchase_item = serializer.save(purchase=self.purchase)
+        # A purchase holds one line per item, so add it to a new purchase
+        purchase_item = serializer.save(purchase=Purchase.objects.create())
         self.assertEqual(purchase_item.item, self.item)
         self.assertEqual(purchase_item.quantity, 5)
 
@@ -224,6 +268,7 @@ class PurchaseSerializerTestCase(TestCase):
 class ItemListViewTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
+        caches['catalogue'].clear()
         self.item1 = Item.objects.create(
             name="Item 1",
             price=10.00,
@@ -245,6 +290,121 @@ class ItemListViewTestCase(TestCase):
         self.assertEqual(response.data[0]['name'], self.item1.name)
         self.assertEqual(response.data[1]['name'], self.item2.name)
 
+class ItemListPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        caches['catalogue'].clear()
+        self.items = Item.objects.bulk_create([
+            Item(name=f"Widget {i}", price=i, description="", stock=i % 3)
+            for i in range(1, 8)
+        ])
+        Item.objects.create(name="Gadget", price=50.00, description="", stock=5)
+
+    def test_keyset_pagination(self):
+        """Test that pages follow each other through the Link header without gaps."""
+        seen = []
+        url = '/api/items/?limit=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data), 3)
+            seen.extend(row['id'] for row in response.data)
+            link = response.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(seen, list(Item.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_filters(self):
+        """Test name prefix, price range and in-stock filters."""
+        response = self.client.get('/api/items/', {'name': 'Widget', 'min_price': '2', 'max_price': '5', 'in_stock': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['name'] for row in response.data], ["Widget 2", "Widget 4", "Widget 5"])
+
+        response = self.client.get('/api/items/', {'in_stock': 'false'})
+        self.assertEqual([row['name'] for row in response.data], ["Widget 3", "Widget 6"])
+
+    def test_invalid_parameters(self):
+        """Test that malformed query parameters are rejected."""
+        for params in ({'cursor': 'abc'}, {'limit': '0'}, {'min_price': 'cheap'}, {'in_stock': 'maybe'}):
+            with self.subTest(params=params):
+                response = self.client.get('/api/items/', params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ndjson_stream(self):
+        """Test that stream=ndjson emits one JSON object per matching item."""
+        response = self.client.get('/api/items/', {'stream': 'ndjson', 'name': 'Gadget'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['price'], "50.00")
+
+class ItemListCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        caches['catalogue'].clear()
+        self.item = Item.objects.create(name="Item 1", price=10.00, description="", stock=5)
+
+    def test_repeat_request_is_served_from_cache(self):
+        """Test that an unchanged catalogue is served without touching the database."""
+        first = self.client.get('/api/items/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/items/')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_item_save_invalidates(self):
+        """Test that saving an item bumps the version and refreshes the list."""
+        self.client.get('/api/items/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.name = "Renamed"
+            self.item.save()
+        response = self.client.get('/api/items/')
+        self.assertEqual(response.data[0]['name'], "Renamed")
+
+    def test_checkout_invalidates(self):
+        """Test that stock decremented by a purchase shows up in the cached list."""
+        self.client.get('/api/items/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create-purchase'), {"items": [{"id": self.item.id, "quantity": 2}]}, format='json')
+        response = self.client.get('/api/items/')
+        self.assertEqual(response.data[0]['stock'], 3)
+
+    def test_if_none_match(self):
+        """Test that a matching ETag yields 304 until the catalogue changes."""
+        etag = self.client.get('/api/items/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/items/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        other = self.client.get('/api/items/', {'limit': 5})
+        self.assertNotEqual(other['ETag'], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+        response = self.client.get('/api/items/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+
+    def test_file_based_backend(self):
+        """Test that caching and invalidation also work with the file-based backend."""
+        with tempfile.TemporaryDirectory() as directory:
+            file_cache = {
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'catalogue': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': directory,
+                },
+            }
+            with self.settings(CACHES=file_cache):
+                self.client.get('/api/items/')
+                with self.assertNumQueries(0):
+                    self.client.get('/api/items/')
+                with self.captureOnCommitCallbacks(execute=True):
+                    Item.objects.filter(pk=self.item.pk).update(stock=0)
+                    bump_catalogue_version_on_commit()
+                response = self.client.get('/api/items/')
+                self.assertEqual(response.data[0]['stock'], 0)
+
 class CreatePurchaseViewTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -308,6 +468,184 @@ class CreatePurchaseViewTestCase(TestCase):
         self.item1.refresh_from_db()
         self.assertEqual(self.item1.stock, 50)  # Stock remains unchanged
 
+    def test_create_purchase_is_atomic(self):
+        """Test that a failing later line leaves no purchase and no stock change behind."""
+        data = {
+            "items": [
+                {"id": self.item1.id, "quantity": 5},
+                {"id": self.item2.id, "quantity": 31}  # Exceeds available stock
+            ]
+        }
+        response = self.client.post(self.create_purchase_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], f"Not enough stock for {self.item2.name}")
+
+        self.assertEqual(Purchase.objects.count(), 0)
+        self.assertEqual(PurchaseItem.objects.count(), 0)
+        self.item1.refresh_from_db()
+        self.assertEqual(self.item1.stock, 50)
+
+    def test_create_purchase_unknown_item(self):
+        """Test that referencing a missing item is rejected without side effects."""
+        data = {"items": [{"id": self.item1.id, "quantity": 1}, {"id": 9999, "quantity": 1}]}
+        response = self.client.post(self.create_purchase_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "Item 9999 does not exist")
+        self.assertEqual(Purchase.objects.count(), 0)
+
+    def test_create_purchase_rejects_non_positive_quantity(self):
+        """Test that zero or negative quantities are rejected."""
+        data = {"items": [{"id": self.item1.id, "quantity": 0}]}
+        response = self.client.post(self.create_purchase_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Purchase.objects.count(), 0)
+
+    def test_create_purchase_rejects_non_integer_and_out_of_range_values(self):
+        """Test that floats, booleans, strings and ids or quantities the database cannot store are rejected."""
+        for line in (
+            {"id": self.item1.id + 0.9, "quantity": 1},
+            {"id": self.item1.id, "quantity": True},
+            {"id": str(self.item1.id), "quantity": 1},
+            {"id": 2**63, "quantity": 1},
+            {"id": self.item1.id, "quantity": 2**63},
+        ):
+            response = self.client.post(self.create_purchase_url, {"items": [line]}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, line)
+        self.assertEqual(Purchase.objects.count(), 0)
+
+    def test_write_endpoints_reject_non_object_bodies(self):
+        """Test that a JSON list body is a 400 on every write endpoint."""
+        purchase = place_order([{"id": self.item1.id, "quantity": 1}])
+        body = [{"id": self.item1.id, "quantity": 1}]
+        for method, url in (
+            ('post', self.create_purchase_url),
+            ('put', reverse('update-purchase', kwargs={'id': purchase.id})),
+            ('patch', reverse('update-purchase', kwargs={'id': purchase.id})),
+            ('post', reverse('reservations')),
+        ):
+            with self.subTest(method=method, url=url):
+                response = getattr(self.client, method)(url, body, format='json')
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response.data['error'], "Body must be a JSON object")
+
+    def test_create_purchase_merges_repeated_items(self):
+        """Test that the same item listed twice becomes one line with the summed quantity."""
+        data = {"items": [{"id": self.item1.id, "quantity": 2}, {"id": self.item1.id, "quantity": 3}]}
+        response = self.client.post(self.create_purchase_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        line = PurchaseItem.objects.get()
+        self.assertEqual(line.quantity, 5)
+        self.item1.refresh_from_db()
+        self.assertEqual(self.item1.stock, 45)
+
+    def test_create_purchase_query_count_is_constant(self):
+        """Test that the number of queries does not grow with the number of lines."""
+        items = [
+            Item.objects.create(name=f"Bulk {i}", price=1.00, description="", stock=10)
+            for i in range(50)
+        ]
+
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.create_purchase_url, {
+                "items": [{"id": items[0].id, "quantity": 1}]
+            }, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post(self.create_purchase_url, {
+                "items": [{"id": item.id, "quantity": 1} for item in items]
+            }, format='json')
+
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(PurchaseItem.objects.count(), 51)
+
+class ReserveStockTestCase(TestCase):
+    def setUp(self):
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=5)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=5)
+
+    def test_stale_snapshot_does_not_oversell(self):
+        """Test that a concurrent stock change between read and update is caught."""
+        items = Item.objects.in_bulk([self.item1.id, self.item2.id])
+        # Another checkout takes most of item 2 after our snapshot was read.
+        Item.objects.filter(pk=self.item2.id).update(stock=1)
+
+        with self.assertRaises(InsufficientStock) as ctx:
+            with transaction.atomic():
+                reserve_stock(items, {self.item1.id: 2, self.item2.id: 3})
+        self.assertEqual(ctx.exception.item, items[self.item2.id])
+
+        self.item1.refresh_from_db()
+        self.item2.refresh_from_db()
+        self.assertEqual(self.item1.stock, 5)
+        self.assertEqual(self.item2.stock, 1)
+
+class PurchaseTotalsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=50)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=50)
+
+    def test_checkout_snapshots_prices_and_totals(self):
+        """Test that checkout stores unit prices, line totals and purchase totals."""
+        response = self.client.post(reverse('create-purchase'), {
+            "items": [{"id": self.item1.id, "quantity": 2}, {"id": self.item2.id, "quantity": 3}]
+        }, format='json')
+        purchase = Purchase.objects.get(pk=response.data['purchase_id'])
+        self.assertEqual(purchase.subtotal, Decimal("80.00"))
+        self.assertEqual(purchase.total, Decimal("80.00"))
+        self.assertEqual(purchase.line_count, 2)
+        line = purchase.purchaseitem_set.get(item=self.item2)
+        self.assertEqual(line.unit_price, Decimal("20.00"))
+        self.assertEqual(line.line_total, Decimal("60.00"))
+
+    def test_update_keeps_existing_snapshots(self):
+        """Test that lines kept by an update retain their original unit price."""
+        purchase = Purchase.objects.create()
+        PurchaseItem.objects.create(purchase=purchase, item=self.item1, quantity=1)
+        Item.objects.filter(pk=self.item1.pk).update(price=99.00)
+
+        self.client.put(reverse('update-purchase', kwargs={'id': purchase.id}), {
+            "items": [{"id": self.item1.id, "quantity": 4}, {"id": self.item2.id, "quantity": 1}]
+        }, format='json')
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.purchaseitem_set.get(item=self.item1).unit_price, Decimal("10.00"))
+        self.assertEqual(purchase.total, Decimal("60.00"))
+        self.assertEqual(purchase.line_count, 2)
+
+    def test_single_line_writes_maintain_totals(self):
+        """Test that saving or deleting one line keeps the purchase totals in sync."""
+        purchase = Purchase.objects.create()
+        line = PurchaseItem.objects.create(purchase=purchase, item=self.item1, quantity=2)
+        PurchaseItem.objects.create(purchase=purchase, item=self.item2, quantity=1)
+        purchase.refresh_from_db()
+        self.assertEqual((purchase.total, purchase.line_count), (Decimal("40.00"), 2))
+
+        line.quantity = 5
+        line.save()
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.total, Decimal("70.00"))
+
+        line.delete()
+        purchase.refresh_from_db()
+        self.assertEqual((purchase.total, purchase.line_count), (Decimal("20.00"), 1))
+
+    def test_changing_line_item_takes_new_price(self):
+        """Test that moving a line to another item snapshots that item's price."""
+        purchase = Purchase.objects.create()
+        line = PurchaseItem.objects.create(purchase=purchase, item=self.item2, quantity=2)
+
+        line.item = self.item1
+        line.save()
+        line.refresh_from_db()
+        purchase.refresh_from_db()
+        self.assertEqual((line.unit_price, line.line_total), (Decimal("10.00"), Decimal("20.00")))
+        self.assertEqual(purchase.total, Decimal("20.00"))
+
+        line.item, line.unit_price = self.item2, Decimal("15.00")
+        line.save()
+        line.refresh_from_db()
+        self.assertEqual(line.unit_price, Decimal("15.00"))
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
 class UpdatePurchaseViewTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -341,6 +679,164 @@ class UpdatePurchaseViewTestCase(TestCase):
         self.assertEqual(self.purchase.items.count(), 1)
         self.assertIn(self.item2, self.purchase.items.all())
 
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class PurchaseDiffUpdateTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.items = [
+            Item.objects.create(name=f"Item {i}", price=10.00, description="", stock=20)
+            for i in range(3)
+        ]
+        response = self.client.post(reverse('create-purchase'), {
+            "items": [{"id": self.items[0].id, "quantity": 5}, {"id": self.items[1].id, "quantity": 5}]
+        }, format='json')
+        self.purchase = Purchase.objects.get(pk=response.data['purchase_id'])
+        self.url = reverse('update-purchase', kwargs={'id': self.purchase.id})
+
+    def stock(self):
+        return [item.stock for item in Item.objects.order_by('id')]
+
+    def test_put_reconciles_stock(self):
+        """Test that stock moves by the net change of each line."""
+        response = self.client.put(self.url, {
+            "items": [{"id": self.items[0].id, "quantity": 8}, {"id": self.items[2].id, "quantity": 4}]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(), [12, 20, 16])
+        quantities = dict(self.purchase.purchaseitem_set.values_list('item_id', 'quantity'))
+        self.assertEqual(quantities, {self.items[0].id: 8, self.items[2].id: 4})
+
+    def test_put_keeps_unchanged_lines(self):
+        """Test that unchanged lines are not rewritten."""
+        line_ids = set(self.purchase.purchaseitem_set.values_list('id', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(self.url, {
+                "items": [{"id": self.items[0].id, "quantity": 5}, {"id": self.items[1].id, "quantity": 6}]
+            }, format='json')
+        self.assertEqual(set(self.purchase.purchaseitem_set.values_list('id', flat=True)), line_ids)
+        writes = [q['sql'] for q in queries if q['sql'].startswith(('INSERT', 'DELETE'))]
+        self.assertEqual(writes, [])
+
+    def test_put_insufficient_stock_rolls_back(self):
+        """Test that a failed update leaves lines, totals and stock untouched."""
+        response = self.client.put(self.url, {
+            "items": [{"id": self.items[0].id, "quantity": 1}, {"id": self.items[1].id, "quantity": 26}]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(), [15, 15, 20])
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.total, Decimal("100.00"))
+
+    def test_patch_single_line(self):
+        """Test that PATCH changes only the listed lines and 0 removes a line."""
+        response = self.client.patch(self.url, {"items": [{"id": self.items[1].id, "quantity": 0}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(), [15, 20, 20])
+        self.purchase.refresh_from_db()
+        self.assertEqual((self.purchase.total, self.purchase.line_count), (Decimal("50.00"), 1))
+
+        self.client.patch(self.url, {"items": [{"id": self.items[2].id, "quantity": 2}]}, format='json')
+        self.assertEqual(self.stock(), [15, 20, 18])
+
+    def test_patch_cannot_empty_purchase(self):
+        """Test that removing every line is rejected."""
+        response = self.client.patch(self.url, {"items": [
+            {"id": self.items[0].id, "quantity": 0}, {"id": self.items[1].id, "quantity": 0}
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.purchase.purchaseitem_set.count(), 2)
+
+    def test_update_query_count_is_constant(self):
+        """Test that the number of queries does not grow with the number of changed lines."""
+        extra = Item.objects.bulk_create([
+            Item(name=f"Bulk {i}", price=1.00, description="", stock=10) for i in range(40)
+        ])
+        with CaptureQueriesContext(connection) as small:
+            self.client.put(self.url, {"items": [{"id": self.items[0].id, "quantity": 6}, {"id": self.items[2].id, "quantity": 1}]}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.put(self.url, {"items": [{"id": self.items[0].id, "quantity": 7}] + [
+                {"id": item.id, "quantity": 1} for item in extra
+            ]}, format='json')
+        self.assertEqual(len(small), len(large))
+
+    def test_missing_purchase(self):
+        """Test that updating an unknown purchase returns 404."""
+        url = reverse('update-purchase', kwargs={'id': 9999})
+        response = self.client.put(url, {"items": [{"id": self.items[0].id, "quantity": 1}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+class BulkPurchaseImportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=10)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=3)
+
+    def post(self, body, content_type):
+        return self.client.generic('POST', reverse('bulk-purchases'), body, content_type=content_type)
+
+    def test_ndjson_import_with_per_record_failures(self):
+        """Test that bad records fail on their own while the rest are created."""
+        body = "\n".join([
+            json.dumps({"items": [{"id": self.item1.id, "quantity": 2}]}),
+            json.dumps({"items": [{"id": self.item2.id, "quantity": 2}, {"id": self.item1.id, "quantity": 1}]}),
+            json.dumps({"items": [{"id": self.item2.id, "quantity": 2}]}),  # only 1 left by now
+            "not json",
+            json.dumps({"items": [{"id": 9999, "quantity": 1}]}),
+            "",
+        ])
+        response = self.post(body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['record'] for row in response.data['created']], [1, 2])
+        self.assertEqual(
+            {row['record']: row['error'] for row in response.data['errors']},
+            {3: "Not enough stock for Item 2", 4: "Record is not a JSON object", 5: "Item 9999 does not exist"},
+        )
+
+        self.item1.refresh_from_db()
+        self.item2.refresh_from_db()
+        self.assertEqual((self.item1.stock, self.item2.stock), (7, 1))
+        purchase = Purchase.objects.get(pk=response.data['created'][1]['purchase_id'])
+        self.assertEqual((purchase.total, purchase.line_count), (Decimal("50.00"), 2))
+
+    def test_csv_import_groups_rows_by_order(self):
+        """Test that consecutive CSV rows with the same order form one purchase."""
+        body = "order,item,quantity\nA,{0},1\nA,{1},1\nB,{0},4\n".format(self.item1.id, self.item2.id)
+        response = self.post(body, 'text/csv')
+        self.assertEqual([row['record'] for row in response.data['created']], ["A", "B"])
+        self.assertEqual(PurchaseItem.objects.count(), 3)
+
+    def test_query_count_per_chunk_is_constant(self):
+        """Test that a chunk costs the same number of queries however many records it holds."""
+        def body(count):
+            return "\n".join(json.dumps({"items": [{"id": self.item1.id, "quantity": 1}]}) for _ in range(count))
+
+        # The first sale of an item on a day also inserts its rollup row
+        import_purchases(parse_ndjson(body(1).splitlines()))
+        with CaptureQueriesContext(connection) as small:
+            import_purchases(parse_ndjson(body(1).splitlines()))
+        with CaptureQueriesContext(connection) as large:
+            import_purchases(parse_ndjson(body(5).splitlines()))
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Purchase.objects.count(), 7)
+
+    def test_unsupported_content_type(self):
+        """Test that bodies other than NDJSON or CSV are rejected."""
+        response = self.client.post(reverse('bulk-purchases'), {"items": []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_import_command(self):
+        """Test the import_purchases management command on a CSV file."""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as source:
+            source.write(f"order,item,quantity\n1,{self.item1.id},2\n2,{self.item2.id},9\n")
+        try:
+            stdout, stderr = StringIO(), StringIO()
+            call_command('import_purchases', source.name, stdout=stdout, stderr=stderr)
+        finally:
+            os.unlink(source.name)
+        self.assertIn("Imported 1 purchases, 1 failed", stdout.getvalue())
+        self.assertIn("record 2: Not enough stock for Item 2", stderr.getvalue())
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
 class InvoiceViewTest(TestCase):
     def setUp(self):
         """
@@ -388,4 +884,1352 @@ class InvoiceViewTest(TestCase):
         self.assertIn("Invoice", pdf_text)
         self.assertIn("Item 1 x 2 @ 10.0", pdf_text)
         self.assertIn("Item 2 x 3 @ 20.0", pdf_text)
-        self.assertIn("Total: 80.0", pdf_text)
\ No newline at end of file
+        self.assertIn("Total: 80.0", pdf_text)
+
+    def test_missing_purchase_returns_404(self):
+        """Test that an invoice for an unknown purchase is a 404, as in the async view."""
+        response = self.client.get(reverse('generate-invoice', kwargs={'id': 9999}))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"error": "Purchase not found"})
+
+class InvoiceLayoutTest(TestCase):
+    def extract(self, pdf):
+        return [page.extract_text() for page in PdfReader(BytesIO(pdf)).pages]
+
+    def test_single_page(self):
+        """Test that a short invoice fits on one page with its total."""
+        pages = self.extract(DEFAULT_TEMPLATE.render([("Item 1", Decimal("10.00"), 2)]))
+        self.assertEqual(len(pages), 1)
+        self.assertIn("Invoice", pages[0])
+        self.assertIn("Item 1 x 2 @ 10.00", pages[0])
+        self.assertIn("Total: 20.00", pages[0])
+        self.assertIn("Page 1 of 1", pages[0])
+
+    def test_long_invoice_paginates(self):
+        """Test that lines flow onto further pages and every line is printed once."""
+        rows = [(f"Item {i}", Decimal("1.00"), 1) for i in range(100)]
+        pages = self.extract(DEFAULT_TEMPLATE.render(rows))
+        per_page = DEFAULT_TEMPLATE.lines_per_page
+        self.assertEqual(len(pages), -(-100 // per_page))
+        text = "\n".join(pages)
+        for i in range(100):
+            self.assertEqual(text.count(f"Item {i} x 1 @ 1.00\n"), 1)
+        self.assertIn("Total: 100.00", pages[-1])
+        for page in pages:
+            self.assertIn("Invoice", page)
+        self.assertIn(f"Page {len(pages)} of {len(pages)}", pages[-1])
+
+    def test_totals_move_to_new_page_when_last_page_is_full(self):
+        """Test that a page filled with lines pushes the total onto a page of its own."""
+        rows = [(f"Item {i}", Decimal("1.00"), 1) for i in range(DEFAULT_TEMPLATE.lines_per_page)]
+        pages = self.extract(DEFAULT_TEMPLATE.render(rows))
+        self.assertEqual(len(pages), 2)
+        self.assertNotIn("Total", pages[0])
+        self.assertIn(f"Total: {DEFAULT_TEMPLATE.lines_per_page}.00", pages[1])
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class InvoiceCacheTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item = Item.objects.create(name="Item 1", price=10.00, description="", stock=100)
+        self.purchase = Purchase.objects.create()
+        PurchaseItem.objects.create(purchase=self.purchase, item=self.item, quantity=2)
+        self.invoice_url = reverse('generate-invoice', kwargs={'id': self.purchase.id})
+        InvoiceStore().invalidate(self.purchase.id)
+
+    def download(self, **headers):
+        response = self.client.get(self.invoice_url, **headers)
+        if response.status_code == 200:
+            response.content_bytes = b"".join(response.streaming_content)
+        return response
+
+    def test_repeat_download_skips_rendering(self):
+        """Test that a second download streams the stored PDF without reportlab."""
+        first = self.download()
+        with mock.patch('invoicing.layout.canvas.Canvas', side_effect=AssertionError("rendered again")):
+            second = self.download()
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.content_bytes, second.content_bytes)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertTrue(second.has_header('Last-Modified'))
+
+    def test_conditional_download(self):
+        """Test that If-None-Match and If-Modified-Since give 304 for an unchanged invoice."""
+        first = self.download()
+        response = self.download(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.download(HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_update_invalidates_stored_pdf(self):
+        """Test that rewriting the lines drops the stored PDF and changes the ETag."""
+        first = self.download()
+        update_url = reverse('update-purchase', kwargs={'id': self.purchase.id})
+        self.client.put(update_url, {"items": [{"id": self.item.id, "quantity": 7}]}, format='json')
+        self.assertFalse((InvoiceStore().root / str(self.purchase.id)).exists())
+
+        second = self.download()
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        pdf_text = ''.join(page.extract_text() for page in PdfReader(BytesIO(second.content_bytes)).pages)
+        self.assertIn("Item 1 x 7 @ 10.0", pdf_text)
+
+    def test_price_change_does_not_alter_invoice(self):
+        """Test that invoices use the price snapshot taken when the line was written."""
+        first = self.download()
+        self.item.price = 12.50
+        self.item.save()
+        second = self.download()
+        self.assertEqual(first['ETag'], second['ETag'])
+        pdf_text = PdfReader(BytesIO(second.content_bytes)).pages[0].extract_text()
+        self.assertIn("Item 1 x 2 @ 10.00", pdf_text)
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        caches['catalogue'].clear()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=50)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=30)
+
+    async def test_async_item_list(self):
+        """Test that the async item list matches the sync one, with pagination headers."""
+        response = await self.async_client.get(reverse('async-item-list'), {'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['name'] for row in response.json()], ["Item 1"])
+        self.assertIn('cursor=', response['Link'])
+
+        response = await self.async_client.get(reverse('async-item-list'), {'limit': 1}, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_async_item_stream(self):
+        """Test the async NDJSON stream."""
+        response = await self.async_client.get(reverse('async-item-list'), {'stream': 'ndjson'})
+        lines = b"".join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ["Item 1", "Item 2"])
+
+    async def test_async_create_purchase_and_invoice(self):
+        """Test creating a purchase and downloading its invoice through the async views."""
+        response = await self.async_client.post(
+            reverse('async-create-purchase'),
+            {"items": [{"id": self.item1.id, "quantity": 2}, {"id": self.item2.id, "quantity": 3}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        purchase_id = response.json()['purchase_id']
+        item1 = await Item.objects.aget(pk=self.item1.pk)
+        self.assertEqual(item1.stock, 48)
+
+        response = await self.async_client.get(reverse('async-generate-invoice', kwargs={'id': purchase_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        text = PdfReader(BytesIO(response.content)).pages[0].extract_text()
+        self.assertIn("Item 2 x 3 @ 20.00", text)
+        self.assertIn("Total: 80.00", text)
+
+        response = await self.async_client.get(
+            reverse('async-generate-invoice', kwargs={'id': purchase_id}),
+            headers={'If-None-Match': response['ETag']},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_async_errors(self):
+        """Test error responses of the async views."""
+        response = await self.async_client.post(
+            reverse('async-create-purchase'), {"items": [{"id": self.item1.id, "quantity": 99}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "Not enough stock for Item 1")
+        response = await self.async_client.get(reverse('async-generate-invoice', kwargs={'id': 9999}))
+        self.assertEqual(response.status_code, 404)
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class InvoiceRenderJobTest(TransactionTestCase):
+    # Jobs run on worker threads with their own connections, so the test data
+    # has to be committed for them to see it.
+
+    def setUp(self):
+        self.client = APIClient()
+        item = Item.objects.create(name="Item 1", price=10.00, description="", stock=100)
+        self.purchase = Purchase.objects.create()
+        PurchaseItem.objects.create(purchase=self.purchase, item=item, quantity=4)
+        InvoiceStore().invalidate(self.purchase.id)
+
+    def test_render_job_round_trip(self):
+        """Test queueing a render, polling its status and downloading the PDF."""
+        queue = InvoiceRenderQueue(max_workers=1)
+        with mock.patch('invoicing.views.render_queue', queue):
+            response = self.client.post(reverse('render-invoice', kwargs={'id': self.purchase.id}))
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            job_id = response.data['job_id']
+            self.assertTrue(response['Location'].endswith(reverse('invoice-job', kwargs={'job_id': job_id})))
+
+            queue.get(job_id).wait(timeout=10)
+            response = self.client.get(reverse('invoice-job', kwargs={'job_id': job_id}))
+            self.assertEqual(response.data['status'], DONE)
+
+            response = self.client.get(response.data['download'])
+            self.assertEqual(response.status_code, 200)
+            pdf = PdfReader(BytesIO(b"".join(response.streaming_content)))
+            self.assertIn("Item 1 x 4 @ 10.0", pdf.pages[0].extract_text())
+
+    def test_unknown_purchase_and_job(self):
+        """Test 404s for a missing purchase or job id."""
+        response = self.client.post(reverse('render-invoice', kwargs={'id': 9999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('invoice-job', kwargs={'job_id': 'missing'}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_duplicate_requests_share_in_flight_job(self):
+        """Test that renders requested while one is in flight collapse onto it."""
+        queue = InvoiceRenderQueue(max_workers=1)
+        release = threading.Event()
+        original = InvoiceStore.ensure
+
+        def slow_ensure(store, purchase_id, lines):
+            release.wait(10)
+            return original(store, purchase_id, lines)
+
+        with mock.patch.object(InvoiceStore, 'ensure', slow_ensure):
+            first, created = queue.submit(self.purchase.id)
+            second, created_again = queue.submit(self.purchase.id)
+            self.assertTrue(created)
+            self.assertFalse(created_again)
+            self.assertIs(first, second)
+            release.set()
+            first.wait(timeout=10)
+
+        self.assertEqual(first.status, DONE)
+        third, created = queue.submit(self.purchase.id)
+        self.assertTrue(created)
+        third.wait(timeout=10)
+
+class InvoiceExportTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        item = Item.objects.create(name="Item 1", price=10.00, description="", stock=100)
+        self.purchases = []
+        for quantity in (1, 2, 3):
+            purchase = Purchase.objects.create()
+            PurchaseItem.objects.create(purchase=purchase, item=item, quantity=quantity)
+            self.purchases.append(purchase)
+        # Backdate the first purchase out of the current day
+        Purchase.objects.filter(pk=self.purchases[0].pk).update(
+            created_at=timezone.now() - datetime.timedelta(days=40)
+        )
+
+    def read_archive(self, data):
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            return {
+                name: PdfReader(BytesIO(archive.read(name))).pages[0].extract_text()
+                for name in archive.namelist()
+            }
+
+    @override_settings(INVOICING_EXPORT_WORKERS=0)
+    def test_export_by_ids(self):
+        """Test that selected purchases are streamed as one PDF per archive member."""
+        ids = f"{self.purchases[0].id},{self.purchases[2].id}"
+        response = self.client.get(reverse('export-invoices'), {'ids': ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        invoices = self.read_archive(b"".join(response.streaming_content))
+        self.assertEqual(sorted(invoices), [f"invoice-{self.purchases[0].id}.pdf", f"invoice-{self.purchases[2].id}.pdf"])
+        self.assertIn("Item 1 x 3 @ 10.0", invoices[f"invoice-{self.purchases[2].id}.pdf"])
+
+    @override_settings(INVOICING_EXPORT_WORKERS=0)
+    def test_export_by_date_range(self):
+        """Test that the date range is inclusive of both days."""
+        today = timezone.localdate().isoformat()
+        response = self.client.get(reverse('export-invoices'), {'start': today, 'end': today})
+        invoices = self.read_archive(b"".join(response.streaming_content))
+        self.assertEqual(len(invoices), 2)
+
+    def test_export_requires_selection(self):
+        """Test that an export without a selection, with a bad date or with an id out of range is rejected."""
+        for params in ({}, {'start': '2024-13-01'}, {'ids': '1,x'}, {'ids': '1,100000000000000000000'}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('export-invoices'), params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command_with_process_pool(self):
+        """Test that the management command renders across worker processes."""
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'invoices.zip')
+            stdout = StringIO()
+            call_command('export_invoices', output, ids=','.join(str(p.id) for p in self.purchases),
+                         workers=2, stdout=stdout)
+            with open(output, 'rb') as archive:
+                invoices = self.read_archive(archive.read())
+        self.assertEqual(len(invoices), 3)
+        self.assertIn("Exported 3 invoices", stdout.getvalue())
+
+class PurchaseReadTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=100)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=100)
+        self.purchases = [
+            place_order([{"id": self.item1.id, "quantity": n + 1}, {"id": self.item2.id, "quantity": 1}])
+            for n in range(5)
+        ]
+
+    def test_list_is_paginated_newest_first(self):
+        """Test keyset pagination of the purchase list."""
+        response = self.client.get(reverse('purchase-list'), {'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [row['id'] for row in response.data]
+        self.assertEqual(ids, [p.id for p in reversed(self.purchases)][:3])
+        self.assertEqual(set(response.data[0]), {'id', 'created_at', 'subtotal', 'total', 'line_count', 'items'})
+
+        next_url = response['Link'].split(';')[0].strip('<>')
+        response = self.client.get(next_url)
+        self.assertEqual([row['id'] for row in response.data], [self.purchases[1].id, self.purchases[0].id])
+        self.assertNotIn('Link', response)
+
+    def test_sparse_fieldsets_limit_queries(self):
+        """Test that query count depends on the requested fields, not on the number of purchases."""
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('purchase-list'), {'fields': 'id,total'})
+        self.assertEqual(response.data[0], {"id": self.purchases[-1].id, "total": "70.00"})
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('purchase-list'), {'fields': 'id,items'})
+        self.assertEqual(response.data[0]['items'], [
+            {"item": self.item1.id, "quantity": 5}, {"item": self.item2.id, "quantity": 1},
+        ])
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('purchase-list'), {'expand': 'items'})
+        self.assertEqual(response.data[0]['items'][0], {
+            "item": {"id": self.item1.id, "name": "Item 1"},
+            "quantity": 5, "unit_price": "10.00", "line_total": "50.00",
+        })
+
+    def test_date_range(self):
+        """Test filtering the list on created_at."""
+        Purchase.objects.filter(pk=self.purchases[0].pk).update(
+            created_at=timezone.now() - datetime.timedelta(days=3)
+        )
+        today = timezone.localdate().isoformat()
+        response = self.client.get(reverse('purchase-list'), {'start': today, 'fields': 'id'})
+        self.assertEqual(len(response.data), 4)
+        response = self.client.get(reverse('purchase-list'), {'end': today, 'start': '2000-01-01', 'fields': 'id'})
+        self.assertEqual(len(response.data), 5)
+
+    def test_detail(self):
+        """Test the purchase detail endpoint."""
+        purchase = self.purchases[0]
+        response = self.client.get(reverse('purchase-detail', kwargs={'id': purchase.id}), {'fields': 'id,line_count'})
+        self.assertEqual(response.data, {"id": purchase.id, "line_count": 2})
+        response = self.client.get(reverse('purchase-detail', kwargs={'id': 9999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_parameters(self):
+        """Test that unknown fields, expansions and bad dates are rejected."""
+        for params in ({'fields': 'id,secret'}, {'expand': 'customer'}, {'start': 'yesterday'}, {'limit': '0'}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('purchase-list'), params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class IdempotencyTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item = Item.objects.create(name="Item 1", price=10.00, description="", stock=10)
+        self.payload = {"items": [{"id": self.item.id, "quantity": 2}]}
+
+    def post(self, key, payload=None):
+        return self.client.post(
+            reverse('create-purchase'), payload or self.payload, format='json',
+            headers={'Idempotency-Key': key},
+        )
+
+    def test_retry_replays_stored_response(self):
+        """Test that a retried purchase is not created twice and costs one lookup."""
+        first = self.post('order-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.post('order-1')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Purchase.objects.count(), 1)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock, 8)
+
+        # Without a key, or with another one, a new purchase is made
+        self.client.post(reverse('create-purchase'), self.payload, format='json')
+        self.post('order-2')
+        self.assertEqual(Purchase.objects.count(), 3)
+
+    def test_key_reused_for_other_request(self):
+        """Test that a key cannot be replayed against a different payload or endpoint."""
+        self.post('order-1')
+        response = self.post('order-1', {"items": [{"id": self.item.id, "quantity": 3}]})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        purchase_id = Purchase.objects.get().id
+        response = self.client.put(
+            reverse('update-purchase', kwargs={'id': purchase_id}), self.payload, format='json',
+            headers={'Idempotency-Key': 'order-1'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        response = self.post('x' * 300)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failures_are_not_stored(self):
+        """Test that a failed request can be retried with the same key once it can succeed."""
+        payload = {"items": [{"id": self.item.id, "quantity": 20}]}
+        self.assertEqual(self.post('order-1', payload).status_code, status.HTTP_400_BAD_REQUEST)
+        Item.objects.filter(pk=self.item.pk).update(stock=50)
+        self.assertEqual(self.post('order-1', payload).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_update_retry_adjusts_stock_once(self):
+        """Test Idempotency-Key on purchase updates."""
+        purchase_id = self.post('order-1').data['purchase_id']
+        url = reverse('update-purchase', kwargs={'id': purchase_id})
+        for _ in range(2):
+            response = self.client.patch(
+                url, {"items": [{"id": self.item.id, "quantity": 5}]}, format='json',
+                headers={'Idempotency-Key': 'update-1'},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock, 5)
+
+    def test_expired_keys(self):
+        """Test that keys past the TTL are reusable and pruned."""
+        self.post('order-1')
+        self.post('order-2')
+        IdempotencyKey.objects.filter(key='order-1').update(
+            created_at=timezone.now() - datetime.timedelta(days=2)
+        )
+        self.assertNotIn('Idempotent-Replayed', self.post('order-1', {"items": [{"id": self.item.id, "quantity": 1}]}))
+        self.assertEqual(Purchase.objects.count(), 3)
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - datetime.timedelta(days=2))
+        stdout = StringIO()
+        call_command('prune_idempotency_keys', stdout=stdout)
+        self.assertIn("Deleted 2 idempotency keys", stdout.getvalue())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_concurrent_duplicate_is_rolled_back(self):
+        """Test that a request losing the race for its key undoes its checkout and replays the winner."""
+        first = self.post('order-1')
+        real_lookup = idempotency._lookup
+        # The second request misses the key, as if the first had not committed yet
+        with mock.patch.object(idempotency, '_lookup', side_effect=[None, real_lookup('order-1', mock.ANY)]):
+            retry = self.post('order-1')
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Purchase.objects.count(), 1)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stock, 8)
+
+    async def test_async_create_purchase(self):
+        """Test Idempotency-Key on the async purchase endpoint."""
+        responses = [
+            await self.async_client.post(
+                reverse('async-create-purchase'), self.payload, content_type='application/json',
+                headers={'Idempotency-Key': 'async-1'},
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual(responses[0].json(), responses[1].json())
+        self.assertEqual(responses[1]['Idempotent-Replayed'], 'true')
+        self.assertEqual(await Purchase.objects.acount(), 1)
+
+
+class ReservationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        caches['catalogue'].clear()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=10)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=5)
+
+    def hold(self, *lines, ttl=None):
+        payload = {"items": [{"id": item.id, "quantity": quantity} for item, quantity in lines]}
+        if ttl is not None:
+            payload["ttl"] = ttl
+        return self.client.post(reverse('reservations'), payload, format='json')
+
+    def stock(self):
+        return {item.name: (item.stock, item.reserved) for item in Item.objects.order_by('id')}
+
+    def test_hold_takes_stock(self):
+        """Test that a hold makes stock unavailable and counts it as reserved."""
+        response = self.hold((self.item1, 3), (self.item2, 5))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], Reservation.ACTIVE)
+        self.assertEqual(self.stock(), {"Item 1": (7, 3), "Item 2": (0, 5)})
+
+        listed = self.client.get(reverse('item-list'))
+        self.assertEqual([row['stock'] for row in listed.data], [7, 0])
+
+        response = self.hold((self.item2, 1))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "Not enough stock for Item 2")
+        self.assertEqual(Reservation.objects.count(), 1)
+
+    def test_checkout_converts_hold(self):
+        """Test that checking out creates the purchase without taking stock again."""
+        token = self.hold((self.item1, 3), (self.item2, 1)).data['reservation']
+        response = self.client.post(reverse('reservation-checkout', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        purchase = Purchase.objects.get(id=response.data['purchase_id'])
+        self.assertEqual(purchase.total, Decimal('50.00'))
+        self.assertEqual(self.stock(), {"Item 1": (7, 0), "Item 2": (4, 0)})
+        detail = self.client.get(reverse('reservation', kwargs={'token': token}))
+        self.assertEqual(detail.data['status'], Reservation.CONVERTED)
+        self.assertEqual(detail.data['purchase_id'], purchase.id)
+
+        response = self.client.post(reverse('reservation-checkout', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Purchase.objects.count(), 1)
+
+    def test_release_returns_stock(self):
+        """Test that cancelling a hold gives its stock back once."""
+        token = self.hold((self.item1, 4)).data['reservation']
+        response = self.client.delete(reverse('reservation', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.stock()["Item 1"], (10, 0))
+
+        response = self.client.delete(reverse('reservation', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.stock()["Item 1"], (10, 0))
+
+    def test_expired_hold_cannot_check_out(self):
+        """Test that a lapsed hold is expired on checkout and its stock returned."""
+        token = self.hold((self.item1, 4)).data['reservation']
+        Reservation.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+
+        response = self.client.post(reverse('reservation-checkout', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertEqual(self.stock()["Item 1"], (10, 0))
+        self.assertEqual(Reservation.objects.get().status, Reservation.EXPIRED)
+        self.assertFalse(Purchase.objects.exists())
+
+    def test_sweeper_expires_lapsed_holds(self):
+        """Test the expire_reservations command."""
+        for _ in range(3):
+            self.hold((self.item1, 2), (self.item2, 1))
+        active = self.hold((self.item1, 1), ttl=600).data['reservation']
+        Reservation.objects.exclude(token=active).update(expires_at=timezone.now() - datetime.timedelta(minutes=1))
+
+        stdout = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('expire_reservations', '--batch-size', '2', stdout=stdout)
+        self.assertIn("Expired 3 reservations", stdout.getvalue())
+        self.assertEqual(self.stock(), {"Item 1": (9, 1), "Item 2": (5, 0)})
+        self.assertEqual(Reservation.objects.filter(status=Reservation.EXPIRED).count(), 3)
+        self.assertEqual(Reservation.objects.get(token=active).status, Reservation.ACTIVE)
+        # Two batches of a constant number of statements, plus the empty check
+        updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 4)
+
+    def test_invalid_ttl(self):
+        """Test that a ttl beyond the configured maximum, fractional or boolean is rejected."""
+        for ttl in (10 ** 6, 1.9, True, "60"):
+            with self.subTest(ttl=ttl):
+                response = self.hold((self.item1, 1), ttl=ttl)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock()["Item 1"], (10, 0))
+
+
+class SalesReportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.item1 = Item.objects.create(name="Item 1", price=10.00, description="", stock=100)
+        self.item2 = Item.objects.create(name="Item 2", price=20.00, description="", stock=100)
+        self.item3 = Item.objects.create(name="Item 3", price=1.00, description="", stock=100)
+        self.today = timezone.localdate()
+
+    def buy(self, *lines):
+        response = self.client.post(reverse('create-purchase'), {
+            "items": [{"id": item.id, "quantity": quantity} for item, quantity in lines]
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Purchase.objects.get(id=response.data['purchase_id'])
+
+    def rollup(self):
+        return {
+            (row.day, row.item_id): (row.units, row.revenue)
+            for row in DailyItemSales.objects.exclude(units=0)
+        }
+
+    def assertRollupMatchesRebuild(self):
+        incremental = self.rollup()
+        DailyItemSales.objects.rebuild()
+        self.assertEqual(incremental, self.rollup())
+
+    def test_rollup_follows_purchase_writes(self):
+        """Test that creates, updates and single-line edits keep the rollup in step."""
+        purchase = self.buy((self.item1, 2), (self.item2, 1))
+        self.buy((self.item1, 3))
+        self.assertEqual(self.rollup(), {
+            (self.today, self.item1.id): (5, Decimal('50.00')),
+            (self.today, self.item2.id): (1, Decimal('20.00')),
+        })
+
+        self.client.put(reverse('update-purchase', kwargs={'id': purchase.id}), {
+            "items": [{"id": self.item1.id, "quantity": 1}, {"id": self.item3.id, "quantity": 4}]
+        }, format='json')
+        self.assertEqual(self.rollup(), {
+            (self.today, self.item1.id): (4, Decimal('40.00')),
+            (self.today, self.item3.id): (4, Decimal('4.00')),
+        })
+
+        line = purchase.purchaseitem_set.get(item=self.item3)
+        line.quantity = 6
+        line.save()
+        purchase.purchaseitem_set.get(item=self.item1).delete()
+        self.assertEqual(self.rollup(), {
+            (self.today, self.item1.id): (3, Decimal('30.00')),
+            (self.today, self.item3.id): (6, Decimal('6.00')),
+        })
+        self.assertRollupMatchesRebuild()
+
+    def test_deleting_purchase_removes_its_sales(self):
+        """Test that deleting a purchase takes its lines' sales back out of the rollup."""
+        purchase = self.buy((self.item1, 2), (self.item2, 1))
+        self.buy((self.item1, 3))
+        purchase.delete()
+        self.assertEqual(self.rollup(), {(self.today, self.item1.id): (3, Decimal('30.00'))})
+        self.assertRollupMatchesRebuild()
+
+    def test_bulk_import_updates_rollup(self):
+        """Test that bulk imported purchases are added to the rollup."""
+        records = [json.dumps({"items": [{"id": self.item2.id, "quantity": 2}]})] * 3
+        import_purchases(parse_ndjson(records))
+        self.assertEqual(self.rollup(), {(self.today, self.item2.id): (6, Decimal('120.00'))})
+        self.assertRollupMatchesRebuild()
+
+    def test_report_over_date_range(self):
+        """Test totals, daily series and top items for a date range."""
+        yesterday = self.today - datetime.timedelta(days=1)
+        old = self.buy((self.item1, 1), (self.item3, 50))
+        Purchase.objects.filter(pk=old.pk).update(created_at=timezone.now() - datetime.timedelta(days=1))
+        self.buy((self.item2, 2))
+        self.buy((self.item1, 10))
+        # created_at was changed behind the rollup's back
+        call_command('rebuild_sales_rollup', stdout=StringIO())
+
+        response = self.client.get(reverse('sales-report'), {'start': str(self.today), 'end': str(self.today)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['units'], 12)
+        self.assertEqual(response.data['revenue'], "140.00")
+        self.assertEqual(response.data['daily'], [{"day": str(self.today), "units": 12, "revenue": "140.00"}])
+
+        response = self.client.get(reverse('sales-report'), {'start': str(yesterday)})
+        self.assertEqual([row['day'] for row in response.data['daily']], [str(yesterday), str(self.today)])
+        self.assertEqual(
+            [row['name'] for row in response.data['top_items']], ["Item 1", "Item 3", "Item 2"]
+        )
+        self.assertEqual(response.data['top_items'][0]['revenue'], "110.00")
+
+        response = self.client.get(reverse('sales-report'), {'by': 'units', 'top': 1})
+        self.assertEqual(response.data['top_items'], [
+            {"item_id": self.item3.id, "name": "Item 3", "units": 50, "revenue": "50.00"}
+        ])
+
+    def test_report_reads_rollup_only(self):
+        """Test that the report runs a fixed number of queries against the rollup table."""
+        for _ in range(5):
+            self.buy((self.item1, 1), (self.item2, 1))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('sales-report'))
+        self.assertEqual(len(queries), 3)
+        self.assertFalse(any('invoicing_purchaseitem' in query['sql'] for query in queries))
+
+    def test_invalid_report_params(self):
+        """Test that malformed report parameters are rejected."""
+        for params in ({'start': 'soon'}, {'start': '2024-02-01', 'end': '2024-01-01'},
+                       {'top': '0'}, {'by': 'margin'}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('sales-report'), params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        caches['catalogue'].clear()
+        registry.reset()
+        self.item = Item.objects.create(name="Item 1", price=10.00, description="", stock=50)
+        self.purchase = place_order([{"id": self.item.id, "quantity": 2}])
+        InvoiceStore().invalidate(self.purchase.id)
+
+    def timings(self, response):
+        return dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+
+    def test_server_timing_breaks_down_invoice(self):
+        """Test that an invoice response reports SQL and PDF render time."""
+        response = self.client.get(reverse('generate-invoice', kwargs={'id': self.purchase.id}))
+        timings = self.timings(response)
+        self.assertIn('render', timings)
+        self.assertIn('total', timings)
+        self.assertRegex(timings['db'], r'^dur=[\d.]+;desc="2 queries"$')
+
+        # Served from the invoice store this time: no render
+        response = self.client.get(reverse('generate-invoice', kwargs={'id': self.purchase.id}))
+        self.assertNotIn('render', self.timings(response))
+
+    def test_server_timing_on_item_list(self):
+        """Test that serialization is timed on the item list."""
+        response = self.client.get(reverse('item-list'))
+        self.assertIn('serialize', self.timings(response))
+
+    async def test_async_views_are_instrumented(self):
+        """Test that queries run through sync_to_async are attributed to the request."""
+        response = await self.async_client.post(
+            reverse('async-create-purchase'), {"items": [{"id": self.item.id, "quantity": 1}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+    async def test_async_invoice_reports_render_time(self):
+        """Test that the render in the async invoice view's thread pool is timed for the request."""
+        response = await self.async_client.get(reverse('async-generate-invoice', kwargs={'id': self.purchase.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('render', self.timings(response))
+
+    def test_metrics_endpoint(self):
+        """Test the Prometheus text output."""
+        invoice = self.client.get(reverse('generate-invoice', kwargs={'id': self.purchase.id}))
+        b"".join(invoice.streaming_content)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE invoicing_request_duration_seconds histogram', text)
+        self.assertIn('invoicing_requests_total{method="GET",status="200",view="generate-invoice"} 1', text)
+        self.assertIn('invoicing_sql_queries_total{view="generate-invoice"} 2', text)
+        self.assertIn('invoicing_request_duration_seconds_count{view="generate-invoice"} 1', text)
+        self.assertEqual(
+            registry.value('invoicing_response_bytes_total', view='generate-invoice'),
+            int(invoice['Content-Length']),
+        )
+        self.assertIn('invoicing_phase_seconds_total{phase="render",view="generate-invoice"}', text)
+
+    def test_streamed_response_size(self):
+        """Test that bytes of responses without a Content-Length are counted as they stream."""
+        response = self.client.get(reverse('item-list'), {'stream': 'ndjson'})
+        body = b"".join(response.streaming_content)
+        self.assertEqual(registry.value('invoicing_response_bytes_total', view='item-list'), len(body))
+
+    def test_profile_sampling(self):
+        """Test that sampled requests leave a loadable cProfile dump."""
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(INVOICING_PROFILE_SAMPLE_RATE=1.0, INVOICING_PROFILE_DIR=directory):
+                self.client.get(reverse('item-list'))
+            dumps = os.listdir(directory)
+            self.assertEqual(len(dumps), 1)
+            self.assertIn('item-list', dumps[0])
+            stats = pstats.Stats(os.path.join(directory, dumps[0]))
+            self.assertTrue(stats.total_calls)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(INVOICING_PROFILE_SAMPLE_RATE=0.0, INVOICING_PROFILE_DIR=directory):
+                self.client.get(reverse('item-list'))
+            self.assertEqual(os.listdir(directory), [])
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        caches['catalogue'].clear()
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_in_process_run(self):
+        """Test that every scenario runs error-free against seeded data."""
+        item_ids, purchase_ids = seed(items=30, purchases=10)
+        self.assertEqual(Purchase.objects.filter(line_count=3).count(), 10)
+
+        report = run_benchmark(item_ids, purchase_ids, requests=5)
+        self.assertEqual(set(report['scenarios']), {f"{name}@1" for name in SCENARIOS})
+        for key, row in report['scenarios'].items():
+            with self.subTest(scenario=key):
+                self.assertEqual(row['requests'], 5)
+                self.assertEqual(row['errors'], 0)
+                self.assertGreater(row['p99_ms'], 0)
+                self.assertGreaterEqual(row['p99_ms'], row['p50_ms'])
+        self.assertGreater(report['scenarios']['create_purchase@1']['queries_max'], 0)
+        self.assertGreater(report['peak_rss_kib'], 0)
+
+    def test_baseline_comparison(self):
+        """Test that slower percentiles, extra queries and errors are reported as regressions."""
+        row = {"errors": 0, "p50_ms": 10.0, "p95_ms": 20.0, "p99_ms": 30.0, "queries_max": 4}
+        baseline = {"scenarios": {"invoice@1": row}, "peak_rss_kib": 1000}
+
+        same = {"scenarios": {"invoice@1": dict(row, p99_ms=33.0)}, "peak_rss_kib": 1100}
+        self.assertEqual(compare_to_baseline(same, baseline), [])
+
+        worse = {"scenarios": {"invoice@1": dict(row, p95_ms=40.0, queries_max=5, errors=1)}, "peak_rss_kib": 2000}
+        regressions = compare_to_baseline(worse, baseline)
+        self.assertEqual(len(regressions), 4)
+        self.assertTrue(regressions[0].startswith("invoice@1: p95_ms"))
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN is SQLite syntax")
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class QueryPlanTestCase(TestCase):
+    """
+    Run EXPLAIN QUERY PLAN on the hot queries over seeded tables and fail if
+    any of them scans a whole table instead of searching an index.
+    """
+    ITEMS = 2000
+    PURCHASES = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        items = Item.objects.bulk_create([
+            Item(name=f"Item {i:05d}", price=Decimal(i % 100) + 1, description="", stock=i % 50)
+            for i in range(cls.ITEMS)
+        ])
+        purchases = Purchase.objects.bulk_create([Purchase() for _ in range(cls.PURCHASES)])
+        lines = []
+        for n, purchase in enumerate(purchases):
+            for item in items[n % 100::700]:
+                lines.append(PurchaseItem(purchase=purchase, item=item, quantity=1,
+                                          unit_price=item.price, line_total=item.price))
+        PurchaseItem.objects.bulk_create(lines)
+        Purchase.objects.update_totals()
+        DailyItemSales.objects.rebuild()
+        cls.purchase = purchases[0]
+        cls.items = items
+        # Give the planner real table statistics, as on a long-lived database
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def full_scans(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            details = [row[-1] for row in cursor.fetchall()]
+        return [detail for detail in details if detail.startswith('SCAN invoicing_')]
+
+    def assertNoFullScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        self.assertEqual(self.full_scans(sql, params), [], sql)
+
+    def assertRequestUsesIndexes(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(APIClient(), method)(url, data, format='json')
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertLess(response.status_code, 400)
+        for query in queries:
+            if query['sql'].startswith(('SELECT', 'UPDATE', 'DELETE')):
+                self.assertEqual(self.full_scans(query['sql']), [], query['sql'])
+
+    def test_item_list_filters(self):
+        """Test that every item list filter and the keyset cursor use an index."""
+        for params in ({'name': 'Item 001'}, {'min_price': '5', 'max_price': '6'}, {'in_stock': 'false'}):
+            with self.subTest(params=params):
+                self.assertNoFullScan(filter_items(QueryDict(urlencode(params)))[:101])
+        self.assertNoFullScan(filter_items(QueryDict()).filter(id__gt=self.items[1500].id)[:101])
+
+    def test_checkout_lookups(self):
+        """Test that loading items and reading a purchase's lines use an index."""
+        self.assertNoFullScan(Item.objects.filter(id__in=[item.id for item in self.items[:20]]))
+        self.assertNoFullScan(PurchaseItem.objects.filter(purchase=self.purchase))
+        self.assertNoFullScan(PurchaseItem.objects.filter(purchase=self.purchase, item=self.items[0]))
+
+    def test_date_range_queries(self):
+        """Test that export and report date ranges use the created_at and day indexes."""
+        today = timezone.localdate().isoformat()
+        self.assertNoFullScan(export_queryset(today, today))
+        self.assertNoFullScan(rollup_range(timezone.localdate(), timezone.localdate()))
+
+    def test_hot_endpoints(self):
+        """Test every statement issued by the hot write and read endpoints."""
+        update_url = reverse('update-purchase', kwargs={'id': self.purchase.id})
+        line_item = self.purchase.purchaseitem_set.first().item
+        self.assertRequestUsesIndexes('patch', update_url, {"items": [{"id": line_item.id, "quantity": 0}]})
+        self.assertRequestUsesIndexes('get', reverse('generate-invoice', kwargs={'id': self.purchase.id}))
+        self.assertRequestUsesIndexes('get', reverse('sales-report') + '?start=2024-01-01')
+
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class QueryBudgetTestCase(TestCase):
+    """
+    Assert that read paths run a fixed number of queries however many lines
+    a purchase has.
+
+    Each check seeds purchases of increasing size and runs the same request
+    or serialization against each; every run must stay within the budget.
+    """
+    LINE_COUNTS = (1, 10, 200)
+
+    def seed_purchase(self, lines):
+        items = Item.objects.bulk_create([
+            Item(name=f"Item {i}", price=1.50, description="", stock=100)
+            for i in range(lines)
+        ])
+        purchase = Purchase.objects.create()
+        PurchaseItem.objects.bulk_create([
+            PurchaseItem(purchase=purchase, item=item, quantity=2, unit_price=1.50, line_total=3.00)
+            for item in items
+        ])
+        Purchase.objects.filter(pk=purchase.pk).update_totals()
+        return purchase
+
+    def assertQueryBudget(self, budget, func, *args):
+        for lines in self.LINE_COUNTS:
+            with self.subTest(lines=lines):
+                purchase = self.seed_purchase(lines)
+                with CaptureQueriesContext(connection) as queries:
+                    func(purchase, *args)
+                self.assertLessEqual(
+                    len(queries), budget,
+                    f"{len(queries)} queries for {lines} lines, budget is {budget}"
+                )
+
+    def test_invoice_query_budget(self):
+        """Test that rendering an invoice costs two queries regardless of line count."""
+        client = APIClient()
+
+        def render(purchase):
+            response = client.get(reverse('generate-invoice', kwargs={'id': purchase.id}))
+            self.assertEqual(response.status_code, 200)
+            b"".join(response.streaming_content)
+
+        self.assertQueryBudget(2, render)
+
+    def test_purchase_list_serialization_query_budget(self):
+        """Test that serializing many purchases costs two queries in total."""
+        def serialize(purchase):
+            data = PurchaseSerializer(Purchase.objects.with_lines(), many=True).data
+            self.assertTrue(data)
+
+        self.assertQueryBudget(2, serialize)
+
+
+class RendererTestCase(TestCase):
+    def setUp(self):
+        caches['catalogue'].clear()
+        self.client = APIClient()
+        Item.objects.create(name="Widget \u2028", price=Decimal('12.50'), description="Ünïcode", stock=3)
+        Item.objects.create(name="Gadget", price=Decimal('7.00'), description="", stock=0)
+
+    def test_item_rows_match_serializer(self):
+        """Test that the values() fast path produces exactly what ItemSerializer does."""
+        items = Item.objects.order_by('id')
+        self.assertEqual(
+            item_rows(items.values(*STREAM_FIELDS)),
+            [dict(row) for row in ItemSerializer(items, many=True).data],
+        )
+
+    def test_renderer_matches_drf(self):
+        """Test that the fast renderer's output matches DRF's, including datetimes, with exact decimals."""
+        data = {"items": ItemSerializer(Item.objects.all(), many=True).data, "total": Decimal('19.50')}
+        content = FastJSONRenderer().render(data)
+        self.assertNotIn('\u2028'.encode(), content)
+        self.assertEqual(json.loads(content)['items'], json.loads(JSONRenderer().render(data['items'])))
+        self.assertEqual(json.loads(content)['total'], '19.50')
+        moment = {"expires_at": timezone.now(), "day": timezone.localdate()}
+        self.assertEqual(FastJSONRenderer().render(moment), JSONRenderer().render(moment))
+        # Pretty output falls back to DRF's renderer
+        self.assertIn(b'\n    ', FastJSONRenderer().render(data, 'application/json; indent=4'))
+
+    def test_parser(self):
+        """Test that the fast parser reads JSON bodies and rejects malformed ones."""
+        self.assertEqual(FastJSONParser().parse(BytesIO(b'{"items": [{"id": 1, "quantity": 2}]}')),
+                         {"items": [{"id": 1, "quantity": 2}]})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"items": '))
+
+        response = self.client.post(reverse('create-purchase'), b'{"items": [', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_item_list_uses_fast_path(self):
+        """Test that the item list renders through the fast path with unchanged output."""
+        response = self.client.get(reverse('item-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsInstance(response.accepted_renderer, FastJSONRenderer)
+        self.assertEqual(response.json()[0]['price'], '12.50')
+        self.assertEqual(response.json()[0]['description'], "Ünïcode")
+
+    def test_serialization_benchmark(self):
+        """Test that both item serialization paths are timed over the same page."""
+        timings = time_item_serialization(limit=10, repeat=2)
+        self.assertEqual(timings['rows'], 2)
+        self.assertGreater(timings['model_serializer_ms'], 0)
+        self.assertGreater(timings['values_rows_ms'], 0)
+
+
+@skipUnless(connection.vendor == 'sqlite', "SQLite connection profiles")
+class SQLiteProfileTestCase(TestCase):
+    def connect(self, profile, directory):
+        settings_dict = {
+            **connection.settings_dict,
+            'NAME': os.path.join(directory, 'profile.sqlite3'),
+            'OPTIONS': settings.INVOICING_SQLITE_PROFILES[profile],
+        }
+        return connections['default'].__class__(settings_dict, alias='profile')
+
+    def pragmas(self, wrapper):
+        with wrapper.cursor() as cursor:
+            values = {}
+            for name in ('journal_mode', 'synchronous', 'cache_size', 'busy_timeout'):
+                cursor.execute(f'PRAGMA {name}')
+                values[name] = cursor.fetchone()[0]
+        return values
+
+    def test_production_profile(self):
+        """Test that production connections use WAL, relaxed syncing and BEGIN IMMEDIATE."""
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = self.connect('production', directory)
+            self.assertEqual(self.pragmas(wrapper), {
+                'journal_mode': 'wal', 'synchronous': 1, 'cache_size': -65536, 'busy_timeout': 10000,
+            })
+            # What transaction.atomic() does on entering its outermost block
+            with CaptureQueriesContext(wrapper) as queries:
+                wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+                wrapper.rollback()
+                wrapper.set_autocommit(True)
+            self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+            wrapper.close()
+
+    def test_development_profile(self):
+        """Test that the development profile keeps SQLite's defaults."""
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = self.connect('development', directory)
+            self.assertEqual(self.pragmas(wrapper)['journal_mode'], 'delete')
+            self.assertIsNone(wrapper.transaction_mode)
+            wrapper.close()
+
+    def test_asgi_disables_persistent_connections(self):
+        """Test that connections are not kept open between requests when served through ASGI."""
+        path = os.path.join(settings.BASE_DIR, 'invoice_system', 'settings.py')
+        with mock.patch.dict(os.environ, {'INVOICING_SERVER': 'asgi'}):
+            asgi = runpy.run_path(path)
+            with mock.patch.dict(os.environ, {'INVOICING_CONN_MAX_AGE': '30'}):
+                overridden = runpy.run_path(path)
+        self.assertEqual({alias: db['CONN_MAX_AGE'] for alias, db in asgi['DATABASES'].items()},
+                         {'default': 0, 'replica': 0})
+        self.assertEqual(overridden['DATABASES']['default']['CONN_MAX_AGE'], 30)
+
+
+@override_settings(INVOICING_READ_REPLICA='replica')
+class ReplicaRoutingTestCase(TransactionTestCase):
+    # The 'replica' alias mirrors the test database, so both connections see
+    # the same rows and each query can be attributed to the one that ran it.
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        caches['catalogue'].clear()
+        self.client = APIClient()
+        self.item = Item.objects.create(name="Widget", price=Decimal('10.00'), description="", stock=10)
+
+    def capture(self):
+        return CaptureQueriesContext(connections['default']), CaptureQueriesContext(connections['replica'])
+
+    def test_router(self):
+        """Test that invoicing reads go to the replica unless a transaction or write needs the primary."""
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Item), 'replica')
+        self.assertEqual(router.db_for_read(IdempotencyKey), 'default')
+        self.assertEqual(router.db_for_write(Item), 'default')
+        self.assertIsNone(router.db_for_read(User))
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Item), 'default')
+        with override_settings(INVOICING_READ_REPLICA=None):
+            self.assertIsNone(router.db_for_read(Item))
+
+    def test_reads_use_replica(self):
+        """Test that the item list and invoice are read from the replica."""
+        purchase = place_order([{"id": self.item.id, "quantity": 1}])
+        primary, replica = self.capture()
+        with primary, replica:
+            self.assertEqual(self.client.get(reverse('item-list')).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(reverse('purchase-detail', kwargs={'id': purchase.id})).status_code,
+                             status.HTTP_200_OK)
+        self.assertEqual(len(primary), 0)
+        self.assertGreater(len(replica), 0)
+
+    def test_writes_pin_reads_to_primary(self):
+        """Test that checkouts run on the primary and pin the client's following reads there."""
+        primary, replica = self.capture()
+        with primary, replica:
+            response = self.client.post(reverse('create-purchase'), {"items": [{"id": self.item.id, "quantity": 2}]},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(replica), 0)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        primary, replica = self.capture()
+        with primary, replica:
+            response = self.client.get(reverse('purchase-detail', kwargs={'id': response.data['purchase_id']}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(replica), 0)
+
+        # Once the pin expires, reads go back to the replica
+        self.client.cookies[PIN_COOKIE] = '0'
+        primary, replica = self.capture()
+        with primary, replica:
+            self.client.get(reverse('item-list'), {'limit': 5})
+        self.assertEqual(len(primary), 0)
+        self.assertGreater(len(replica), 0)
+
+
+@override_settings(INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name)
+class ArchiveTestCase(TransactionTestCase):
+    # Archive tables are created with DDL, which SQLite cannot run inside the
+    # transaction a TestCase wraps each test in.
+
+    def setUp(self):
+        self.client = APIClient()
+        self.widget = Item.objects.create(name="Widget", price=Decimal('10.00'), description="", stock=100)
+        self.gadget = Item.objects.create(name="Gadget", price=Decimal('2.50'), description="", stock=100)
+        self.old = [
+            place_order([{"id": self.widget.id, "quantity": 2}, {"id": self.gadget.id, "quantity": 1}]),
+            place_order([{"id": self.gadget.id, "quantity": 4}]),
+            place_order([{"id": self.widget.id, "quantity": 1}]),
+        ]
+        self.recent = place_order([{"id": self.widget.id, "quantity": 3}])
+        # Two purchases from January, one from February
+        for purchase, created_at in zip(self.old, ['2024-01-10T12:00', '2024-01-31T18:00', '2024-02-03T09:00']):
+            Purchase.objects.filter(pk=purchase.pk).update(
+                created_at=timezone.make_aware(datetime.datetime.fromisoformat(created_at)),
+            )
+        DailyItemSales.objects.rebuild()
+        self.addCleanup(self.drop_archive_tables)
+
+    def drop_archive_tables(self):
+        tables = set(connection.introspection.table_names())
+        with connection.schema_editor() as editor:
+            for month in (datetime.date(2024, 1, 1), datetime.date(2024, 2, 1)):
+                for model in archive_models(month):
+                    if model._meta.db_table in tables:
+                        editor.delete_model(model)
+
+    def test_archive_moves_purchases_by_month(self):
+        """Test that old purchases and lines move into their month's tables in batches."""
+        self.assertEqual(archive_purchases(datetime.date(2024, 3, 1), batch_size=2), 3)
+        self.assertEqual(list(Purchase.objects.values_list('id', flat=True)), [self.recent.id])
+        self.assertEqual(PurchaseItem.objects.count(), 1)
+
+        january = ArchiveMonth.objects.get(month=datetime.date(2024, 1, 1))
+        self.assertEqual((january.purchases, january.lines), (2, 3))
+        self.assertEqual((january.first_id, january.last_id), (self.old[0].id, self.old[1].id))
+        self.assertEqual(january.through, datetime.date(2024, 1, 31))
+        purchase_model, line_model = archive_models(datetime.date(2024, 2, 1))
+        self.assertEqual(purchase_model.objects.get().total, Decimal('10.00'))
+        self.assertEqual(line_model.objects.get().item_id, self.widget.id)
+
+        # Nothing left to move
+        self.assertEqual(archive_purchases(datetime.date(2024, 3, 1)), 0)
+
+    def test_archived_purchases_stay_readable(self):
+        """Test that the purchase detail and invoice endpoints fall back to the archive."""
+        call_command('archive_purchases', before='2024-03-01', stdout=StringIO())
+
+        purchase = archived_purchase(self.old[0].id)
+        self.assertEqual(purchase.created_at.date(), datetime.date(2024, 1, 10))
+        self.assertEqual([line.item.name for line in purchase.purchaseitem_set.all()], ["Widget", "Gadget"])
+
+        response = self.client.get(reverse('purchase-detail', kwargs={'id': self.old[0].id}), {'expand': 'items'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], '22.50')
+        self.assertEqual([line['item']['name'] for line in response.data['items']], ["Widget", "Gadget"])
+
+        response = self.client.get(reverse('generate-invoice', kwargs={'id': self.old[1].id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        text = PdfReader(BytesIO(b''.join(response.streaming_content))).pages[0].extract_text()
+        self.assertIn("Gadget", text)
+
+        response = self.client.get(reverse('purchase-detail', kwargs={'id': self.recent.id + 100}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rollup_rebuild_keeps_archived_days(self):
+        """Test that rebuilding the rollup does not drop the sales of archived days."""
+        archive_purchases(datetime.date(2024, 3, 1))
+        DailyItemSales.objects.rebuild()
+        report = rollup_range(datetime.date(2024, 1, 1), datetime.date(2024, 2, 28))
+        self.assertEqual(
+            sorted(report.values_list('day', 'item_id', 'units')),
+            sorted([(datetime.date(2024, 1, 10), self.widget.id, 2), (datetime.date(2024, 1, 10), self.gadget.id, 1),
+                    (datetime.date(2024, 1, 31), self.gadget.id, 4), (datetime.date(2024, 2, 3), self.widget.id, 1)]),
+        )
+
+
+class CatalogueSnapshotTestCase(TestCase):
+    def setUp(self):
+        caches['catalogue'].clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'catalogue.snap')
+        settings_override = override_settings(
+            INVOICING_CATALOGUE_SNAPSHOT=self.path, INVOICING_INVOICE_CACHE_DIR=INVOICE_CACHE_DIR.name,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.widget = Item.objects.create(name="Widget", price=Decimal('12.50'), description="Blue", stock=10)
+        self.gadget = Item.objects.create(name="Gädget", price=Decimal('0.99'), description="", stock=0)
+
+    def test_snapshot_matches_database(self):
+        """Test that lookups and pages read from the snapshot match the database."""
+        self.assertIsNone(catalogue_snapshot())
+        self.assertEqual(build_snapshot(), 2)
+        snapshot = catalogue_snapshot()
+        self.assertEqual(snapshot.get(self.gadget.id), ("Gädget", Decimal('0.99'), 0))
+        self.assertIsNone(snapshot.get(self.gadget.id + 1))
+
+        rows, next_cursor = snapshot.page(None, 1)
+        self.assertEqual(rows, item_rows(Item.objects.filter(pk=self.widget.pk).values(*STREAM_FIELDS)))
+        self.assertEqual(next_cursor, self.widget.id)
+        self.assertEqual(snapshot.page(next_cursor, 5), (item_rows(Item.objects.filter(pk=self.gadget.pk).values(*STREAM_FIELDS)), None))
+
+    def test_incremental_refresh(self):
+        """Test that stock changes are written in place and other changes go to the overlay."""
+        build_snapshot()
+        generation = catalogue_snapshot().generation
+        inode = os.stat(self.path).st_ino
+        gadget_id = self.gadget.id
+
+        with self.captureOnCommitCallbacks(execute=True):
+            place_order([{"id": self.widget.id, "quantity": 3}])
+        self.assertEqual(catalogue_snapshot().get(self.widget.id)[2], 7)
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.widget.refresh_from_db()
+            self.widget.price = Decimal('15.00')
+            self.widget.save()
+            added = Item.objects.create(name="Gizmo", price=Decimal('3.00'), description="", stock=1)
+            self.gadget.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            place_order([{"id": added.id, "quantity": 1}])
+        snapshot = catalogue_snapshot()
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(snapshot.generation, generation)
+        rows, _ = snapshot.page(None, 10)
+        self.assertEqual([row["id"] for row in rows], [self.widget.id, added.id])
+        self.assertEqual(snapshot.get(self.widget.id), ("Widget", Decimal('15.00'), 7))
+        self.assertEqual(snapshot.get(added.id), ("Gizmo", Decimal('3.00'), 0))
+        self.assertIsNone(snapshot.get(gadget_id))
+
+        self.assertEqual(compact_snapshot(), 3)
+        compacted = catalogue_snapshot()
+        self.assertFalse(os.path.exists(f'{self.path}.overlay'))
+        self.assertEqual(compacted.generation, generation + 1)
+        self.assertEqual(compacted.page(None, 10), (rows, None))
+
+    def test_failed_refresh_drops_snapshot(self):
+        """Test that a refresh error after commit removes the snapshot instead of failing the request."""
+        purchase = place_order([{"id": self.widget.id, "quantity": 1}])
+        build_snapshot()
+        with mock.patch('invoicing.snapshot.refresh_snapshot', side_effect=OSError("disk full")), \
+                self.assertLogs('invoicing.snapshot', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.put(reverse('update-purchase', kwargs={'id': purchase.id}), {
+                    "items": [{"id": self.widget.id, "quantity": 2}]
+                }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(catalogue_snapshot())
+
+    def test_views_read_items_from_snapshot(self):
+        """Test that the item list needs no query and invoices no item join with a snapshot."""
+        purchase = place_order([{"id": self.widget.id, "quantity": 1}])
+        build_snapshot()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('item-list'))
+        self.assertEqual(response.json()[0], {"id": self.widget.id, "name": "Widget", "price": "12.50",
+                                              "description": "Blue", "stock": 9})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('generate-invoice', kwargs={'id': purchase.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('JOIN "invoicing_item"' in query['sql'] for query in queries))
+        text = PdfReader(BytesIO(b''.join(response.streaming_content))).pages[0].extract_text()
+        self.assertIn("Widget", text)
+
+    async def test_async_invoice_reads_items_from_snapshot(self):
+        """Test that the async invoice view attaches items from the snapshot and loads the rest."""
+        await sync_to_async(build_snapshot)()
+        gizmo = await Item.objects.acreate(name="Gizmo", price=Decimal('3.00'), description="", stock=5)
+        purchase = await sync_to_async(place_order)([
+            {"id": self.widget.id, "quantity": 1}, {"id": gizmo.id, "quantity": 2},
+        ])
+        response = await self.async_client.get(reverse('async-generate-invoice', kwargs={'id': purchase.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        text = PdfReader(BytesIO(response.content)).pages[0].extract_text()
+        self.assertIn("Widget", text)
+        self.assertIn("Gizmo", text)
+
+    def test_item_change_refreshes_snapshot_before_bumping_version(self):
+        """Test that an item edit republishes the snapshot before invalidating cached pages."""
+        build_snapshot()
+        order = []
+        with mock.patch('invoicing.snapshot.refresh_snapshot', side_effect=lambda ids: order.append('snapshot')), \
+                mock.patch('invoicing.cache.bump_catalogue_version', side_effect=lambda: order.append('version')):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.widget.name = "Widget 2"
+                self.widget.save()
+        self.assertEqual(order, ['snapshot', 'version'])
+
+
+class AdminTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.client.force_login(self.admin)
+        self.items = [
+            Item.objects.create(name=f"Item {n}", price=Decimal('2.00'), description="", stock=100)
+            for n in range(5)
+        ]
+        self.purchase = place_order([{"id": item.id, "quantity": 1} for item in self.items])
+
+    def test_purchase_page_query_count_is_bounded(self):
+        """Test that the purchase page loads its lines and their items in a fixed number of queries."""
+        one_line = place_order([{"id": self.items[0].id, "quantity": 1}])
+        self.client.get(reverse('admin:invoicing_purchase_change', args=(one_line.id,)))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('admin:invoicing_purchase_change', args=(one_line.id,)))
+
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('admin:invoicing_purchase_change', args=(self.purchase.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Item 4")
+
+    def test_line_changelist_joins_related_rows(self):
+        """Test that the line changelist does not query purchases or items per row."""
+        url = reverse('admin:invoicing_purchaseitem_changelist')
+        with CaptureQueriesContext(connection) as five_lines:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        place_order([{"id": item.id, "quantity": 2} for item in self.items])
+        with self.assertNumQueries(len(five_lines)):
+            self.client.get(url)
+
+    def test_changelist_estimates_large_unfiltered_counts(self):
+        """Test that large unfiltered changelists are counted from the id range instead of COUNT(*)."""
+        url = reverse('admin:invoicing_purchase_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertTrue(any('COUNT(*)' in query['sql'] for query in queries))
+
+        Purchase.objects.create(id=self.purchase.id + 20000)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.context['cl'].result_count, 20001)
+        self.assertFalse(any('COUNT(*)' in query['sql'] for query in queries))
+
+        response = self.client.get(url, {'created_at__year': timezone.localdate().year})
+        self.assertEqual(response.context['cl'].result_count, 2)
@@ -1,9 +1,32 @@
 from django.urls import path
-from .views import CreatePurchaseView, ItemListView, UpdatePurchaseView, InvoiceView
+from . import async_views
+from .views import (
+    CreatePurchaseView, ItemListView, UpdatePurchaseView, InvoiceView,
+    InvoiceRenderView, InvoiceJobView, InvoiceJobDownloadView, InvoiceExportView,
+    BulkPurchaseView, SalesReportView, MetricsView, ReservationListView, ReservationView,
+    ReservationCheckoutView, PurchaseListView, PurchaseDetailView,
+)
 
 urlpatterns = [
     path('items/', ItemListView.as_view(), name='item-list'),
     path('purchase/', CreatePurchaseView.as_view(), name='create-purchase'),
     path('purchase/<int:id>/', UpdatePurchaseView.as_view(), name='update-purchase'),
+    path('purchases/', PurchaseListView.as_view(), name='purchase-list'),
+    path('purchases/<int:id>/', PurchaseDetailView.as_view(), name='purchase-detail'),
+    path('purchases/bulk/', BulkPurchaseView.as_view(), name='bulk-purchases'),
+    path('reservations/', ReservationListView.as_view(), name='reservations'),
+    path('reservations/<uuid:token>/', ReservationView.as_view(), name='reservation'),
+    path('reservations/<uuid:token>/checkout/', ReservationCheckoutView.as_view(), name='reservation-checkout'),
     path('invoice/<int:id>/', InvoiceView.as_view(), name='generate-invoice'),
+    path('invoice/<int:id>/render/', InvoiceRenderView.as_view(), name='render-invoice'),
+    path('invoice/jobs/<str:job_id>/', InvoiceJobView.as_view(), name='invoice-job'),
+    path('invoice/jobs/<str:job_id>/download/', InvoiceJobDownloadView.as_view(), name='invoice-job-download'),
+    path('invoices/export/', InvoiceExportView.as_view(), name='export-invoices'),
+    path('reports/sales/', SalesReportView.as_view(), name='sales-report'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+
+    # ASGI-native variants of the hot endpoints
+    path('async/items/', async_views.item_list, name='async-item-list'),
+    path('async/purchase/', async_views.create_purchase, name='async-create-purchase'),
+    path('async/invoice/<int:id>/', async_views.invoice, name='async-generate-invoice'),
 ]
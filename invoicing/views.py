@@ -1,32 +1,122 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import Item, Purchase, PurchaseItem
-from .serializers import ItemSerializer
+from .models import Purchase, Reservation
+from .archive import get_purchase, is_archived
+from .serializers import PurchaseReadSerializer
+from .checkout import CheckoutError, place_order, update_lines
+from .catalogue import (
+    STREAM_FIELDS, CatalogueQueryError, filter_items, is_unfiltered, item_rows, ndjson_line, paginate, parse_page,
+)
+from .idempotency import idempotent
+from .instrumentation import registry, timed
+from .invoices import InvoiceStore, invoice_purchase
+from .jobs import DONE, FAILED, render_queue
+from .ingest import import_purchases, parse_csv, parse_ndjson
+from .purchases import PurchaseQueryError, filter_purchases, parse_shape, purchase_queryset
+from .reports import ReportQueryError, parse_report_params, sales_report
+from .reservations import ReservationExpired, checkout, release, reserve
+from .params import set_next_link
+from .snapshot import catalogue_snapshot
+from .export import (
+    ExportQueryError, export_executor, export_queryset, export_workers, parse_ids,
+    render_invoices, stream_zip,
+)
+from .cache import catalogue_cache, catalogue_version, list_etag, list_response_key, params_digest
+
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+
+
+def _payload(request):
+    # The request body, which every write endpoint expects to be an object
+    if not isinstance(request.data, dict):
+        raise CheckoutError("Body must be a JSON object")
+    return request.data
 
 
-from django.http import FileResponse
-from reportlab.pdfgen import canvas
-from io import BytesIO
-
 class ItemListView(APIView):
     """
-    API View to fetch and return a list of all available items.
+    API View to fetch and return the catalogue of available items.
+
+    Results are ordered by id and paginated with a keyset cursor: the ``Link``
+    response header carries the URL of the next page. Pass ``?stream=ndjson``
+    to stream every matching item as newline-delimited JSON instead.
+
+    Pages are cached per query and catalogue version (see invoicing.cache)
+    and carry an ``ETag`` so clients can revalidate with ``If-None-Match``.
     """
+    page_size = 100
+    max_page_size = 1000
+    stream_chunk_size = 2000
 
     def get(self, request):
         """
-        Handle GET requests to retrieve all items.
+        Handle GET requests to retrieve items.
 
         Args:
-            request: The HTTP request object.
+            request: The HTTP request object. Supported query parameters are
+                ``name`` (prefix), ``min_price``, ``max_price``, ``in_stock``,
+                ``cursor``, ``limit`` and ``stream``.
 
         Returns:
-            Response: A JSON response containing a list of items with details
-            like name, price, description, and stock.
+            Response: A JSON response containing a page of items with details
+            like name, price, description, and stock, or a streaming NDJSON
+            response when ``stream=ndjson`` is requested.
+        """
+        # The ETag only depends on the catalogue version and the query, so a
+        # client revalidating an unchanged page costs no database work at all.
+        version = catalogue_version()
+        digest = params_digest(request.query_params)
+        etag = list_etag(version, digest)
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return Response(status=304, headers={'ETag': etag})
+
+        try:
+            items = filter_items(request.query_params)
+            if request.query_params.get('stream') == 'ndjson':
+                response = self.stream(items)
+                response['ETag'] = etag
+                return response
+            cursor, limit = parse_page(request.query_params, self.page_size, self.max_page_size)
+        except CatalogueQueryError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        cache = catalogue_cache()
+        key = list_response_key(version, digest)
+        cached = cache.get(key)
+        if cached is None:
+            snapshot = catalogue_snapshot() if is_unfiltered(request.query_params) else None
+            if snapshot is not None:
+                cached = snapshot.page(cursor, limit)
+            else:
+                page, next_cursor = paginate(items.values(*STREAM_FIELDS), cursor, limit)
+                with timed('serialize'):
+                    cached = (item_rows(page), next_cursor)
+            cache.set(key, cached)
+        data, next_cursor = cached
+
+        response = Response(data, headers={'ETag': etag})
+        set_next_link(response, request, request.query_params, next_cursor)
+        return response
+
+    def stream(self, items):
+        """
+        Stream every item in ``items`` as one JSON object per line.
+
+        Rows are read with a server-side iterator in fixed-size chunks, so
+        memory use does not grow with the size of the catalogue.
         """
-        items = Item.objects.all()
-        serializer = ItemSerializer(items, many=True)
-        return Response(serializer.data)
+        rows = items.values_list(*STREAM_FIELDS)
+
+        def lines():
+            for row in rows.iterator(chunk_size=self.stream_chunk_size):
+                yield ndjson_line(row)
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
 
 
 class CreatePurchaseView(APIView):
@@ -34,10 +124,14 @@ class CreatePurchaseView(APIView):
     API View to handle the creation of a new purchase.
     """
 
+    @idempotent
     def post(self, request):
         """
         Handle POST requests to create a new purchase.
 
+        Send an ``Idempotency-Key`` header to make retries safe: a repeat
+        with the same key returns the first response instead of buying again.
+
         Args:
             request: The HTTP request object containing a list of items to purchase.
 
@@ -59,35 +153,96 @@ class CreatePurchaseView(APIView):
             ]
         }
         """
-        data = request.data
-        purchase = Purchase.objects.create()
-
-        for item_data in data['items']:
-            item = Item.objects.get(id=item_data['id'])
-
-            # Check if enough stock is available
-            if item.stock >= item_data['quantity']:
-                item.stock -= item_data['quantity']
-                item.save()
-                PurchaseItem.objects.create(
-                    purchase=purchase,
-                    item=item,
-                    quantity=item_data['quantity']
-                )
-            else:
-                return Response({"error": f"Not enough stock for {item.name}"}, status=400)
+        # Lines are loaded, stock-checked, decremented and inserted as a set
+        # inside one transaction; see invoicing.checkout for the details.
+        try:
+            purchase = place_order(_payload(request).get('items'))
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=400)
 
         return Response({"purchase_id": purchase.id}, status=201)
 
 
+class PurchaseListView(APIView):
+    """
+    API View to list purchases, newest first.
+
+    Results are paginated with a keyset cursor like the item list: the
+    ``Link`` response header carries the URL of the next page.
+    """
+    page_size = 50
+    max_page_size = 500
+
+    def get(self, request):
+        """
+        Handle GET requests to list purchases.
+
+        Args:
+            request: The HTTP request object. Supported query parameters are
+                ``start`` and ``end`` (``YYYY-MM-DD``, inclusive), ``fields``
+                (comma-separated, e.g. ``id,total``), ``expand=items``,
+                ``cursor`` and ``limit``.
+
+        Returns:
+            Response: A JSON list of purchases with the requested fields.
+        """
+        params = request.query_params
+        try:
+            fields, expand = parse_shape(params)
+            purchases = filter_purchases(purchase_queryset(fields, expand), params).order_by('-id')
+            cursor, limit = parse_page(params, self.page_size, self.max_page_size)
+        except (PurchaseQueryError, CatalogueQueryError) as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        page, next_cursor = paginate(purchases, cursor, limit, descending=True)
+        with timed('serialize'):
+            data = PurchaseReadSerializer(page, many=True, fields=fields, expand=expand).data
+
+        response = Response(data)
+        set_next_link(response, request, params, next_cursor)
+        return response
+
+
+class PurchaseDetailView(APIView):
+    """
+    API View to read a single purchase.
+    """
+
+    def get(self, request, id):
+        """
+        Handle GET requests for one purchase.
+
+        Args:
+            request: The HTTP request object. Accepts the same ``fields``
+                and ``expand`` parameters as the purchase list.
+            id: The ID of the purchase.
+
+        Returns:
+            Response: The purchase with the requested fields, or 404.
+        """
+        try:
+            fields, expand = parse_shape(request.query_params)
+        except PurchaseQueryError as exc:
+            return Response({"error": str(exc)}, status=400)
+        try:
+            purchase = get_purchase(purchase_queryset(fields, expand), id)
+        except Purchase.DoesNotExist:
+            return Response({"error": "Purchase not found"}, status=404)
+        return Response(PurchaseReadSerializer(purchase, fields=fields, expand=expand).data)
+
 class UpdatePurchaseView(APIView):
     """
     API View to handle updating an existing purchase.
     """
 
+    @idempotent
     def put(self, request, id):
         """
-        Handle PUT requests to update the list of items in a purchase.
+        Handle PUT requests to replace the list of items in a purchase.
+
+        Only lines that actually change are written, and item stock is
+        adjusted by the difference from the previous quantities. Like
+        purchase creation, it accepts an ``Idempotency-Key`` header.
 
         Args:
             request: The HTTP request object containing the updated list of items.
@@ -110,16 +265,42 @@ class UpdatePurchaseView(APIView):
             ]
         }
         """
-        purchase = Purchase.objects.get(id=id)
-        purchase.items.clear()
+        return self.update(request, id, partial=False)
 
-        for item_data in request.data['items']:
-            item = Item.objects.get(id=item_data['id'])
-            PurchaseItem.objects.create(
-                purchase=purchase,
-                item=item,
-                quantity=item_data['quantity']
-            )
+    @idempotent
+    def patch(self, request, id):
+        """
+        Handle PATCH requests to change only some lines of a purchase.
+
+        Listed items are set to the given quantity (added if new) and a
+        quantity of 0 removes the line; other lines are left untouched.
+
+        Payload format:
+        {
+            "items": [
+                {
+                    "id": 2,
+                    "quantity": 0
+                }
+            ]
+        }
+        """
+        return self.update(request, id, partial=True)
+
+    def update(self, request, id, partial):
+        try:
+            purchase = Purchase.objects.get(id=id)
+        except Purchase.DoesNotExist:
+            return Response({"error": "Purchase not found"}, status=404)
+
+        # Apply only the changed lines and reconcile stock in one transaction
+        try:
+            update_lines(purchase, _payload(request).get('items'), partial=partial)
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        # Drop rendered invoices built from the old lines
+        InvoiceStore().invalidate(purchase.id)
 
         return Response({"message": "Purchase updated successfully"})
 
@@ -135,35 +316,318 @@ class InvoiceView(APIView):
         Returns:
             FileResponse: A response containing the generated PDF file as an attachment.
         """
-        # Retrieve the purchase object by ID
-        purchase = Purchase.objects.get(id=id)
+        # Retrieve the purchase with its lines and items in two queries (or
+        # from the archive)
+        try:
+            purchase, lines = invoice_purchase(id)
+        except Purchase.DoesNotExist:
+            return Response({"error": "Purchase not found"}, status=404)
+
+        # Serve the stored PDF when one matches the current lines, otherwise
+        # render and store it
+        file, digest, last_modified = InvoiceStore().open(purchase, lines)
+        etag = f'"{digest}"'
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+        if not_modified is not None:
+            file.close()
+            return not_modified
+
+        # Return the PDF file as a downloadable response
+        response = FileResponse(file, as_attachment=True, filename='invoice.pdf')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class InvoiceRenderView(APIView):
+    """
+    API View to render an invoice in the background instead of in the request.
+    """
 
-        # Create an in-memory buffer to hold the PDF data
-        buffer = BytesIO()
+    def post(self, request, id):
+        """
+        Queue a render of the invoice for a given purchase.
 
-        # Initialize a PDF canvas
-        pdf = canvas.Canvas(buffer)
+        Args:
+            request: The HTTP request object.
+            id: The ID of the purchase to render the invoice for.
+
+        Returns:
+            Response: 202 with the job id and status. A render already queued
+            or running for the same purchase is returned instead of a new one.
+        """
+        if not Purchase.objects.filter(id=id).exists() and not is_archived(id):
+            return Response({"error": "Purchase not found"}, status=404)
 
-        # Add invoice title
-        pdf.drawString(100, 800, "Invoice")
+        job, _ = render_queue.submit(id)
+        status_url = reverse('invoice-job', kwargs={'job_id': job.id})
+        return Response(
+            {"job_id": job.id, "status": job.status},
+            status=202,
+            headers={'Location': request.build_absolute_uri(status_url)},
+        )
 
-        # Start adding purchase item details at the specified position
-        y = 750
-        for item in purchase.purchaseitem_set.all():
-            # Write item name, quantity, and price
-            pdf.drawString(100, y, f"{item.item.name} x {item.quantity} @ {item.item.price}")
-            y -= 20
 
-        # Calculate and display the total price
-        total = sum([p.item.price * p.quantity for p in purchase.purchaseitem_set.all()])
-        pdf.drawString(100, y - 20, f"Total: {total}")
+class InvoiceJobView(APIView):
+    def get(self, request, job_id):
+        """
+        Report the status of a background invoice render.
+
+        Returns:
+            Response: The job's status (queued, running, done or failed). Done
+            jobs include a ``download`` URL for the rendered PDF.
+        """
+        job = render_queue.get(job_id)
+        if job is None:
+            return Response({"error": "Job not found"}, status=404)
+
+        data = {"job_id": job.id, "purchase_id": job.purchase_id, "status": job.status}
+        if job.status == DONE:
+            data["download"] = request.build_absolute_uri(
+                reverse('invoice-job-download', kwargs={'job_id': job.id})
+            )
+        elif job.status == FAILED:
+            data["error"] = job.error
+        return Response(data)
 
-        # Finalize the PDF content and save it
-        pdf.showPage()
-        pdf.save()
 
-        # Rewind the buffer to the beginning
-        buffer.seek(0)
+class InvoiceJobDownloadView(APIView):
+    def get(self, request, job_id):
+        """
+        Return the PDF produced by a finished background render.
+
+        Returns:
+            FileResponse: The rendered invoice as an attachment, 409 if the job
+            has not finished yet, or 410 if the purchase changed since.
+        """
+        job = render_queue.get(job_id)
+        if job is None:
+            return Response({"error": "Job not found"}, status=404)
+        if job.status != DONE:
+            return Response({"error": f"Job is {job.status}"}, status=409)
+
+        try:
+            file = job.path.open('rb')
+        except FileNotFoundError:
+            return Response({"error": "Invoice has changed since it was rendered"}, status=410)
+        return FileResponse(file, as_attachment=True, filename='invoice.pdf')
+
+
+class InvoiceExportView(APIView):
+    """
+    API View to download the invoices of many purchases as one ZIP archive.
+    """
 
-        # Return the generated PDF file as a downloadable response
-        return FileResponse(buffer, as_attachment=True, filename='invoice.pdf')
\ No newline at end of file
+    def get(self, request):
+        """
+        Stream a ZIP with one ``invoice-<id>.pdf`` per selected purchase.
+
+        Args:
+            request: The HTTP request object. Select purchases with ``start``
+                and/or ``end`` (``YYYY-MM-DD``, inclusive) or with ``ids``
+                (comma-separated).
+
+        Returns:
+            StreamingHttpResponse: The archive, produced while invoices are
+            rendered across the export process pool.
+        """
+        params = request.query_params
+        try:
+            ids = parse_ids(params.get('ids', ''))
+            purchases = export_queryset(params.get('start'), params.get('end'), ids)
+        except ExportQueryError as exc:
+            return Response({"error": str(exc)}, status=400)
+
+        executor = export_executor()
+        rendered = render_invoices(purchases, executor, window=2 * export_workers())
+        response = StreamingHttpResponse(stream_zip(rendered), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="invoices.zip"'
+        return response
+
+
+class BulkPurchaseView(APIView):
+    """
+    API View to import many purchases in one request.
+    """
+    chunk_size = 500
+
+    def post(self, request):
+        """
+        Handle POST requests with a stream of purchases.
+
+        Args:
+            request: The HTTP request object. The body is either NDJSON
+                (``Content-Type: application/x-ndjson``), one
+                ``{"items": [...]}`` object per line, or CSV
+                (``Content-Type: text/csv``) with an ``order,item,quantity``
+                header.
+
+        Returns:
+            Response: The ids of the created purchases and the errors of the
+            records that failed, each keyed by record (NDJSON line number or
+            CSV order).
+        """
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type == 'application/x-ndjson':
+            parse = parse_ndjson
+        elif content_type == 'text/csv':
+            parse = parse_csv
+        else:
+            return Response({"error": "Send application/x-ndjson or text/csv"}, status=415)
+
+        # Read the body line by line rather than loading it whole
+        stream = request.stream
+        lines = (line.decode('utf-8', errors='replace') for line in stream) if stream is not None else []
+        report = import_purchases(parse(lines), chunk_size=self.chunk_size)
+        return Response(report.as_dict())
+
+
+class SalesReportView(APIView):
+    """
+    API View to report sales over a date range.
+    """
+
+    def get(self, request):
+        """
+        Report revenue and units sold, per day and for the best-selling items.
+
+        Args:
+            request: The HTTP request object. Supported query parameters are
+                ``start`` and ``end`` (``YYYY-MM-DD``, inclusive), ``top``
+                (number of items to rank, default 10) and ``by``
+                (``revenue`` or ``units``).
+
+        Returns:
+            Response: Totals for the range, a ``daily`` series and the
+            ``top_items``, read from the daily sales rollup.
+        """
+        try:
+            start, end, top, by = parse_report_params(request.query_params)
+        except ReportQueryError as exc:
+            return Response({"error": str(exc)}, status=400)
+        return Response(sales_report(start, end, top=top, by=by))
+
+
+def _reservation_data(reservation):
+    return {
+        "reservation": str(reservation.token),
+        "status": reservation.status,
+        "expires_at": reservation.expires_at,
+        "items": [
+            {"id": line.item_id, "quantity": line.quantity}
+            for line in reservation.reserveditem_set.order_by('id')
+        ],
+        "purchase_id": reservation.purchase_id,
+    }
+
+
+class ReservationListView(APIView):
+    """
+    API View to hold stock for a cart before checkout.
+    """
+
+    def post(self, request):
+        """
+        Place a time-limited hold on stock.
+
+        Args:
+            request: The HTTP request object with the same ``items`` list as
+                a purchase and an optional ``ttl`` in seconds.
+
+        Returns:
+            Response: 201 with the reservation token and expiry, or 400 if
+            the stock cannot be held.
+
+        Payload format:
+        {
+            "items": [
+                {
+                    "id": 1,
+                    "quantity": 2
+                }
+            ],
+            "ttl": 600
+        }
+        """
+        try:
+            payload = _payload(request)
+            reservation = reserve(payload.get('items'), payload.get('ttl'))
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=400)
+        return Response(_reservation_data(reservation), status=201)
+
+
+class ReservationView(APIView):
+    """
+    API View to inspect or cancel a reservation.
+    """
+
+    def get(self, request, token):
+        """
+        Return a reservation's status, expiry and held items.
+        """
+        try:
+            reservation = Reservation.objects.get(token=token)
+        except Reservation.DoesNotExist:
+            return Response({"error": "Reservation not found"}, status=404)
+        return Response(_reservation_data(reservation))
+
+    def delete(self, request, token):
+        """
+        Release a reservation, returning its stock.
+
+        Returns:
+            Response: 204, or 409 if it was already used, released or expired.
+        """
+        try:
+            reservation = Reservation.objects.get(token=token)
+        except Reservation.DoesNotExist:
+            return Response({"error": "Reservation not found"}, status=404)
+        try:
+            release(reservation)
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=409)
+        return Response(status=204)
+
+
+class ReservationCheckoutView(APIView):
+    """
+    API View to turn a reservation into a purchase.
+    """
+
+    def post(self, request, token):
+        """
+        Check out the held items.
+
+        Returns:
+            Response: 201 with the purchase ID, 410 if the hold expired, or
+            409 if the reservation was already used or released.
+        """
+        try:
+            reservation = Reservation.objects.get(token=token)
+        except Reservation.DoesNotExist:
+            return Response({"error": "Reservation not found"}, status=404)
+        try:
+            purchase = checkout(reservation)
+        except ReservationExpired as exc:
+            return Response({"error": str(exc)}, status=410)
+        except CheckoutError as exc:
+            return Response({"error": str(exc)}, status=409)
+        return Response({"purchase_id": purchase.id}, status=201)
+
+class MetricsView(APIView):
+    """
+    API View exposing request metrics for Prometheus to scrape.
+    """
+
+    def get(self, request):
+        """
+        Return the request metrics of this process.
+
+        Returns:
+            HttpResponse: Request counts and durations, SQL counts and time,
+            serializer/PDF render time and response bytes per view, in the
+            Prometheus text exposition format.
+        """
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')